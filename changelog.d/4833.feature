@@ -0,0 +1 @@
+Persist the results of state resolution so that they can be reused across workers and restarts.
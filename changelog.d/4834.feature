@@ -0,0 +1 @@
+Avoid loading the full room state when computing the context of new non-state events.
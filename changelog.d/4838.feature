@@ -0,0 +1 @@
+Reuse a summary of the previous sync response when computing the state for gappy incremental syncs.
@@ -0,0 +1 @@
+Fetch timelines and unread notification counts for many rooms at once when generating initial syncs.
@@ -0,0 +1 @@
+Send initial sync responses with chunked encoding, encoding a room at a time, rather than encoding the whole response in one go.
@@ -0,0 +1 @@
+Add an option to keep precomputed initial sync responses for selected users, such as bots and bridges.
@@ -0,0 +1 @@
+Add jitter to sync long-poll timeouts and an optional limit on concurrent sync computations.
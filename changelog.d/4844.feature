@@ -0,0 +1 @@
+Persist the lazy-loaded members sent to each device, so that they are not resent by other synchrotrons or after a restart.
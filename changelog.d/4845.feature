@@ -0,0 +1 @@
+Look up the unread notification counts for all the rooms in a sync response in a single query.
@@ -0,0 +1 @@
+Keep a materialised summary of each room's membership for the lazy-loading room summary in /sync.
@@ -0,0 +1 @@
+Answer idle incremental syncs without computing a response when the notifier knows nothing has changed for the user.
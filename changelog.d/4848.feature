@@ -0,0 +1 @@
+Keep track of which rooms each federation destination has missed events in, so that unreachable servers are caught up with the latest events rather than having their events queued up in memory.
@@ -0,0 +1 @@
+Allow outbound federation to be sharded across several federation_sender workers by destination.
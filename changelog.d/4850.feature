@@ -0,0 +1 @@
+Keep track of the servers in each room as its membership changes, rather than recalculating them from the room's state for each event, presence update, typing notification and receipt sent over federation.
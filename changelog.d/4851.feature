@@ -0,0 +1 @@
+Adapt the size of federation transactions, and how long to wait before sending them, to how quickly each destination responds.
@@ -0,0 +1 @@
+Process the PDUs in incoming federation transactions in the background, so that a room which is slow to fetch missing events doesn't hold up other rooms.
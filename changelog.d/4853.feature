@@ -0,0 +1 @@
+Check the signatures and content hashes of received events in batches in the thread pool, rather than on the reactor thread.
@@ -0,0 +1 @@
+Parse large federation responses (/send_join, /state, /get_missing_events and /backfill) as they arrive, if ijson is installed.
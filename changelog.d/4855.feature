@@ -0,0 +1 @@
+Cache server signing keys in memory, refresh them before they expire, and batch lookups via the perspectives servers.
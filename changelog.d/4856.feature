@@ -0,0 +1 @@
+Make the federation connection pool configurable, cache the absence of SRV records, and add metrics for connection reuse and DNS, connect and TLS handshake times.
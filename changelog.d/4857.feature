@@ -0,0 +1 @@
+Backfill from the servers which have been quickest to respond first, several at a time, and prefetch the next page of history when a client paginates.
@@ -27,6 +27,7 @@ from synapse import event_auth
 from synapse.api.constants import EventTypes, JoinRules, Membership
 from synapse.api.errors import AuthError, Codes, ResourceLimitError
 from synapse.config.server import is_threepid_reserved
+from synapse.storage.state import StateFilter
 from synapse.types import UserID
 from synapse.util.caches import CACHE_SIZE_FACTOR, register_cache
 from synapse.util.caches.lrucache import LruCache
@@ -66,7 +67,12 @@ class Auth(object):
 
     @defer.inlineCallbacks
     def check_from_context(self, room_version, event, context, do_sig_check=True):
-        prev_state_ids = yield context.get_prev_state_ids(self.store)
+        # we only need the auth state, so don't load the full state map if we
+        # haven't already.
+        prev_state_ids = yield context.get_prev_state_ids(
+            self.store,
+            StateFilter.from_types(event_auth.auth_types_for_event(event)),
+        )
         auth_events_ids = yield self.compute_auth_events(
             event, prev_state_ids, for_verification=True,
         )
@@ -38,6 +38,7 @@ from synapse.replication.slave.storage.registration import SlavedRegistrationSto
 from synapse.replication.slave.storage.transactions import SlavedTransactionStore
 from synapse.replication.tcp.client import ReplicationClientHandler
 from synapse.server import HomeServer
+from synapse.storage._base import LoggingTransaction
 from synapse.storage.engines import create_engine
 from synapse.util.async_helpers import Linearizer
 from synapse.util.httpresourcetree import create_resource_tree
@@ -62,18 +63,20 @@ class FederationSenderSlaveStore(
         self.federation_out_pos_startup = self._get_federation_out_pos(db_conn)
 
     def _get_federation_out_pos(self, db_conn):
-        sql = (
-            "SELECT stream_id FROM federation_stream_position"
-            " WHERE type = ?"
+        txn = LoggingTransaction(
+            db_conn.cursor(),
+            name="_get_federation_out_pos",
+            database_engine=self.database_engine,
+            after_callbacks=[],
+            exception_callbacks=[],
+        )
+        stream_id = self._get_federation_out_pos_txn(
+            txn, "federation", self.hs.config.federation_sender_instance_name,
         )
-        sql = self.database_engine.convert_param_style(sql)
-
-        txn = db_conn.cursor()
-        txn.execute(sql, ("federation",))
-        rows = txn.fetchall()
         txn.close()
+        db_conn.commit()
 
-        return rows[0][0] if rows else -1
+        return stream_id
 
 
 class FederationSenderServer(HomeServer):
@@ -205,6 +208,8 @@ class FederationSenderHandler(object):
         self.federation_sender = hs.get_federation_sender()
         self.replication_client = replication_client
 
+        self._instance_name = hs.config.federation_sender_instance_name
+
         self.federation_position = self.store.federation_out_pos_startup
         self._fed_position_linearizer = Linearizer(name="_fed_position_linearizer")
 
@@ -248,7 +253,9 @@ class FederationSenderHandler(object):
 
                     # We ACK this token over replication so that the master can drop
                     # its in memory queues
-                    self.replication_client.send_federation_ack(self.federation_position)
+                    self.replication_client.send_federation_ack(
+                        self.federation_position, self._instance_name,
+                    )
                     self._last_ack = self.federation_position
         except Exception:
             logger.exception("Error updating federation stream position")
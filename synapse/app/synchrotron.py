@@ -54,6 +54,7 @@ from synapse.rest.client.v1.room import RoomInitialSyncRestServlet
 from synapse.rest.client.v2_alpha import sync
 from synapse.server import HomeServer
 from synapse.storage.engines import create_engine
+from synapse.storage.lazy_loaded_members import LazyLoadedMembersStore
 from synapse.storage.presence import UserPresenceState
 from synapse.util.httpresourcetree import create_resource_tree
 from synapse.util.logcontext import LoggingContext, run_in_background
@@ -77,6 +78,7 @@ class SynchrotronSlavedStore(
     SlavedPushRuleStore,
     SlavedEventStore,
     SlavedClientIpStore,
+    LazyLoadedMembersStore,
     RoomStore,
     BaseSlavedStore,
 ):
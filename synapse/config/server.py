@@ -78,6 +78,25 @@ class ServerConfig(Config):
 
         self.filter_timeline_limit = config.get("filter_timeline_limit", -1)
 
+        # Users for whom we keep a precomputed initial sync response, and how
+        # often we recompute it.
+        self.initial_sync_cache_users = set(
+            config.get("initial_sync_cache_users", [])
+        )
+        self.initial_sync_cache_refresh_interval = self.parse_duration(
+            config.get("initial_sync_cache_refresh_interval", "5m")
+        )
+
+        # The maximum number of sync responses to compute at once (0 for no
+        # limit), and the fraction by which long-poll timeouts are randomly
+        # shortened.
+        self.sync_max_concurrent_computations = config.get(
+            "sync_max_concurrent_computations", 0,
+        )
+        self.sync_timeout_jitter = float(config.get("sync_timeout_jitter", 0.1))
+        if not 0 <= self.sync_timeout_jitter <= 1:
+            raise ConfigError("sync_timeout_jitter must be between 0 and 1")
+
         # Whether we should block invites sent to users on this server
         # (other than those sent by local server admins)
         self.block_non_admin_invites = config.get(
@@ -121,6 +140,18 @@ class ServerConfig(Config):
             for domain in federation_domain_whitelist:
                 self.federation_domain_whitelist[domain] = True
 
+        # Limits on the idle connections we keep open to other servers for
+        # federation. The timeout is in milliseconds.
+        self.federation_client_max_connections_per_host = config.get(
+            "federation_client_max_connections_per_host", 5,
+        )
+        self.federation_client_idle_connection_timeout = self.parse_duration(
+            config.get("federation_client_idle_connection_timeout", "2m")
+        )
+        self.federation_client_max_idle_connections = config.get(
+            "federation_client_max_idle_connections", None,
+        )
+
         if self.public_baseurl is not None:
             if self.public_baseurl[-1] != '/':
                 self.public_baseurl += '/'
@@ -318,6 +349,36 @@ class ServerConfig(Config):
         #
         #filter_timeline_limit: 5000
 
+        # A list of users for whom the server should keep a precomputed
+        # response to an initial /sync, per filter. This is useful
+        # for bots and bridges which log in often and are in many rooms, as
+        # their initial syncs are then served from memory. Clients get the
+        # state as of the last refresh, and catch up with their next
+        # incremental sync.
+        #
+        #initial_sync_cache_users:
+        #  - "@bridgebot:example.com"
+
+        # How often to bring the precomputed initial sync responses up to
+        # date. The default is 5m.
+        #
+        #initial_sync_cache_refresh_interval: 5m
+
+        # The maximum number of sync responses that the server will compute at
+        # once. Further requests are queued, with incremental syncs served
+        # before initial syncs, so that a burst of clients reconnecting (for
+        # example after a restart) slows syncs down rather than overloading the
+        # server. The default is 0, which means no limit.
+        #
+        #sync_max_concurrent_computations: 50
+
+        # Long-polling syncs are returned after a random fraction (up to this
+        # value) of the client's timeout has been knocked off, which spreads
+        # out clients that would otherwise all time out together. The default
+        # is 0.1; set it to 0 to always wait for the full timeout.
+        #
+        #sync_timeout_jitter: 0.1
+
         # Whether room invites to users on this server should be blocked
         # (except those sent by local server admins). The default is False.
         #
@@ -341,6 +402,17 @@ class ServerConfig(Config):
         #  - nyc.example.com
         #  - syd.example.com
 
+        # Outbound federation requests reuse idle connections to the
+        # destination where possible. These options control how many idle
+        # connections are kept open to each server (default 5), how long they
+        # are kept for (default 2m), and the maximum number kept open in total,
+        # after which the one which has been idle the longest is closed
+        # (default no limit).
+        #
+        #federation_client_max_connections_per_host: 5
+        #federation_client_idle_connection_timeout: 2m
+        #federation_client_max_idle_connections: 1000
+
         # List of ports that Synapse should listen on, their purpose and their
         # configuration.
         #
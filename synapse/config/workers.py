@@ -13,7 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from ._base import Config
+from ._base import Config, ConfigError
 
 
 class WorkerConfig(Config):
@@ -48,6 +48,34 @@ class WorkerConfig(Config):
         self.worker_main_http_uri = config.get("worker_main_http_uri", None)
         self.worker_cpu_affinity = config.get("worker_cpu_affinity")
 
+        # The worker_names of the federation_sender workers to shard outbound
+        # federation across, by destination. If empty, a single process sends
+        # to every destination.
+        self.federation_sender_instances = (
+            config.get("federation_sender_instances") or []
+        )
+        if self.federation_sender_instances and config.get("send_federation", True):
+            raise ConfigError(
+                "send_federation must be disabled when federation_sender_instances"
+                " is set, as federation is sent by those workers"
+            )
+        if (
+            self.federation_sender_instances
+            and self.worker_app == "synapse.app.federation_sender"
+            and self.worker_name not in self.federation_sender_instances
+        ):
+            raise ConfigError(
+                "worker_name %r is not listed in federation_sender_instances"
+                % (self.worker_name,)
+            )
+
+        # The name this process tracks its positions in the event and
+        # federation streams under when sending federation.
+        if self.federation_sender_instances:
+            self.federation_sender_instance_name = self.worker_name
+        else:
+            self.federation_sender_instance_name = "master"
+
         if self.worker_listeners:
             for listener in self.worker_listeners:
                 bind_address = listener.pop("bind_address", None)
@@ -14,7 +14,9 @@
 # limitations under the License.
 
 import logging
+import time
 
+from prometheus_client import Histogram
 from zope.interface import implementer
 
 from OpenSSL import SSL, crypto
@@ -26,6 +28,11 @@ from twisted.python.failure import Failure
 
 logger = logging.getLogger(__name__)
 
+tls_handshake_timer = Histogram(
+    "synapse_tls_client_handshake_seconds",
+    "Time taken for TLS handshakes with remote servers",
+)
+
 
 class ServerContextFactory(ContextFactory):
     """Factory for PyOpenSSL SSL contexts that are used to handle incoming
@@ -107,6 +114,9 @@ class ClientTLSOptions(object):
             self._hostnameBytes = _idnaBytes(hostname)
             self._sendSNI = True
 
+        # when the current handshake started, so that we can time it
+        self._handshake_start = None
+
         ctx.set_info_callback(_tolerateErrors(self._identityVerifyingInfoCallback))
 
     def clientConnectionForTLS(self, tlsProtocol):
@@ -118,8 +128,14 @@ class ClientTLSOptions(object):
     def _identityVerifyingInfoCallback(self, connection, where, ret):
         # Literal IPv4 and IPv6 addresses are not permitted
         # as host names according to the RFCs
-        if where & SSL.SSL_CB_HANDSHAKE_START and self._sendSNI:
-            connection.set_tlsext_host_name(self._hostnameBytes)
+        if where & SSL.SSL_CB_HANDSHAKE_START:
+            self._handshake_start = time.time()
+            if self._sendSNI:
+                connection.set_tlsext_host_name(self._hostnameBytes)
+
+        if where & SSL.SSL_CB_HANDSHAKE_DONE and self._handshake_start is not None:
+            tls_handshake_timer.observe(time.time() - self._handshake_start)
+            self._handshake_start = None
 
 
 class ClientTLSOptionsFactory(object):
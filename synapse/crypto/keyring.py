@@ -20,6 +20,8 @@ from collections import namedtuple
 from six import raise_from
 from six.moves import urllib
 
+import attr
+from prometheus_client import Counter, Histogram
 from signedjson.key import (
     decode_verify_key_bytes,
     encode_verify_key_base64,
@@ -42,7 +44,9 @@ from synapse.api.errors import (
     RequestSendFailed,
     SynapseError,
 )
-from synapse.util import logcontext, unwrapFirstError
+from synapse.metrics.background_process_metrics import run_as_background_process
+from synapse.util import batch_iter, logcontext, unwrapFirstError
+from synapse.util.async_helpers import ObservableDeferred
 from synapse.util.logcontext import (
     LoggingContext,
     PreserveLoggingContext,
@@ -54,6 +58,34 @@ from synapse.util.retryutils import NotRetryingDestination
 
 logger = logging.getLogger(__name__)
 
+# the maximum number of signatures we check in each call out to the thread pool
+SIGNATURE_CHECK_BATCH_SIZE = 100
+
+# how long we cache keys for if we don't know when they expire
+KEY_CACHE_UNKNOWN_VALIDITY_TTL_MS = 60 * 60 * 1000
+
+# the minimum time we cache keys for, even if they have already expired
+KEY_CACHE_MIN_TTL_MS = 5 * 60 * 1000
+
+# keys which haven't been used for this long are dropped from the cache, rather
+# than being refreshed
+KEY_CACHE_UNUSED_MS = 24 * 60 * 60 * 1000
+
+# how often we look for cached keys which are about to expire, and refresh
+# the ones which expire within KEY_REFRESH_WINDOW_MS
+KEY_REFRESH_INTERVAL_MS = 5 * 60 * 1000
+KEY_REFRESH_WINDOW_MS = 60 * 60 * 1000
+
+key_fetch_timer = Histogram(
+    "synapse_keyring_key_fetch_seconds",
+    "Time taken to look up server keys, by where we looked",
+    ["source"],
+)
+
+key_cache_hits_counter = Counter("synapse_keyring_key_cache_hits", "")
+
+key_cache_misses_counter = Counter("synapse_keyring_key_cache_misses", "")
+
 
 VerifyKeyRequest = namedtuple("VerifyRequest", (
     "server_name", "key_ids", "json_object", "deferred"
@@ -73,6 +105,39 @@ Attributes:
 """
 
 
+_SignatureCheck = namedtuple("_SignatureCheck", (
+    "server_name", "key_id", "verify_key", "json_object", "deferred",
+))
+"""
+A signature which is waiting to be checked in the thread pool.
+
+Attributes:
+    server_name(str): The name of the server to verify against.
+    key_id(str): The id of the key to verify with.
+    verify_key(nacl.signing.VerifyKey): The key to verify with.
+    json_object(dict): The JSON object to verify.
+    deferred(Deferred[None]): A deferred which resolves once the signature has
+        been checked, or fails with a SynapseError if it is invalid. The
+        deferreds' callbacks are run with no logcontext.
+"""
+
+
+@attr.s
+class _CachedKey(object):
+    verify_key = attr.ib()
+    """The key. Has a `valid_until_ts` attribute, which is None if we don't
+    know when it expires.
+    :type: nacl.signing.VerifyKey"""
+
+    expires_ts = attr.ib()
+    """When we should stop using the cached key.
+    :type: int"""
+
+    last_used_ts = attr.ib()
+    """When we last used the key.
+    :type: int"""
+
+
 class KeyLookupError(ValueError):
     pass
 
@@ -93,6 +158,27 @@ class Keyring(object):
         # These are regular, logcontext-agnostic Deferreds.
         self.key_downloads = {}
 
+        # Signatures whose keys we have, waiting to be checked. We check all of
+        # the signatures whose keys arrive in the same reactor tick together,
+        # in batches, in the thread pool.
+        self._pending_signature_checks = []
+
+        # map from (server_name, key_id) to _CachedKey. Keys which are in use
+        # are refreshed in the background before they expire.
+        self._key_cache = {}
+        self.clock.looping_call(
+            self._start_refresh_expiring_keys, KEY_REFRESH_INTERVAL_MS,
+        )
+
+        # Keys to look up from the perspective servers, as a map from
+        # server_name to a set of key_ids. We only have one request to the
+        # perspective servers in flight at a time, and any keys which are
+        # wanted in the meantime are looked up together once it completes,
+        # when the ObservableDeferred is resolved.
+        self._pending_perspectives_lookups = {}
+        self._next_perspectives_batch = None
+        self._perspectives_batch_in_flight = False
+
     def verify_json_for_server(self, server_name, json_object):
         return logcontext.make_deferred_yieldable(
             self.verify_json_objects_for_server(
@@ -140,13 +226,76 @@ class Keyring(object):
 
         run_in_background(self._start_key_lookups, verify_requests)
 
-        # Pass those keys to handle_key_deferred so that the json object
-        # signatures can be verified
-        handle = preserve_fn(_handle_key_deferred)
+        # Wait for the keys, and then verify the json object signatures with
+        # them
+        handle = preserve_fn(self._handle_verify_request)
         return [
             handle(rq) for rq in verify_requests
         ]
 
+    @defer.inlineCallbacks
+    def _handle_verify_request(self, verify_request):
+        """Waits for the key for a verify request to become available, and then
+        checks the signature with it.
+
+        Args:
+            verify_request (VerifyKeyRequest):
+
+        Returns:
+            Deferred[None]
+
+        Raises:
+            SynapseError if there was a problem performing the verification
+        """
+        key_id, verify_key = yield _handle_key_deferred(verify_request)
+
+        d = defer.Deferred()
+        self._pending_signature_checks.append(_SignatureCheck(
+            verify_request.server_name, key_id, verify_key,
+            verify_request.json_object, d,
+        ))
+        if len(self._pending_signature_checks) == 1:
+            self.hs.get_reactor().callLater(0, self._start_signature_checks)
+
+        yield logcontext.make_deferred_yieldable(d)
+
+    def _start_signature_checks(self):
+        """Checks the signatures which are waiting to be checked, in batches
+        """
+        checks = self._pending_signature_checks
+        self._pending_signature_checks = []
+
+        # group the checks by key, so that each batch uses as few keys as
+        # possible.
+        checks.sort(key=lambda c: (c.server_name, c.key_id))
+
+        with PreserveLoggingContext():
+            for batch in batch_iter(checks, SIGNATURE_CHECK_BATCH_SIZE):
+                run_in_background(self._run_signature_checks, batch)
+
+    @defer.inlineCallbacks
+    def _run_signature_checks(self, checks):
+        """Checks a batch of signatures in the thread pool, and resolves their
+        deferreds.
+
+        Args:
+            checks (list[_SignatureCheck])
+        """
+        try:
+            results = yield logcontext.defer_to_thread(
+                self.hs.get_reactor(), _check_signatures, checks,
+            )
+        except Exception as e:
+            logger.exception("Error checking signatures")
+            results = [e] * len(checks)
+
+        with PreserveLoggingContext():
+            for check, result in zip(checks, results):
+                if result is None:
+                    check.deferred.callback(None)
+                else:
+                    check.deferred.errback(result)
+
     @defer.inlineCallbacks
     def _start_key_lookups(self, verify_requests):
         """Sets off the key fetches for each verify request
@@ -266,9 +415,10 @@ class Keyring(object):
 
         # These are functions that produce keys given a list of key ids
         key_fetch_fns = (
-            self.get_keys_from_store,  # First try the local store
-            self.get_keys_from_perspectives,  # Then try via perspectives
-            self.get_keys_from_server,  # Then try directly
+            ("cache", self._get_keys_from_cache),  # First try our cache
+            ("store", self.get_keys_from_store),  # Then try the local store
+            ("perspectives", self.get_keys_from_perspectives),  # Then via perspectives
+            ("server", self.get_keys_from_server),  # Then try directly
         )
 
         @defer.inlineCallbacks
@@ -285,9 +435,17 @@ class Keyring(object):
                         verify_request.key_ids
                     )
 
-                for fn in key_fetch_fns:
+                for source, fn in key_fetch_fns:
+                    start = self.clock.time()
                     results = yield fn(missing_keys.items())
-                    merged_results.update(results)
+                    if source != "cache":
+                        key_fetch_timer.labels(source).observe(
+                            self.clock.time() - start,
+                        )
+                        self._cache_keys(results)
+
+                    for server_name, keys in results.items():
+                        merged_results.setdefault(server_name, {}).update(keys)
 
                     # We now need to figure out which verify requests we have keys
                     # for and which we don't
@@ -295,7 +453,7 @@ class Keyring(object):
                     requests_missing_keys = []
                     for verify_request in verify_requests:
                         server_name = verify_request.server_name
-                        result_keys = merged_results[server_name]
+                        result_keys = merged_results.get(server_name, {})
 
                         if verify_request.deferred.called:
                             # We've already called this deferred, which probably
@@ -340,7 +498,117 @@ class Keyring(object):
 
         run_in_background(do_iterations).addErrback(on_err)
 
+    def _get_keys_from_cache(self, server_name_and_key_ids):
+        """
+
+        Args:
+            server_name_and_key_ids (list[(str, iterable[str])]):
+                list of (server_name, iterable[key_id]) tuples to fetch keys for
+
+        Returns:
+            Deferred: resolves to dict[str, dict[str, VerifyKey]]: map from
+                server_name -> key_id -> VerifyKey
+        """
+        now = self.clock.time_msec()
+        results = {}
+        for server_name, key_ids in server_name_and_key_ids:
+            for key_id in key_ids:
+                cached = self._key_cache.get((server_name, key_id))
+                if cached is None or cached.expires_ts <= now:
+                    key_cache_misses_counter.inc()
+                    continue
+
+                key_cache_hits_counter.inc()
+                cached.last_used_ts = now
+                results.setdefault(server_name, {})[key_id] = cached.verify_key
+
+        return defer.succeed(results)
+
+    def _cache_keys(self, results):
+        """Adds keys which we have looked up to the cache
+
+        Args:
+            results (dict[str, dict[str, VerifyKey]]): map from server_name ->
+                key_id -> VerifyKey
+        """
+        now = self.clock.time_msec()
+        for server_name, keys in results.items():
+            for key_id, verify_key in keys.items():
+                valid_until_ts = getattr(verify_key, "valid_until_ts", None)
+                if valid_until_ts is None:
+                    expires_ts = now + KEY_CACHE_UNKNOWN_VALIDITY_TTL_MS
+                else:
+                    expires_ts = max(valid_until_ts, now + KEY_CACHE_MIN_TTL_MS)
+
+                self._key_cache[(server_name, key_id)] = _CachedKey(
+                    verify_key=verify_key,
+                    expires_ts=expires_ts,
+                    last_used_ts=now,
+                )
+
+    def _start_refresh_expiring_keys(self):
+        return run_as_background_process(
+            "refresh_expiring_server_keys", self._refresh_expiring_keys,
+        )
+
     @defer.inlineCallbacks
+    def _refresh_expiring_keys(self):
+        """Looks up new copies of the cached keys which are about to expire,
+        and drops keys which haven't been used for a while from the cache.
+        """
+        now = self.clock.time_msec()
+
+        to_refresh = {}
+        for (server_name, key_id), cached in list(self._key_cache.items()):
+            if now - cached.last_used_ts > KEY_CACHE_UNUSED_MS:
+                del self._key_cache[(server_name, key_id)]
+                continue
+
+            # keys which the server has told us have expired won't be coming
+            # back, so there is no point asking for them again.
+            if getattr(cached.verify_key, "expired", None) is not None:
+                continue
+
+            valid_until_ts = getattr(cached.verify_key, "valid_until_ts", None)
+            if valid_until_ts is None:
+                continue
+            if valid_until_ts - now < KEY_REFRESH_WINDOW_MS:
+                to_refresh.setdefault(server_name, set()).add(key_id)
+
+        if not to_refresh:
+            return
+
+        logger.info(
+            "Refreshing keys which are about to expire for %s", list(to_refresh),
+        )
+
+        results = yield self.get_keys_from_perspectives(to_refresh.items())
+        self._cache_keys(results)
+
+        missing = {}
+        for server_name, key_ids in to_refresh.items():
+            key_ids = key_ids - set(results.get(server_name, {}))
+            if key_ids:
+                missing[server_name] = key_ids
+
+        # we ask each server separately, so that one which fails doesn't stop
+        # us using the keys we got from the others.
+        @defer.inlineCallbacks
+        def refresh_from_server(server_name, key_ids):
+            try:
+                results = yield self.get_server_verify_key_v2_direct(
+                    server_name, key_ids,
+                )
+            except Exception as e:
+                logger.info("Failed to refresh keys from %s: %s", server_name, e)
+            else:
+                self._cache_keys(results)
+
+        yield logcontext.make_deferred_yieldable(defer.gatherResults([
+            run_in_background(refresh_from_server, server_name, key_ids)
+            for server_name, key_ids in missing.items()
+        ]))
+
     def get_keys_from_store(self, server_name_and_key_ids):
         """
 
@@ -352,21 +620,66 @@ class Keyring(object):
             Deferred: resolves to dict[str, dict[str, VerifyKey]]: map from
                 server_name -> key_id -> VerifyKey
         """
-        res = yield logcontext.make_deferred_yieldable(defer.gatherResults(
-            [
-                run_in_background(
-                    self.store.get_server_verify_keys,
-                    server_name, key_ids,
-                ).addCallback(lambda ks, server: (server, ks), server_name)
-                for server_name, key_ids in server_name_and_key_ids
-            ],
-            consumeErrors=True,
-        ).addErrback(unwrapFirstError))
+        return self.store.get_server_signature_keys(server_name_and_key_ids)
 
-        defer.returnValue(dict(res))
+    def get_keys_from_perspectives(self, server_name_and_key_ids):
+        """Looks up keys from the perspective servers.
+
+        Lookups which are requested while a request to the perspective servers
+        is in flight are sent together once it completes.
+
+        Args:
+            server_name_and_key_ids (list[(str, iterable[str])]):
+                list of (server_name, iterable[key_id]) tuples to fetch keys for
+
+        Returns:
+            Deferred: resolves to dict[str, dict[str, VerifyKey]]: map from
+                server_name -> key_id -> VerifyKey. May include keys which
+                weren't asked for.
+        """
+        if not self.perspective_servers:
+            return defer.succeed({})
+
+        for server_name, key_ids in server_name_and_key_ids:
+            self._pending_perspectives_lookups.setdefault(
+                server_name, set(),
+            ).update(key_ids)
+
+        batch = self._next_perspectives_batch
+        if batch is None:
+            batch = self._next_perspectives_batch = ObservableDeferred(
+                defer.Deferred(), consumeErrors=True,
+            )
+            if not self._perspectives_batch_in_flight:
+                self._send_perspectives_batch()
+
+        return logcontext.make_deferred_yieldable(batch.observe())
+
+    def _send_perspectives_batch(self):
+        """Sends the pending perspectives lookups, and resolves the waiting
+        ObservableDeferred once they complete. Any lookups which were queued up
+        in the meantime are then sent, with no logcontext.
+        """
+        lookups = self._pending_perspectives_lookups
+        batch = self._next_perspectives_batch
+        self._pending_perspectives_lookups = {}
+        self._next_perspectives_batch = None
+        self._perspectives_batch_in_flight = True
+
+        def on_done(result):
+            self._perspectives_batch_in_flight = False
+            with PreserveLoggingContext():
+                if self._next_perspectives_batch is not None:
+                    self._send_perspectives_batch()
+
+                batch.callback(result)
+
+        run_in_background(
+            self._get_keys_from_perspectives, list(lookups.items()),
+        ).addBoth(on_done)
 
     @defer.inlineCallbacks
-    def get_keys_from_perspectives(self, server_name_and_key_ids):
+    def _get_keys_from_perspectives(self, server_name_and_key_ids):
         @defer.inlineCallbacks
         def get_key(perspective_name, perspective_keys):
             try:
@@ -577,6 +890,7 @@ class Keyring(object):
                 key_bytes = decode_base64(key_base64)
                 verify_key = decode_verify_key_bytes(key_id, key_bytes)
                 verify_key.time_added = time_now_ms
+                verify_key.valid_until_ts = response_json["valid_until_ts"]
                 verify_keys[key_id] = verify_key
 
         old_verify_keys = {}
@@ -586,6 +900,7 @@ class Keyring(object):
                 key_bytes = decode_base64(key_base64)
                 verify_key = decode_verify_key_bytes(key_id, key_bytes)
                 verify_key.expired = key_data["expired_ts"]
+                verify_key.valid_until_ts = key_data["expired_ts"]
                 verify_key.time_added = time_now_ms
                 old_verify_keys[key_id] = verify_key
 
@@ -661,7 +976,8 @@ class Keyring(object):
             [
                 run_in_background(
                     self.store.store_server_verify_key,
-                    server_name, server_name, key.time_added, key
+                    server_name, server_name, key.time_added, key,
+                    ts_valid_until_ms=getattr(key, "valid_until_ts", None),
                 )
                 for key_id, key in verify_keys.items()
             ],
@@ -671,16 +987,17 @@ class Keyring(object):
 
 @defer.inlineCallbacks
 def _handle_key_deferred(verify_request):
-    """Waits for the key to become available, and then performs a verification
+    """Waits for the key to become available
 
     Args:
         verify_request (VerifyKeyRequest):
 
     Returns:
-        Deferred[None]
+        Deferred[(str, nacl.signing.VerifyKey)]: the key id and key to verify
+            the json object with.
 
     Raises:
-        SynapseError if there was a problem performing the verification
+        SynapseError if there was a problem fetching the key
     """
     server_name = verify_request.server_name
     try:
@@ -707,13 +1024,46 @@ def _handle_key_deferred(verify_request):
             Codes.UNAUTHORIZED,
         )
 
-    json_object = verify_request.json_object
+    defer.returnValue((key_id, verify_key))
+
+
+def _check_signatures(checks):
+    """Checks a batch of signatures. Called in the thread pool.
+
+    Args:
+        checks (list[_SignatureCheck])
+
+    Returns:
+        list[Exception|None]: for each check, None if the signature is
+            valid, or the error to raise if not.
+    """
+    results = []
+    for check in checks:
+        try:
+            _check_signature(check)
+            results.append(None)
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def _check_signature(check):
+    """Checks a signature with a key we have fetched.
+
+    Args:
+        check (_SignatureCheck)
+
+    Raises:
+        SynapseError if the signature is invalid
+    """
+    server_name = check.server_name
+    verify_key = check.verify_key
 
     logger.debug("Got key %s %s:%s for server %s, verifying" % (
-        key_id, verify_key.alg, verify_key.version, server_name,
+        check.key_id, verify_key.alg, verify_key.version, server_name,
     ))
     try:
-        verify_signed_json(json_object, server_name, verify_key)
+        verify_signed_json(check.json_object, server_name, verify_key)
     except SignatureVerifyException as e:
         logger.debug(
             "Error verifying signature for %s:%s:%s with key %s: %s",
@@ -34,13 +34,118 @@ from synapse.types import UserID, get_domain_from_id
 logger = logging.getLogger(__name__)
 
 
-def check(room_version, event, auth_events, do_sig_check=True, do_size_check=True):
+class BatchAuthChecker(object):
+    """Checks the auth of many events in a room.
+
+    Most of the work in an auth check is deriving power levels from the power
+    levels and create events in the auth state. The checker keeps a
+    _PowerLevels view for each pair of those events it has seen. The levels
+    it works out are reused by every later event which is authed against the
+    same pair, so as a run of events is checked against a changing state,
+    the view is only rebuilt when the power levels change.
+
+    Args:
+        room_version (str): the version of the room
+    """
+
+    def __init__(self, room_version):
+        self._room_version = room_version
+
+        # map from (power levels event id, create event id) to _PowerLevels
+        self._power_levels = {}
+
+    def check(self, event, auth_events, do_sig_check=True, do_size_check=True):
+        """Checks if an event is correctly authed. See `check`.
+
+        Args:
+            event: the event being checked.
+            auth_events (dict: event-key -> event): the existing room state.
+
+        Raises:
+            AuthError if the checks fail
+        """
+        power_levels = None
+        if auth_events is not None:
+            power_levels = self._get_power_levels(auth_events)
+
+        check(
+            self._room_version, event, auth_events,
+            do_sig_check=do_sig_check,
+            do_size_check=do_size_check,
+            power_levels=power_levels,
+        )
+
+    def _get_power_levels(self, auth_events):
+        power_levels_event = _get_power_level_event(auth_events)
+        create_event = auth_events.get((EventTypes.Create, ""))
+        key = (
+            power_levels_event.event_id if power_levels_event else None,
+            create_event.event_id if create_event else None,
+        )
+
+        power_levels = self._power_levels.get(key)
+        if power_levels is None:
+            power_levels = self._power_levels[key] = _PowerLevels(auth_events)
+        return power_levels
+
+
+class _PowerLevels(object):
+    """The power levels in force for some auth state.
+
+    Levels are worked out the same way as by get_user_power_level,
+    _get_named_level and get_send_level, and remembered once looked up.
+
+    Args:
+        auth_events (dict[(str, str), synapse.events.EventBase]): the auth
+            state. Only the power levels and create events are used.
+    """
+
+    def __init__(self, auth_events):
+        self._auth_events = {}
+        for key in ((EventTypes.PowerLevels, ""), (EventTypes.Create, "")):
+            if key in auth_events:
+                self._auth_events[key] = auth_events[key]
+
+        self._user_levels = {}
+        self._named_levels = {}
+        self._send_levels = {}
+
+    def get_user_level(self, user_id):
+        level = self._user_levels.get(user_id)
+        if level is None:
+            level = get_user_power_level(user_id, self._auth_events)
+            self._user_levels[user_id] = level
+        return level
+
+    def get_named_level(self, name, default):
+        key = (name, default)
+        level = self._named_levels.get(key)
+        if level is None:
+            level = _get_named_level(self._auth_events, name, default)
+            self._named_levels[key] = level
+        return level
+
+    def get_send_level(self, etype, state_key):
+        key = (etype, state_key is not None)
+        level = self._send_levels.get(key)
+        if level is None:
+            level = get_send_level(
+                etype, state_key, _get_power_level_event(self._auth_events),
+            )
+            self._send_levels[key] = level
+        return level
+
+
+def check(room_version, event, auth_events, do_sig_check=True, do_size_check=True,
+          power_levels=None):
     """ Checks if this event is correctly authed.
 
     Args:
         room_version (str): the version of the room
         event: the event being checked.
         auth_events (dict: event-key -> event): the existing room state.
+        power_levels (_PowerLevels|None): the power levels for auth_events, if
+            they have already been looked up (see BatchAuthChecker).
 
     Raises:
         AuthError if the checks fail
@@ -86,6 +191,9 @@ def check(room_version, event, auth_events, do_sig_check=True, do_size_check=Tru
         logger.warn("Trusting event: %s", event.event_id)
         return
 
+    if power_levels is None:
+        power_levels = _PowerLevels(auth_events)
+
     if event.type == EventTypes.Create:
         sender_domain = get_domain_from_id(event.sender)
         room_id_domain = get_domain_from_id(event.room_id)
@@ -151,7 +259,7 @@ def check(room_version, event, auth_events, do_sig_check=True, do_size_check=Tru
         )
 
     if event.type == EventTypes.Member:
-        _is_membership_change_allowed(event, auth_events)
+        _is_membership_change_allowed(event, auth_events, power_levels)
         logger.debug("Allowing! %s", event)
         return
 
@@ -161,8 +269,8 @@ def check(room_version, event, auth_events, do_sig_check=True, do_size_check=Tru
     # a user is allowed to issue invites.  Fixes
     # https://github.com/vector-im/vector-web/issues/1208 hopefully
     if event.type == EventTypes.ThirdPartyInvite:
-        user_level = get_user_power_level(event.user_id, auth_events)
-        invite_level = _get_named_level(auth_events, "invite", 0)
+        user_level = power_levels.get_user_level(event.user_id)
+        invite_level = power_levels.get_named_level("invite", 0)
 
         if user_level < invite_level:
             raise AuthError(
@@ -172,13 +280,13 @@ def check(room_version, event, auth_events, do_sig_check=True, do_size_check=Tru
             logger.debug("Allowing! %s", event)
             return
 
-    _can_send_event(event, auth_events)
+    _can_send_event(event, power_levels)
 
     if event.type == EventTypes.PowerLevels:
-        _check_power_levels(event, auth_events)
+        _check_power_levels(event, auth_events, power_levels)
 
     if event.type == EventTypes.Redaction:
-        check_redaction(room_version, event, auth_events)
+        check_redaction(room_version, event, auth_events, power_levels)
 
     logger.debug("Allowing! %s", event)
 
@@ -207,7 +315,7 @@ def _can_federate(event, auth_events):
     return creation_event.content.get("m.federate", True) is True
 
 
-def _is_membership_change_allowed(event, auth_events):
+def _is_membership_change_allowed(event, auth_events, power_levels):
     membership = event.content["membership"]
 
     # Check if this is the room creator joining:
@@ -253,27 +361,26 @@ def _is_membership_change_allowed(event, auth_events):
     else:
         join_rule = JoinRules.INVITE
 
-    user_level = get_user_power_level(event.user_id, auth_events)
-    target_level = get_user_power_level(
-        target_user_id, auth_events
-    )
+    user_level = power_levels.get_user_level(event.user_id)
+    target_level = power_levels.get_user_level(target_user_id)
 
     # FIXME (erikj): What should we do here as the default?
-    ban_level = _get_named_level(auth_events, "ban", 50)
-
-    logger.debug(
-        "_is_membership_change_allowed: %s",
-        {
-            "caller_in_room": caller_in_room,
-            "caller_invited": caller_invited,
-            "target_banned": target_banned,
-            "target_in_room": target_in_room,
-            "membership": membership,
-            "join_rule": join_rule,
-            "target_user_id": target_user_id,
-            "event.user_id": event.user_id,
-        }
-    )
+    ban_level = power_levels.get_named_level("ban", 50)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "_is_membership_change_allowed: %s",
+            {
+                "caller_in_room": caller_in_room,
+                "caller_invited": caller_invited,
+                "target_banned": target_banned,
+                "target_in_room": target_in_room,
+                "membership": membership,
+                "join_rule": join_rule,
+                "target_user_id": target_user_id,
+                "event.user_id": event.user_id,
+            }
+        )
 
     if Membership.INVITE == membership and "third_party_invite" in event.content:
         if not _verify_third_party_invite(event, auth_events):
@@ -309,7 +416,7 @@ def _is_membership_change_allowed(event, auth_events):
             raise AuthError(403, "%s is already in the room." %
                                  target_user_id)
         else:
-            invite_level = _get_named_level(auth_events, "invite", 0)
+            invite_level = power_levels.get_named_level("invite", 0)
 
             if user_level < invite_level:
                 raise AuthError(
@@ -339,7 +446,7 @@ def _is_membership_change_allowed(event, auth_events):
                 403, "You cannot unban user %s." % (target_user_id,)
             )
         elif target_user_id != event.user_id:
-            kick_level = _get_named_level(auth_events, "kick", 50)
+            kick_level = power_levels.get_named_level("kick", 50)
 
             if user_level < kick_level or user_level <= target_level:
                 raise AuthError(
@@ -405,13 +512,9 @@ def get_send_level(etype, state_key, power_levels_event):
     return int(send_level)
 
 
-def _can_send_event(event, auth_events):
-    power_levels_event = _get_power_level_event(auth_events)
-
-    send_level = get_send_level(
-        event.type, event.get("state_key"), power_levels_event,
-    )
-    user_level = get_user_power_level(event.user_id, auth_events)
+def _can_send_event(event, power_levels):
+    send_level = power_levels.get_send_level(event.type, event.get("state_key"))
+    user_level = power_levels.get_user_level(event.user_id)
 
     if user_level < send_level:
         raise AuthError(
@@ -432,9 +535,16 @@ def _can_send_event(event, auth_events):
     return True
 
 
-def check_redaction(room_version, event, auth_events):
+def check_redaction(room_version, event, auth_events, power_levels=None):
     """Check whether the event sender is allowed to redact the target event.
 
+    Args:
+        room_version (str)
+        event: the redaction event
+        auth_events (dict: event-key -> event): the existing room state.
+        power_levels (_PowerLevels|None): the power levels for auth_events, if
+            they have already been looked up.
+
     Returns:
         True if the the sender is allowed to redact the target event if the
         target event was created by them.
@@ -445,9 +555,12 @@ def check_redaction(room_version, event, auth_events):
         AuthError if the event sender is definitely not allowed to redact
         the target event.
     """
-    user_level = get_user_power_level(event.user_id, auth_events)
+    if power_levels is None:
+        power_levels = _PowerLevels(auth_events)
+
+    user_level = power_levels.get_user_level(event.user_id)
 
-    redact_level = _get_named_level(auth_events, "redact", 50)
+    redact_level = power_levels.get_named_level("redact", 50)
 
     if user_level >= redact_level:
         return False
@@ -469,7 +582,7 @@ def check_redaction(room_version, event, auth_events):
     )
 
 
-def _check_power_levels(event, auth_events):
+def _check_power_levels(event, auth_events, power_levels):
     user_list = event.content.get("users", {})
     # Validate users
     for k, v in user_list.items():
@@ -489,7 +602,7 @@ def _check_power_levels(event, auth_events):
     if not current_state:
         return
 
-    user_level = get_user_power_level(event.user_id, auth_events)
+    user_level = power_levels.get_user_level(event.user_id)
 
     # Check other levels:
     levels_to_check = [
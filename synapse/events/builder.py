@@ -24,6 +24,8 @@ from synapse.api.constants import (
     EventFormatVersions,
 )
 from synapse.crypto.event_signing import add_hashes_and_signatures
+from synapse.event_auth import auth_types_for_event
+from synapse.storage.state import StateFilter
 from synapse.types import EventID
 from synapse.util.stringutils import random_string
 
@@ -103,8 +105,11 @@ class EventBuilder(object):
             Deferred[FrozenEvent]
         """
 
+        # we only need the state used to auth the event, so avoid loading
+        # the full state of the room.
         state_ids = yield self._state.get_current_state_ids(
             self.room_id, prev_event_ids,
+            state_filter=StateFilter.from_types(auth_types_for_event(self)),
         )
         auth_ids = yield self._auth.compute_auth_events(
             self, state_ids,
@@ -110,6 +110,41 @@ class EventContext(object):
 
         return context
 
+    @staticmethod
+    def for_state_group(state_group, prev_group=None, delta_ids=None):
+        """Create a context for a non-state event whose state is the state in
+        the given state group.
+
+        The state map is only loaded from the database when it is asked for,
+        so this avoids copying the full state of the room around for ordinary
+        messages.
+
+        Args:
+            state_group (int): the state group for the state at the event
+            prev_group (int|None): previously persisted state group
+            delta_ids (dict[(str, str), str]|None): delta from `prev_group`
+
+        Returns:
+            EventContext
+        """
+        context = EventContext()
+
+        context._current_state_ids = None
+        context._prev_state_ids = None
+        context.state_group = state_group
+
+        # The event isn't a state event, so the state before and after the
+        # event are the same.
+        context._prev_state_id = None
+        context._event_type = None
+        context._event_state_key = None
+        context._fetching_state_deferred = None
+
+        context.prev_group = prev_group
+        context.delta_ids = delta_ids
+
+        return context
+
     @defer.inlineCallbacks
     def serialize(self, event, store):
         """Converts self to a type that can be serialized as JSON, and then
@@ -200,14 +235,26 @@ class EventContext(object):
         defer.returnValue(self._current_state_ids)
 
     @defer.inlineCallbacks
-    def get_prev_state_ids(self, store):
+    def get_prev_state_ids(self, store, state_filter=None):
         """Gets the prev state IDs
 
+        Args:
+            store (DataStore)
+            state_filter (StateFilter|None): if given, only return the state
+                matching the filter. If we haven't already loaded the full
+                state, only the matching state is fetched from the database.
+
         Returns:
             Deferred[dict[(str, str), str]|None]: Returns None if state_group
             is None, which happens when the associated event is an outlier.
         """
 
+        if state_filter is not None and not self._fetching_state_deferred:
+            prev_state_ids = yield self._get_filtered_prev_state_ids(
+                store, state_filter,
+            )
+            defer.returnValue(prev_state_ids)
+
         if not self._fetching_state_deferred:
             self._fetching_state_deferred = run_in_background(
                 self._fill_out_state, store,
@@ -215,7 +262,19 @@ class EventContext(object):
 
         yield make_deferred_yieldable(self._fetching_state_deferred)
 
-        defer.returnValue(self._prev_state_ids)
+        prev_state_ids = self._prev_state_ids
+        if state_filter is not None and prev_state_ids is not None:
+            if state_filter.has_wildcards():
+                prev_state_ids = state_filter.filter_state(prev_state_ids)
+            else:
+                # avoid iterating over the full state map
+                prev_state_ids = {
+                    key: prev_state_ids[key]
+                    for key in state_filter.concrete_types()
+                    if key in prev_state_ids
+                }
+
+        defer.returnValue(prev_state_ids)
 
     def get_cached_current_state_ids(self):
         """Gets the current state IDs if we have them already cached.
@@ -247,6 +306,25 @@ class EventContext(object):
         else:
             self._prev_state_ids = self._current_state_ids
 
+    @defer.inlineCallbacks
+    def _get_filtered_prev_state_ids(self, store, state_filter):
+        """Load the prev state IDs matching the filter from the database,
+        without populating _current_state_ids and _prev_state_ids.
+        """
+        if self.state_group is None:
+            defer.returnValue(None)
+
+        prev_state_ids = yield store.get_state_ids_for_group(
+            self.state_group, state_filter,
+        )
+        if self._prev_state_id and self._event_state_key is not None:
+            key = (self._event_type, self._event_state_key)
+            if key in prev_state_ids:
+                prev_state_ids = dict(prev_state_ids)
+                prev_state_ids[key] = self._prev_state_id
+
+        defer.returnValue(prev_state_ids)
+
     @defer.inlineCallbacks
     def update_state(self, state_group, prev_state_ids, current_state_ids,
                      prev_group, delta_ids):
@@ -27,10 +27,14 @@ from synapse.events import event_type_from_format_version
 from synapse.events.utils import prune_event
 from synapse.http.servlet import assert_params_in_dict
 from synapse.types import get_domain_from_id
-from synapse.util import logcontext, unwrapFirstError
+from synapse.util import batch_iter, logcontext, unwrapFirstError
 
 logger = logging.getLogger(__name__)
 
+# the maximum number of events whose content hashes we check in each call out
+# to the thread pool
+CONTENT_HASH_CHECK_BATCH_SIZE = 100
+
 
 class FederationBase(object):
     def __init__(self, hs):
@@ -44,7 +48,8 @@ class FederationBase(object):
 
     @defer.inlineCallbacks
     def _check_sigs_and_hash_and_fetch(self, origin, pdus, room_version,
-                                       outlier=False, include_none=False):
+                                       outlier=False, include_none=False,
+                                       deferreds=None):
         """Takes a list of PDUs and checks the signatures and hashs of each
         one. If a PDU fails its signature check then we check if we have it in
         the database and if not then request if from the originating server of
@@ -62,11 +67,15 @@ class FederationBase(object):
             outlier (bool): Whether the events are outliers or not
             include_none (str): Whether to include None in the returned list
                 for events that have failed their checks
+            deferreds (list[Deferred]|None): the results of checks of the PDUs
+                which have already been started, as returned by
+                `_check_sigs_and_hashes`. If None, the checks are started here.
 
         Returns:
             Deferred : A list of PDUs that have valid signatures and hashes.
         """
-        deferreds = self._check_sigs_and_hashes(room_version, pdus)
+        if deferreds is None:
+            deferreds = self._check_sigs_and_hashes(room_version, pdus)
 
         @defer.inlineCallbacks
         def handle_check_result(pdu, deferred):
@@ -144,11 +153,22 @@ class FederationBase(object):
         """
         deferreds = _check_sigs_on_pdus(self.keyring, room_version, pdus)
 
+        # we check the content hashes in the thread pool while the signatures
+        # are being checked.
+        hash_deferreds = [defer.Deferred() for _ in pdus]
+        for batch in batch_iter(zip(pdus, hash_deferreds), CONTENT_HASH_CHECK_BATCH_SIZE):
+            logcontext.run_in_background(
+                _check_content_hashes, self.hs.get_reactor(), batch,
+            )
+
         ctx = logcontext.LoggingContext.current_context()
 
-        def callback(_, pdu):
+        def callback(content_hash_result, pdu):
             with logcontext.PreserveLoggingContext(ctx):
-                if not check_event_content_hash(pdu):
+                if isinstance(content_hash_result, Exception):
+                    raise content_hash_result
+
+                if not content_hash_result:
                     # let's try to distinguish between failures because the event was
                     # redacted (which are somewhat expected) vs actual ball-tampering
                     # incidents.
@@ -193,7 +213,8 @@ class FederationBase(object):
                 )
             return failure
 
-        for deferred, pdu in zip(deferreds, pdus):
+        for deferred, hash_deferred, pdu in zip(deferreds, hash_deferreds, pdus):
+            deferred.addCallback(lambda _, d: d, hash_deferred)
             deferred.addCallbacks(
                 callback, errback,
                 callbackArgs=[pdu],
@@ -203,6 +224,48 @@ class FederationBase(object):
         return deferreds
 
 
+@defer.inlineCallbacks
+def _check_content_hashes(reactor, batch):
+    """Checks the content hashes of a batch of events in the thread pool.
+
+    Args:
+        reactor (twisted.internet.base.ReactorBase)
+        batch (list[tuple[EventBase, Deferred]]): the events to be checked,
+            with a deferred for each which will be resolved with the result of
+            `check_event_content_hash` for the event, or the exception it
+            raised. The deferreds run their callbacks in the sentinel
+            logcontext.
+    """
+    pdus = [pdu for pdu, _ in batch]
+    try:
+        results = yield logcontext.defer_to_thread(
+            reactor, _check_content_hashes_in_thread, pdus,
+        )
+    except Exception as e:
+        logger.exception("Error checking content hashes")
+        results = [e] * len(pdus)
+
+    with logcontext.PreserveLoggingContext():
+        for (_, d), result in zip(batch, results):
+            d.callback(result)
+
+
+def _check_content_hashes_in_thread(pdus):
+    """Checks the content hashes of some events. Called in the thread pool.
+
+    Returns:
+        list[bool|Exception]: for each event, whether its content hash
+            matches, or the exception raised when checking it.
+    """
+    results = []
+    for pdu in pdus:
+        try:
+            results.append(check_event_content_hash(pdu))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
 class PduToCheckSig(namedtuple("PduToCheckSig", [
     "pdu", "redacted_pdu_json", "sender_domain", "deferreds",
 ])):
@@ -39,10 +39,21 @@ from synapse.api.errors import (
     SynapseError,
 )
 from synapse.events import builder, room_version_to_event_format
-from synapse.federation.federation_base import FederationBase, event_from_pdu_json
+from synapse.federation.federation_base import (
+    CONTENT_HASH_CHECK_BATCH_SIZE,
+    FederationBase,
+    event_from_pdu_json,
+)
+from synapse.http.json_parser import JsonStreamParser
 from synapse.util import logcontext, unwrapFirstError
+from synapse.util.async_helpers import ObservableDeferred
 from synapse.util.caches.expiringcache import ExpiringCache
-from synapse.util.logcontext import make_deferred_yieldable, run_in_background
+from synapse.util.logcontext import (
+    LoggingContext,
+    PreserveLoggingContext,
+    make_deferred_yieldable,
+    run_in_background,
+)
 from synapse.util.logutils import log_function
 from synapse.util.retryutils import NotRetryingDestination
 
@@ -191,22 +202,22 @@ class FederationClient(FederationBase):
         if not extremities:
             return
 
+        room_version = yield self.store.get_room_version(room_id)
+        format_ver = room_version_to_event_format(room_version)
+
+        checker = _PduChecker(self, room_version)
         transaction_data = yield self.transport_layer.backfill(
-            dest, room_id, extremities, limit)
+            dest, room_id, extremities, limit,
+            parser=_events_parser(format_ver, ["pdus"], checker=checker),
+        )
 
         logger.debug("backfill transaction_data=%s", repr(transaction_data))
 
-        room_version = yield self.store.get_room_version(room_id)
-        format_ver = room_version_to_event_format(room_version)
-
-        pdus = [
-            event_from_pdu_json(p, format_ver, outlier=False)
-            for p in transaction_data["pdus"]
-        ]
+        pdus = list(transaction_data["pdus"])
 
         # FIXME: We should handle signature failures more gracefully.
         pdus[:] = yield logcontext.make_deferred_yieldable(defer.gatherResults(
-            self._check_sigs_and_hashes(room_version, pdus),
+            checker.get_results(pdus),
             consumeErrors=True,
         ).addErrback(unwrapFirstError))
 
@@ -351,42 +362,43 @@ class FederationClient(FederationBase):
             else:
                 raise e
 
-        result = yield self.transport_layer.get_room_state(
-            destination, room_id, event_id=event_id,
-        )
-
         room_version = yield self.store.get_room_version(room_id)
         format_ver = room_version_to_event_format(room_version)
 
-        pdus = [
-            event_from_pdu_json(p, format_ver, outlier=True)
-            for p in result["pdus"]
-        ]
+        checker = _PduChecker(self, room_version)
+        result = yield self.transport_layer.get_room_state(
+            destination, room_id, event_id=event_id,
+            parser=_events_parser(
+                format_ver, ["pdus", "auth_chain"], outlier=True, checker=checker,
+            ),
+        )
 
-        auth_chain = [
-            event_from_pdu_json(p, format_ver, outlier=True)
-            for p in result.get("auth_chain", [])
-        ]
+        pdus = list(result["pdus"])
+        auth_chain = list(result.get("auth_chain", []))
 
         seen_events = yield self.store.get_events([
             ev.event_id for ev in itertools.chain(pdus, auth_chain)
         ])
 
+        unseen_pdus = [p for p in pdus if p.event_id not in seen_events]
         signed_pdus = yield self._check_sigs_and_hash_and_fetch(
             destination,
-            [p for p in pdus if p.event_id not in seen_events],
+            unseen_pdus,
             outlier=True,
             room_version=room_version,
+            deferreds=checker.get_results(unseen_pdus),
         )
         signed_pdus.extend(
             seen_events[p.event_id] for p in pdus if p.event_id in seen_events
         )
 
+        unseen_auth = [p for p in auth_chain if p.event_id not in seen_events]
         signed_auth = yield self._check_sigs_and_hash_and_fetch(
             destination,
-            [p for p in auth_chain if p.event_id not in seen_events],
+            unseen_auth,
             outlier=True,
             room_version=room_version,
+            deferreds=checker.get_results(unseen_auth),
         )
         signed_auth.extend(
             seen_events[p.event_id] for p in auth_chain if p.event_id in seen_events
@@ -673,19 +685,17 @@ class FederationClient(FederationBase):
                 room_id=pdu.room_id,
                 event_id=pdu.event_id,
                 content=pdu.get_pdu_json(time_now),
+                # the response is a [code, body] pair
+                parser=_events_parser(
+                    event_format_version, ["item.state", "item.auth_chain"],
+                    outlier=True,
+                ),
             )
 
             logger.debug("Got content: %s", content)
 
-            state = [
-                event_from_pdu_json(p, event_format_version, outlier=True)
-                for p in content.get("state", [])
-            ]
-
-            auth_chain = [
-                event_from_pdu_json(p, event_format_version, outlier=True)
-                for p in content.get("auth_chain", [])
-            ]
+            state = list(content.get("state", []))
+            auth_chain = list(content.get("auth_chain", []))
 
             pdus = {
                 p.event_id: p
@@ -938,6 +948,10 @@ class FederationClient(FederationBase):
             timeout (int): Max time to wait in ms
         """
         try:
+            room_version = yield self.store.get_room_version(room_id)
+            format_ver = room_version_to_event_format(room_version)
+
+            checker = _PduChecker(self, room_version)
             content = yield self.transport_layer.get_missing_events(
                 destination=destination,
                 room_id=room_id,
@@ -946,18 +960,14 @@ class FederationClient(FederationBase):
                 limit=limit,
                 min_depth=min_depth,
                 timeout=timeout,
+                parser=_events_parser(format_ver, ["events"], checker=checker),
             )
 
-            room_version = yield self.store.get_room_version(room_id)
-            format_ver = room_version_to_event_format(room_version)
-
-            events = [
-                event_from_pdu_json(e, format_ver)
-                for e in content.get("events", [])
-            ]
+            events = list(content.get("events", []))
 
             signed_events = yield self._check_sigs_and_hash_and_fetch(
                 destination, events, outlier=False, room_version=room_version,
+                deferreds=checker.get_results(events),
             )
         except HttpResponseException as e:
             if not e.code == 400:
@@ -991,3 +1001,93 @@ class FederationClient(FederationBase):
                 )
 
         raise RuntimeError("Failed to send to any server.")
+
+
+def _events_parser(event_format_version, paths, outlier=False, checker=None):
+    """Builds a parser for a federation response which turns the PDUs in the
+    given lists into events as they arrive.
+
+    Args:
+        event_format_version (int): The event format version
+        paths (list[str]): the paths of the lists of PDUs in the response.
+        outlier (bool): True to mark the events as outliers
+        checker (_PduChecker|None): if given, each event is passed to it so
+            that its signatures and hashes can be checked while the rest of
+            the response arrives.
+
+    Returns:
+        JsonStreamParser
+    """
+    def transform(pdu_json):
+        event = event_from_pdu_json(pdu_json, event_format_version, outlier=outlier)
+        if checker is not None:
+            checker.add(event)
+        return event
+
+    return JsonStreamParser({path: transform for path in paths})
+
+
+class _PduChecker(object):
+    """Checks the signatures and hashes of the PDUs in a response as they are
+    parsed, in batches, rather than waiting for the whole response.
+
+    Args:
+        federation_base (FederationBase)
+        room_version (str): The room version of the PDUs
+    """
+
+    def __init__(self, federation_base, room_version):
+        self._federation_base = federation_base
+        self._room_version = room_version
+
+        # the checks are started from the parser, which may be running in the
+        # sentinel context.
+        self._context = LoggingContext.current_context()
+
+        self._pending = []
+
+        # map from id(pdu) to an ObservableDeferred for the result of its
+        # checks. We use the id rather than the event ID as the same event can
+        # appear more than once in a response (eg, in both the state and the
+        # auth chain).
+        self._results = {}
+
+    def add(self, pdu):
+        """Queues up the checks for a PDU, starting them if there are enough
+        queued up.
+
+        Args:
+            pdu (FrozenEvent)
+        """
+        self._pending.append(pdu)
+        if len(self._pending) >= CONTENT_HASH_CHECK_BATCH_SIZE:
+            self._start_checks()
+
+    def get_results(self, pdus):
+        """Gets the results of the checks of some PDUs which have been added.
+
+        Args:
+            pdus (list[FrozenEvent])
+
+        Returns:
+            list[Deferred]: as returned by `_check_sigs_and_hashes`.
+        """
+        self._start_checks()
+        return [
+            defer.maybeDeferred(self._results[id(pdu)].observe) for pdu in pdus
+        ]
+
+    def _start_checks(self):
+        pdus, self._pending = self._pending, []
+        if not pdus:
+            return
+
+        with PreserveLoggingContext(self._context):
+            deferreds = self._federation_base._check_sigs_and_hashes(
+                self._room_version, pdus,
+            )
+
+        for pdu, d in zip(pdus, deferreds):
+            # we might not end up waiting for every result (eg, if we already
+            # have the event), so don't let failures go unhandled.
+            self._results[id(pdu)] = ObservableDeferred(d, consumeErrors=True)
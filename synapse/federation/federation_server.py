@@ -14,6 +14,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import logging
+from collections import deque
 
 import six
 from six import iteritems
@@ -40,6 +41,8 @@ from synapse.federation.federation_base import FederationBase, event_from_pdu_js
 from synapse.federation.persistence import TransactionActions
 from synapse.federation.units import Edu, Transaction
 from synapse.http.endpoint import parse_server_name
+from synapse.metrics import LaterGauge
+from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.replication.http.federation import (
     ReplicationFederationSendEduRestServlet,
     ReplicationGetQueryRestServlet,
@@ -48,13 +51,30 @@ from synapse.types import get_domain_from_id
 from synapse.util import glob_to_regex
 from synapse.util.async_helpers import Linearizer, concurrently_execute
 from synapse.util.caches.response_cache import ResponseCache
-from synapse.util.logcontext import nested_logging_context
+from synapse.util.logcontext import (
+    PreserveLoggingContext,
+    make_deferred_yieldable,
+    nested_logging_context,
+)
 from synapse.util.logutils import log_function
 
 # when processing incoming transactions, we try to handle multiple rooms in
 # parallel, up to this limit.
 TRANSACTION_CONCURRENCY_LIMIT = 10
 
+# the maximum number of rooms whose received PDUs we check the signatures of at
+# once, across all incoming transactions.
+VERIFICATION_CONCURRENCY_LIMIT = 10
+
+# the maximum number of rooms whose received PDUs we process (ie, fetch missing
+# events for and persist) at once.
+ROOM_CONCURRENCY_LIMIT = 20
+
+# if more than this many received PDUs are waiting to be processed, we wait for
+# the PDUs in a transaction to be processed before responding to it, so that
+# the sending servers slow down.
+MAX_QUEUED_PDUS = 1000
+
 logger = logging.getLogger(__name__)
 
 received_pdus_counter = Counter("synapse_federation_server_received_pdus", "")
@@ -77,6 +97,47 @@ class FederationServer(FederationBase):
         self._server_linearizer = Linearizer("fed_server")
         self._transaction_linearizer = Linearizer("fed_txn_handler")
 
+        # Received PDUs go through two stages: first their signatures and
+        # hashes are checked, then they are queued up to be processed by their
+        # room. Each stage is limited to working on a few rooms at once.
+        self._verification_limiter = Linearizer(
+            "fed_verify_pdus", max_count=VERIFICATION_CONCURRENCY_LIMIT,
+        )
+        self._room_processing_limiter = Linearizer(
+            "fed_process_pdus", max_count=ROOM_CONCURRENCY_LIMIT,
+        )
+
+        # map from room_id to a deque of (origin, pdu, deferred) waiting to be
+        # processed. A room is in here iff its queue is being processed.
+        #
+        # Queued PDUs are also recorded in the federation_inbound_events_staging
+        # table until they have been processed, so that they aren't lost if we
+        # restart.
+        self._room_pdu_queues = {}
+        self._queued_pdu_count = 0
+
+        # the name we record against the PDUs we stage. Other workers may be
+        # processing PDUs of their own, so we only pick up our own PDUs when
+        # we restart.
+        self._instance_name = hs.config.worker_name or "master"
+
+        # whether we have started processing the PDUs that were left in the
+        # staging table when we last stopped.
+        self._started_handling_of_staged_events = False
+
+        LaterGauge(
+            "synapse_federation_server_queued_pdus",
+            "",
+            [],
+            lambda: self._queued_pdu_count,
+        )
+        LaterGauge(
+            "synapse_federation_server_queued_pdu_rooms",
+            "",
+            [],
+            lambda: len(self._room_pdu_queues),
+        )
+
         self.transaction_actions = TransactionActions(self.store)
 
         self.registry = hs.get_federation_registry()
@@ -149,6 +210,13 @@ class FederationServer(FederationBase):
 
         logger.debug("[%s] Transaction is new", transaction.transaction_id)
 
+        if not self._started_handling_of_staged_events:
+            self._started_handling_of_staged_events = True
+            run_as_background_process(
+                "handle_old_staged_events", self._handle_old_staged_events,
+                request_time,
+            )
+
         # Reject if PDU count > 50 and EDU count > 100
         if (len(transaction.pdus) > 50
                 or (hasattr(transaction, "edus") and len(transaction.edus) > 100)):
@@ -207,13 +275,18 @@ class FederationServer(FederationBase):
 
         pdu_results = {}
 
-        # we can process different rooms in parallel (which is useful if they
-        # require callouts to other servers to fetch missing events), but
-        # impose a limit to avoid going too crazy with ram/cpu.
+        # map from event_id to a deferred which resolves to the result of
+        # processing the PDU.
+        queued_pdus = {}
+
+        # we can verify different rooms in parallel, and then hand their PDUs
+        # over to be processed by each room in the background, so that a room
+        # which needs to fetch missing events from a slow server doesn't hold
+        # up the rest of the transaction.
 
         @defer.inlineCallbacks
-        def process_pdus_for_room(room_id):
-            logger.debug("Processing PDUs for %s", room_id)
+        def verify_pdus_for_room(room_id):
+            logger.debug("Verifying PDUs for %s", room_id)
             try:
                 yield self.check_server_matches_acl(origin_host, room_id)
             except AuthError as e:
@@ -225,31 +298,58 @@ class FederationServer(FederationBase):
                     pdu_results[event_id] = e.error_dict()
                 return
 
+            pdus = []
             for pdu in pdus_by_room[room_id]:
-                event_id = pdu.event_id
-                with nested_logging_context(event_id):
+                if self._check_pdu_origin(origin, pdu):
+                    pdus.append(pdu)
+                else:
+                    pdu_results[pdu.event_id] = {}
+
+            # We've already checked that we know the room version by this point
+            room_version = yield self.store.get_room_version(room_id)
+
+            with (yield self._verification_limiter.queue(None)):
+                deferreds = self._check_sigs_and_hashes(room_version, pdus)
+                for pdu, d in zip(pdus, deferreds):
+                    event_id = pdu.event_id
                     try:
-                        yield self._handle_received_pdu(
-                            origin, pdu
-                        )
-                        pdu_results[event_id] = {}
-                    except FederationError as e:
-                        logger.warn("Error handling PDU %s: %s", event_id, e)
-                        pdu_results[event_id] = {"error": str(e)}
-                    except Exception as e:
-                        f = failure.Failure()
-                        pdu_results[event_id] = {"error": str(e)}
-                        logger.error(
-                            "Failed to handle PDU %s",
-                            event_id,
-                            exc_info=(f.type, f.value, f.getTracebackObject()),
+                        pdu = yield make_deferred_yieldable(d)
+                    except SynapseError as e:
+                        err = FederationError(
+                            "ERROR",
+                            e.code,
+                            e.msg,
+                            affected=event_id,
                         )
+                        logger.warn("Error handling PDU %s: %s", event_id, err)
+                        pdu_results[event_id] = {"error": str(err)}
+                        continue
+
+                    yield self.store.insert_received_event_to_staging(
+                        self._instance_name, origin, pdu,
+                    )
+                    queued_pdus[event_id] = self._queue_pdu_for_processing(
+                        origin, pdu,
+                    )
 
         yield concurrently_execute(
-            process_pdus_for_room, pdus_by_room.keys(),
+            verify_pdus_for_room, pdus_by_room.keys(),
             TRANSACTION_CONCURRENCY_LIMIT,
         )
 
+        if self._queued_pdu_count > MAX_QUEUED_PDUS:
+            logger.info(
+                "[%s] %d received PDUs are queued: waiting for ours to be processed",
+                transaction.transaction_id, self._queued_pdu_count,
+            )
+            results = yield make_deferred_yieldable(defer.gatherResults(
+                list(queued_pdus.values()), consumeErrors=True,
+            ))
+            pdu_results.update(zip(queued_pdus.keys(), results))
+        else:
+            for event_id in queued_pdus:
+                pdu_results[event_id] = {}
+
         if hasattr(transaction, "edus"):
             for edu in (Edu(**x) for x in transaction.edus):
                 yield self.received_edu(
@@ -612,14 +712,147 @@ class FederationServer(FederationBase):
             destination=None,
         )
 
+    def _check_pdu_origin(self, origin, pdu):
+        """Checks that a PDU received in a federation /send/ transaction is
+        actually being sent from a valid destination, to workaround bug #1753
+        in 0.18.5 and 0.18.6
+
+        Args:
+            origin (str): server which sent the pdu
+            pdu (FrozenEvent): received pdu
+
+        Returns:
+            bool: whether the PDU should be accepted.
+        """
+        if origin == get_domain_from_id(pdu.sender):
+            return True
+
+        # We continue to accept join events from any server; this is
+        # necessary for the federation join dance to work correctly.
+        # (When we join over federation, the "helper" server is
+        # responsible for sending out the join event, rather than the
+        # origin. See bug #1893. This is also true for some third party
+        # invites).
+        if not (
+            pdu.type == 'm.room.member' and
+            pdu.content and
+            pdu.content.get("membership", None) in (
+                Membership.JOIN, Membership.INVITE,
+            )
+        ):
+            logger.info(
+                "Discarding PDU %s from invalid origin %s",
+                pdu.event_id, origin
+            )
+            return False
+
+        logger.info(
+            "Accepting join PDU %s from %s",
+            pdu.event_id, origin
+        )
+        return True
+
+    def _queue_pdu_for_processing(self, origin, pdu):
+        """Queues up a PDU whose signatures and hashes have been checked, to be
+        processed after any other PDUs we have received in its room.
+
+        Args:
+            origin (str): server which sent the pdu
+            pdu (FrozenEvent): received pdu
+
+        Returns:
+            Deferred[dict]: resolves to the result for the PDU in the
+            transaction response, once it has been processed. Follows the
+            synapse rules about logcontexts.
+        """
+        room_id = pdu.room_id
+        d = defer.Deferred()
+
+        room_queue = self._room_pdu_queues.get(room_id)
+        start_processing = room_queue is None
+        if start_processing:
+            room_queue = self._room_pdu_queues[room_id] = deque()
+
+        room_queue.append((origin, pdu, d))
+        self._queued_pdu_count += 1
+
+        if start_processing:
+            run_as_background_process(
+                "process_received_pdus", self._process_room_pdu_queue, room_id,
+            )
+
+        return d
+
     @defer.inlineCallbacks
-    def _handle_received_pdu(self, origin, pdu):
-        """ Process a PDU received in a federation /send/ transaction.
+    def _process_room_pdu_queue(self, room_id):
+        """Processes the queued PDUs for a room, in the order they were
+        received, until there are none left.
+        """
+        room_queue = self._room_pdu_queues[room_id]
+        try:
+            while room_queue:
+                # We give up our slot after each PDU, so that rooms which are
+                # kept busy take turns with the others rather than hogging it.
+                with (yield self._room_processing_limiter.queue(None)):
+                    origin, pdu, d = room_queue.popleft()
+                    with nested_logging_context(pdu.event_id):
+                        result = yield self._process_received_pdu(origin, pdu)
+                    self._queued_pdu_count -= 1
+
+                with PreserveLoggingContext():
+                    d.callback(result)
+
+                yield self.store.remove_received_event_from_staging(
+                    origin, pdu.event_id,
+                )
+        finally:
+            del self._room_pdu_queues[room_id]
 
-        If the event is invalid, then this method throws a FederationError.
-        (The error will then be logged and sent back to the sender (which
-        probably won't do anything with it), and other events in the
-        transaction will be processed as normal).
+            # We shouldn't have anything left over, but make sure that nothing
+            # is left waiting forever if we do.
+            for _, _, d in room_queue:
+                self._queued_pdu_count -= 1
+                with PreserveLoggingContext():
+                    d.callback({"error": "Failed to process PDU"})
+
+    @defer.inlineCallbacks
+    def _handle_old_staged_events(self, received_before_ts):
+        """Queues up the PDUs which were left in the staging table when we last
+        stopped, so that they get processed.
+
+        Args:
+            received_before_ts (int): only PDUs received before this time are
+                queued, so that we don't pick up ones which have been staged
+                since we started.
+        """
+        staged = yield self.store.get_received_events_in_staging(
+            self._instance_name, received_before_ts,
+        )
+        if staged:
+            logger.info("Processing %d previously received PDUs", len(staged))
+
+        for origin, room_id, pdu_json in staged:
+            try:
+                room_version = yield self.store.get_room_version(room_id)
+            except NotFoundError:
+                logger.info("Dropping staged PDU for unknown room_id: %s", room_id)
+                yield self.store.remove_received_event_from_staging(
+                    origin, pdu_json.get("event_id"),
+                )
+                continue
+
+            format_ver = room_version_to_event_format(room_version)
+            pdu = event_from_pdu_json(pdu_json, format_ver)
+            self._queue_pdu_for_processing(origin, pdu)
+
+    @defer.inlineCallbacks
+    def _process_received_pdu(self, origin, pdu):
+        """ Process a PDU received in a federation /send/ transaction, once its
+        signatures and hashes have been checked.
+
+        If the event is invalid, then the error will be logged and returned to
+        the sender (which probably won't do anything with it), and other events
+        in the transaction will be processed as normal.
 
         It is likely that we'll then receive other events which refer to
         this rejected_event in their prev_events, etc.  When that happens,
@@ -637,56 +870,28 @@ class FederationServer(FederationBase):
             origin (str): server which sent the pdu
             pdu (FrozenEvent): received pdu
 
-        Returns (Deferred): completes with None
-
-        Raises: FederationError if the signatures / hash do not match, or
-            if the event was unacceptable for any other reason (eg, too large,
-            too many prev_events, couldn't find the prev_events)
+        Returns:
+            Deferred[dict]: the result for the PDU in the transaction response.
         """
-        # check that it's actually being sent from a valid destination to
-        # workaround bug #1753 in 0.18.5 and 0.18.6
-        if origin != get_domain_from_id(pdu.sender):
-            # We continue to accept join events from any server; this is
-            # necessary for the federation join dance to work correctly.
-            # (When we join over federation, the "helper" server is
-            # responsible for sending out the join event, rather than the
-            # origin. See bug #1893. This is also true for some third party
-            # invites).
-            if not (
-                pdu.type == 'm.room.member' and
-                pdu.content and
-                pdu.content.get("membership", None) in (
-                    Membership.JOIN, Membership.INVITE,
-                )
-            ):
-                logger.info(
-                    "Discarding PDU %s from invalid origin %s",
-                    pdu.event_id, origin
-                )
-                return
-            else:
-                logger.info(
-                    "Accepting join PDU %s from %s",
-                    pdu.event_id, origin
-                )
-
-        # We've already checked that we know the room version by this point
-        room_version = yield self.store.get_room_version(pdu.room_id)
-
-        # Check signature.
+        event_id = pdu.event_id
         try:
-            pdu = yield self._check_sigs_and_hash(room_version, pdu)
-        except SynapseError as e:
-            raise FederationError(
-                "ERROR",
-                e.code,
-                e.msg,
-                affected=pdu.event_id,
+            yield self.handler.on_receive_pdu(
+                origin, pdu, sent_to_us_directly=True,
+            )
+            result = {}
+        except FederationError as e:
+            logger.warn("Error handling PDU %s: %s", event_id, e)
+            result = {"error": str(e)}
+        except Exception as e:
+            f = failure.Failure()
+            result = {"error": str(e)}
+            logger.error(
+                "Failed to handle PDU %s",
+                event_id,
+                exc_info=(f.type, f.value, f.getTracebackObject()),
             )
 
-        yield self.handler.on_receive_pdu(
-            origin, pdu, sent_to_us_directly=True,
-        )
+        defer.returnValue(result)
 
     def __str__(self):
         return "<ReplicationLayer(%s)>" % self.server_name
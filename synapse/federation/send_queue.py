@@ -44,6 +44,10 @@ from .units import Edu
 
 logger = logging.getLogger(__name__)
 
+# How often to warn that some federation sender instances have not acked the
+# federation stream.
+MISSING_ACK_WARNING_INTERVAL = 60 * 1000
+
 
 class FederationRemoteSendQueue(object):
     """A drop in replacement for TransactionQueue"""
@@ -67,6 +71,12 @@ class FederationRemoteSendQueue(object):
         self.pos = 1
         self.pos_time = SortedDict()
 
+        # If outbound federation is sharded then every shard reads the whole
+        # stream, so we can only drop what all of them have acked.
+        self._federation_sender_instances = hs.config.federation_sender_instances
+        self._federation_acks = {}  # instance_name -> token
+        self._last_missing_ack_warning_ms = 0
+
         # EVERYTHING IS SAD. In particular, python only makes new scopes when
         # we make a new function, so we need to make a new function so the inner
         # lambda binds to the queue rather than to the name of the queue which
@@ -100,7 +110,9 @@ class FederationRemoteSendQueue(object):
         if not keys[:time]:
             return
 
-        position_to_delete = max(keys[:time])
+        # Everything up to and including the last position from before the
+        # cutoff can go.
+        position_to_delete = max(self.pos_time[key] for key in keys[:time]) + 1
         for key in keys[:time]:
             del self.pos_time[key]
 
@@ -205,8 +217,36 @@ class FederationRemoteSendQueue(object):
     def get_current_token(self):
         return self.pos - 1
 
-    def federation_ack(self, token):
-        self._clear_queue_before_pos(token)
+    def federation_ack(self, token, instance_name=None):
+        if not self._federation_sender_instances:
+            self._clear_queue_before_pos(token)
+            return
+
+        self._federation_acks[instance_name] = token
+
+        missing = [
+            instance for instance in self._federation_sender_instances
+            if instance not in self._federation_acks
+        ]
+        if missing:
+            # We can't drop anything until every shard has seen it. In the
+            # meantime `_clear_queue` still drops anything older than five
+            # minutes, which is how long the missing shards have to connect
+            # before they miss data.
+            now = self.clock.time_msec()
+            if now - self._last_missing_ack_warning_ms > MISSING_ACK_WARNING_INTERVAL:
+                self._last_missing_ack_warning_ms = now
+                logger.warning(
+                    "Federation sender instances %s have not connected: keeping"
+                    " federation rows for up to five minutes for them",
+                    ", ".join(missing),
+                )
+            return
+
+        self._clear_queue_before_pos(min(
+            self._federation_acks[instance]
+            for instance in self._federation_sender_instances
+        ))
 
     def get_replication_rows(self, from_token, to_token, limit, federation_ack=None):
         """Get rows to be sent over federation between the two tokens
@@ -17,11 +17,12 @@ import logging
 
 from six import itervalues
 
-from prometheus_client import Counter
+from prometheus_client import Counter, Histogram
 
 from twisted.internet import defer
 
 import synapse.metrics
+from synapse.api.constants import EventTypes, Membership
 from synapse.api.errors import (
     FederationDeniedError,
     HttpResponseException,
@@ -36,7 +37,10 @@ from synapse.metrics import (
     sent_transactions_counter,
 )
 from synapse.metrics.background_process_metrics import run_as_background_process
+from synapse.types import get_domain_from_id
 from synapse.util import logcontext
+from synapse.util.caches.expiringcache import ExpiringCache
+from synapse.util.hash_ring import ConsistentHashRing
 from synapse.util.metrics import measure_func
 from synapse.util.retryutils import NotRetryingDestination, get_retry_limiter
 
@@ -66,6 +70,112 @@ sent_edus_by_type = Counter(
     ["type"],
 )
 
+transaction_duration = Histogram(
+    "synapse_federation_transaction_queue_transaction_duration_seconds",
+    "Time taken for destinations to respond to transactions",
+    buckets=[0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120],
+)
+
+transaction_pdus = Histogram(
+    "synapse_federation_transaction_queue_transaction_pdus",
+    "Number of PDUs sent per transaction",
+    buckets=[0, 1, 2, 5, 10, 20, 35, 50],
+)
+
+transaction_edus = Histogram(
+    "synapse_federation_transaction_queue_transaction_edus",
+    "Number of EDUs sent per transaction",
+    buckets=[0, 1, 2, 5, 10, 20, 50, 100],
+)
+
+# How long we remember the batching policy of a destination we haven't sent
+# anything to.
+BATCHING_POLICY_EXPIRY_MS = 60 * 60 * 1000
+
+transaction_linger_seconds = Counter(
+    "synapse_federation_transaction_queue_linger_seconds",
+    "Total time spent waiting for more PDUs and EDUs before sending transactions",
+)
+
+
+class _DestinationBatchingPolicy(object):
+    """Decides how to batch up the transactions we send to a destination, based
+    on how quickly it has been responding to them.
+
+    Destinations which are slow to respond get a short linger window before
+    each transaction, so that more PDUs and EDUs can build up and they get
+    fewer, fuller transactions. Transactions which take too long or fail
+    shrink the number of PDUs we send at once, in case the destination is
+    struggling to process them, and it grows back as the destination keeps up.
+
+    We only ever have one transaction in flight to each destination.
+    """
+
+    # The most PDUs and EDUs we can put in a transaction.
+    MAX_PDUS = 50
+    MAX_EDUS = 100
+
+    MIN_PDUS = 5
+
+    # Transactions taking longer than this shrink the number of PDUs we send.
+    TARGET_RESPONSE_TIME_MS = 10 * 1000
+
+    # Destinations taking longer than this to respond get a linger window of a
+    # fraction of their response time.
+    LINGER_RESPONSE_TIME_MS = 500
+    LINGER_FRACTION = 0.1
+    MAX_LINGER_MS = 1000
+
+    # The weight given to the latest response time in the average.
+    RESPONSE_TIME_SMOOTHING = 0.2
+
+    def __init__(self):
+        self.max_pdus = self.MAX_PDUS
+        self.max_edus = self.MAX_EDUS
+
+        # Moving average of the destination's response time
+        self.response_time_ms = None
+
+    def get_linger_ms(self):
+        """How long to wait for more PDUs and EDUs before sending a transaction
+        which isn't full.
+
+        Returns:
+            int
+        """
+        if (
+            self.response_time_ms is None
+            or self.response_time_ms < self.LINGER_RESPONSE_TIME_MS
+        ):
+            return 0
+        return int(min(
+            self.MAX_LINGER_MS, self.response_time_ms * self.LINGER_FRACTION,
+        ))
+
+    def on_response(self, response_time_ms, pdu_count):
+        """Called when the destination responds to a transaction.
+
+        Args:
+            response_time_ms (int)
+            pdu_count (int): the number of PDUs in the transaction.
+        """
+        if self.response_time_ms is None:
+            self.response_time_ms = response_time_ms
+        else:
+            self.response_time_ms += self.RESPONSE_TIME_SMOOTHING * (
+                response_time_ms - self.response_time_ms
+            )
+
+        if response_time_ms > self.TARGET_RESPONSE_TIME_MS:
+            self.max_pdus = max(self.MIN_PDUS, min(self.max_pdus, pdu_count) // 2)
+        elif pdu_count >= self.max_pdus:
+            self.max_pdus = min(self.MAX_PDUS, self.max_pdus + self.MIN_PDUS)
+
+    def on_failure(self):
+        """Called when we fail to send a transaction to the destination.
+        """
+        self.max_pdus = max(self.MIN_PDUS, self.max_pdus // 2)
+
 
 class TransactionQueue(object):
     """This class makes sure we only have one transaction in flight at
@@ -87,6 +197,15 @@ class TransactionQueue(object):
         self.clock = hs.get_clock()
         self.is_mine_id = hs.is_mine_id
 
+        # If outbound federation is sharded across several federation senders,
+        # each destination belongs to the one it hashes to.
+        self._instance_name = hs.config.federation_sender_instance_name
+        self._federation_shard_ring = None
+        if hs.config.federation_sender_instances:
+            self._federation_shard_ring = ConsistentHashRing(
+                hs.config.federation_sender_instances,
+            )
+
         # Is a mapping from destinations -> deferreds. Used to keep track
         # of which destinations have transactions in flight and when they are
         # done
@@ -144,6 +263,37 @@ class TransactionQueue(object):
         # update.
         self.last_device_list_stream_id_by_dest = {}
 
+        # destination -> whether the destination is catching up. A destination
+        # starts catching up when we fail to send to it: rather than queuing
+        # up its PDUs in memory, we rely on the destination_rooms table to
+        # send it the latest event in each room it has missed once it is
+        # reachable again. Destinations we haven't tried to send to yet since
+        # starting up are absent, and are checked for missed events first.
+        self._catching_up_by_dest = {}
+
+        # destination -> stream_ordering of the most recent PDU which wasn't
+        # queued for the destination because it was catching up.
+        self._catch_up_last_skipped_by_dest = {}
+
+        LaterGauge(
+            "synapse_federation_transaction_queue_catching_up_destinations",
+            "",
+            [],
+            lambda: sum(1 for c in itervalues(self._catching_up_by_dest) if c),
+        )
+
+        self.clock.looping_call(
+            self._start_wake_destinations_needing_catch_up, 60 * 1000,
+        )
+
+        # destination -> _DestinationBatchingPolicy
+        self._batching_policies = ExpiringCache(
+            cache_name="federation_batching_policies",
+            clock=self.clock,
+            expiry_ms=BATCHING_POLICY_EXPIRY_MS,
+            reset_expiry_on_get=True,
+        )
+
         # HACK to get unique tx id
         self._next_txn_id = int(self.clock.time_msec())
 
@@ -193,14 +343,8 @@ class TransactionQueue(object):
                         return
 
                     try:
-                        # Get the state from before the event.
-                        # We need to make sure that this is the state from before
-                        # the event and not from after it.
-                        # Otherwise if the last member on a server in a room is
-                        # banned then it won't receive the event because it won't
-                        # be in the room after the ban.
-                        destinations = yield self.state.get_current_hosts_in_room(
-                            event.room_id, latest_event_ids=event.prev_event_ids(),
+                        destinations = yield self._get_destinations_for_event(
+                            event,
                         )
                     except Exception:
                         logger.exception(
@@ -209,7 +353,11 @@ class TransactionQueue(object):
                         )
                         return
 
-                    destinations = set(destinations)
+                    destinations = set(
+                        destination for destination in destinations
+                        if self._should_send_to(destination)
+                    )
+                    destinations.discard(self.server_name)
 
                     if send_on_behalf_of is not None:
                         # If we are sending the event on behalf of another server
@@ -217,26 +365,50 @@ class TransactionQueue(object):
                         # send the event to it.
                         destinations.discard(send_on_behalf_of)
 
-                    logger.debug("Sending %s to %r", event, destinations)
-
-                    self._send_pdu(event, destinations)
+                    defer.returnValue(destinations)
 
                 @defer.inlineCallbacks
                 def handle_room_events(events):
+                    sends = []
                     for event in events:
-                        yield handle_event(event)
+                        destinations = yield handle_event(event)
+                        if destinations:
+                            sends.append((event, destinations))
+                    defer.returnValue(sends)
 
                 events_by_room = {}
                 for event in events:
                     events_by_room.setdefault(event.room_id, []).append(event)
 
-                yield logcontext.make_deferred_yieldable(defer.gatherResults(
-                    [
-                        logcontext.run_in_background(handle_room_events, evs)
-                        for evs in itervalues(events_by_room)
-                    ],
-                    consumeErrors=True
-                ))
+                sends_by_room = yield logcontext.make_deferred_yieldable(
+                    defer.gatherResults(
+                        [
+                            logcontext.run_in_background(handle_room_events, evs)
+                            for evs in itervalues(events_by_room)
+                        ],
+                        consumeErrors=True
+                    )
+                )
+                sends = sorted(
+                    (send for sends in sends_by_room for send in sends),
+                    key=lambda send: send[0].internal_metadata.stream_ordering,
+                )
+
+                # Record which rooms each destination needs to hear about before
+                # queuing the PDUs, so that destinations which we fail to reach
+                # can be caught up later.
+                yield self.store.store_destination_rooms_entries(
+                    (
+                        event.room_id,
+                        event.internal_metadata.stream_ordering,
+                        destinations,
+                    )
+                    for event, destinations in sends
+                )
+
+                for event, destinations in sends:
+                    logger.debug("Sending %s to %r", event, destinations)
+                    self._send_pdu(event, destinations)
 
                 yield self.store.update_federation_out_pos(
                     "events", next_token
@@ -284,9 +456,17 @@ class TransactionQueue(object):
         sent_pdus_destination_dist_count.inc()
 
         for destination in destinations:
-            self.pending_pdus_by_dest.setdefault(destination, []).append(
-                (pdu, order)
-            )
+            if self._catching_up_by_dest.get(destination):
+                # The destination will be sent the latest event in the room
+                # from the database, so we just need to note that there is
+                # more to send.
+                self._catch_up_last_skipped_by_dest[destination] = (
+                    pdu.internal_metadata.stream_ordering
+                )
+            else:
+                self.pending_pdus_by_dest.setdefault(destination, []).append(
+                    (pdu, order)
+                )
 
             self._attempt_new_transaction(destination)
 
@@ -346,13 +526,16 @@ class TransactionQueue(object):
         Args:
             states (list(UserPresenceState))
         """
-        hosts_and_states = yield get_interested_remotes(self.store, states, self.state)
+        hosts_and_states = yield get_interested_remotes(self.store, states)
 
         for destinations, states in hosts_and_states:
             for destination in destinations:
                 if destination == self.server_name:
                     continue
 
+                if not self._should_send_to(destination):
+                    continue
+
                 self.pending_presence_by_dest.setdefault(
                     destination, {}
                 ).update({
@@ -373,6 +556,9 @@ class TransactionQueue(object):
             logger.info("Not sending EDU to ourselves")
             return
 
+        if not self._should_send_to(destination):
+            return
+
         if key:
             self.pending_edus_keyed_by_dest.setdefault(
                 destination, {}
@@ -387,11 +573,28 @@ class TransactionQueue(object):
             logger.info("Not sending device update to ourselves")
             return
 
+        if not self._should_send_to(destination):
+            return
+
         self._attempt_new_transaction(destination)
 
     def get_current_token(self):
         return 0
 
+    def _should_send_to(self, destination):
+        """Whether this process is responsible for sending to the destination,
+        when outbound federation is sharded.
+
+        Args:
+            destination (str)
+
+        Returns:
+            bool
+        """
+        if self._federation_shard_ring is None:
+            return True
+        return self._federation_shard_ring.get_node(destination) == self._instance_name
+
     def _attempt_new_transaction(self, destination):
         """Try to start a new transaction to this destination
 
@@ -436,8 +639,23 @@ class TransactionQueue(object):
             # hence why we throw the result away.
             yield get_retry_limiter(destination, self.clock, self.store)
 
+            if self._catching_up_by_dest.get(destination, True):
+                yield self._catch_up_destination(destination)
+
+            batching_policy = self._get_batching_policy(destination)
+
             pending_pdus = []
             while True:
+                # Only linger if there are PDUs to batch up: EDUs on their own
+                # (e.g. typing notifications) should go out straight away.
+                linger_ms = batching_policy.get_linger_ms()
+                if linger_ms and (
+                    0 < len(self.pending_pdus_by_dest.get(destination, ()))
+                    < batching_policy.max_pdus
+                ):
+                    transaction_linger_seconds.inc(linger_ms / 1000.)
+                    yield self.clock.sleep(linger_ms / 1000.)
+
                 device_message_edus, device_stream_id, dev_list_id = (
                     yield self._get_new_device_messages(destination)
                 )
@@ -453,15 +671,22 @@ class TransactionQueue(object):
 
                 pending_pdus = self.pending_pdus_by_dest.pop(destination, [])
 
-                # We can only include at most 50 PDUs per transactions
-                pending_pdus, leftover_pdus = pending_pdus[:50], pending_pdus[50:]
+                # We can only include at most 50 PDUs per transactions, and may
+                # send fewer if the destination is struggling.
+                max_pdus = batching_policy.max_pdus
+                pending_pdus, leftover_pdus = (
+                    pending_pdus[:max_pdus], pending_pdus[max_pdus:]
+                )
                 if leftover_pdus:
                     self.pending_pdus_by_dest[destination] = leftover_pdus
 
                 pending_edus = self.pending_edus_by_dest.pop(destination, [])
 
                 # We can only include at most 100 EDUs per transactions
-                pending_edus, leftover_edus = pending_edus[:100], pending_edus[100:]
+                max_edus = batching_policy.max_edus
+                pending_edus, leftover_edus = (
+                    pending_edus[:max_edus], pending_edus[max_edus:]
+                )
                 if leftover_edus:
                     self.pending_edus_by_dest[destination] = leftover_edus
 
@@ -523,6 +748,15 @@ class TransactionQueue(object):
 
                     self.last_device_stream_id_by_dest[destination] = device_stream_id
                     self.last_device_list_stream_id_by_dest[destination] = dev_list_id
+
+                    if pending_pdus:
+                        yield self.store.set_destination_last_successful_stream_ordering(
+                            destination,
+                            max(
+                                pdu.internal_metadata.stream_ordering
+                                for pdu, _ in pending_pdus
+                            ),
+                        )
                 else:
                     break
         except NotRetryingDestination as e:
@@ -534,19 +768,23 @@ class TransactionQueue(object):
                     (e.retry_last_ts + e.retry_interval) / 1000.0
                 ),
             )
+            yield self._start_catching_up(destination, pending_pdus)
         except FederationDeniedError as e:
             logger.info(e)
+            yield self._start_catching_up(destination, pending_pdus)
         except HttpResponseException as e:
             logger.warning(
                 "TX [%s] Received %d response to transaction: %s",
                 destination, e.code, e,
             )
+            yield self._start_catching_up(destination, pending_pdus)
         except RequestSendFailed as e:
             logger.warning("TX [%s] Failed to send transaction: %s", destination, e)
 
             for p, _ in pending_pdus:
                 logger.info("Failed to send event %s to %s", p.event_id,
                             destination)
+            yield self._start_catching_up(destination, pending_pdus)
         except Exception:
             logger.exception(
                 "TX [%s] Failed to send transaction",
@@ -555,10 +793,203 @@ class TransactionQueue(object):
             for p, _ in pending_pdus:
                 logger.info("Failed to send event %s to %s", p.event_id,
                             destination)
+            yield self._start_catching_up(destination, pending_pdus)
         finally:
             # We want to be *very* sure we delete this after we stop processing
             self.pending_transactions.pop(destination, None)
 
+    @defer.inlineCallbacks
+    def _get_destinations_for_event(self, event):
+        """Works out which hosts an event should be sent to, from the state
+        before the event.
+
+        Args:
+            event (FrozenEvent)
+
+        Returns:
+            Deferred[set[str]]
+        """
+        latest_event_ids = yield self.store.get_latest_event_ids_in_room(
+            event.room_id,
+        )
+        latest_event_ids = set(latest_event_ids)
+
+        if latest_event_ids == set(event.prev_event_ids()):
+            # The room's current state is the state before the event, so we
+            # can use the hosts which are maintained as the membership
+            # changes rather than resolving the state.
+            destinations = yield self.store.get_hosts_in_room(event.room_id)
+        elif latest_event_ids == {event.event_id}:
+            # As above, except that the current state is from after the event.
+            # If the last member on a server in the room has left or been
+            # banned by this event then it won't be in the room any more, but
+            # should still receive the event.
+            destinations = yield self.store.get_hosts_in_room(event.room_id)
+            if (
+                event.type == EventTypes.Member
+                and event.membership != Membership.JOIN
+            ):
+                destinations = destinations | {get_domain_from_id(event.state_key)}
+        else:
+            # Other events have happened in the room since (or alongside)
+            # this one, so we need to work out the state before it.
+            destinations = yield self.state.get_current_hosts_in_room(
+                event.room_id, latest_event_ids=event.prev_event_ids(),
+            )
+
+        defer.returnValue(set(destinations))
+
+    @defer.inlineCallbacks
+    def _catch_up_destination(self, destination):
+        """Sends the destination the latest event in each room which it has
+        missed events in, according to the destination_rooms table.
+
+        This is used instead of the in-memory queue of PDUs for destinations
+        which we have failed to send to, and for each destination the first
+        time we send to it after starting up in case it missed events before
+        we restarted.
+
+        Args:
+            destination (str)
+
+        Returns:
+            Deferred
+        """
+        last_successful_stream_ordering = (
+            yield self.store.get_destination_last_successful_stream_ordering(
+                destination,
+            )
+        )
+        if last_successful_stream_ordering is None:
+            # We have never successfully sent the destination any events, so
+            # there is nothing for it to catch up on.
+            self._catching_up_by_dest[destination] = False
+            return
+
+        while True:
+            rows = yield self.store.get_catch_up_room_event_ids(
+                destination, last_successful_stream_ordering,
+                limit=self._get_batching_policy(destination).max_pdus,
+            )
+
+            if not rows:
+                last_skipped = self._catch_up_last_skipped_by_dest.pop(
+                    destination, None,
+                )
+                if (
+                    last_skipped is not None
+                    and last_skipped > last_successful_stream_ordering
+                ):
+                    # Some PDUs were skipped while we were looking: check the
+                    # database again, as they will be in there by now. We only
+                    # do this once per skip, so that we don't spin if the
+                    # skipped PDU never turns up.
+                    continue
+
+                self._catching_up_by_dest[destination] = False
+                return
+
+            # We're going to send the latest event in each room from the
+            # database, so anything queued in memory is redundant.
+            self._catching_up_by_dest[destination] = True
+            self.pending_pdus_by_dest.pop(destination, None)
+
+            # Events which have been purged since are skipped.
+            events = yield self.store.get_events(
+                [event_id for event_id, _ in rows if event_id is not None],
+            )
+            pending_pdus = [
+                (events[event_id], stream_ordering)
+                for event_id, stream_ordering in rows
+                if event_id in events
+            ]
+
+            logger.info(
+                "TX [%s] Catching up with %d rooms", destination, len(pending_pdus),
+            )
+
+            if pending_pdus:
+                success = yield self._send_new_transaction(
+                    destination, pending_pdus, [],
+                )
+                if success:
+                    sent_transactions_counter.inc()
+
+            # We don't retry PDUs which the destination rejected, as for the
+            # in-memory queue.
+            last_successful_stream_ordering = rows[-1][1]
+            yield self.store.set_destination_last_successful_stream_ordering(
+                destination, last_successful_stream_ordering,
+            )
+
+    @defer.inlineCallbacks
+    def _start_catching_up(self, destination, failed_pdus):
+        """Switches the destination to catching up after we failed to send to
+        it. Its queued PDUs are dropped, since it will be sent the latest event
+        in each of their rooms once it is reachable again.
+
+        Args:
+            destination (str)
+            failed_pdus (list[tuple[FrozenEvent, int]]): the PDUs in the
+                transaction which we failed to send, with their order.
+
+        Returns:
+            Deferred
+        """
+        pdus = failed_pdus + self.pending_pdus_by_dest.pop(destination, [])
+        self._catching_up_by_dest[destination] = True
+
+        if not pdus:
+            return
+
+        last_successful_stream_ordering = (
+            yield self.store.get_destination_last_successful_stream_ordering(
+                destination,
+            )
+        )
+        if last_successful_stream_ordering is None:
+            # We have never successfully sent the destination anything, so
+            # make sure that catching up includes these PDUs.
+            yield self.store.set_destination_last_successful_stream_ordering(
+                destination,
+                min(pdu.internal_metadata.stream_ordering for pdu, _ in pdus) - 1,
+            )
+
+    def _start_wake_destinations_needing_catch_up(self):
+        return run_as_background_process(
+            "wake_destinations_needing_catch_up",
+            self._wake_destinations_needing_catch_up,
+        )
+
+    @defer.inlineCallbacks
+    def _wake_destinations_needing_catch_up(self):
+        """Starts sending to destinations which have missed events and are no
+        longer backing off, since nothing else may prompt us to.
+        """
+        last_destination = None
+        while True:
+            destinations = yield self.store.get_catch_up_outstanding_destinations(
+                last_destination,
+            )
+            if not destinations:
+                break
+
+            for destination in destinations:
+                if self._should_send_to(destination):
+                    self._attempt_new_transaction(destination)
+
+            last_destination = destinations[-1]
+
+            # Spread out the load of starting lots of transactions.
+            yield self.clock.sleep(5)
+
+    def _get_batching_policy(self, destination):
+        policy = self._batching_policies.get(destination)
+        if policy is None:
+            policy = _DestinationBatchingPolicy()
+            self._batching_policies[destination] = policy
+        return policy
+
     @defer.inlineCallbacks
     def _get_new_device_messages(self, destination):
         last_device_stream_id = self.last_device_stream_id_by_dest.get(destination, 0)
@@ -654,6 +1085,11 @@ class TransactionQueue(object):
                         del p["age_ts"]
             return data
 
+        batching_policy = self._get_batching_policy(destination)
+        transaction_pdus.observe(len(pdus))
+        transaction_edus.observe(len(edus))
+
+        start = self.clock.time_msec()
         try:
             response = yield self.transport_layer.send_transaction(
                 transaction, json_data_cb
@@ -668,7 +1104,15 @@ class TransactionQueue(object):
                     "TX [%s] {%s} got %d response",
                     destination, txn_id, code
                 )
+                batching_policy.on_failure()
                 raise e
+        except RequestSendFailed:
+            batching_policy.on_failure()
+            raise
+
+        response_time_ms = self.clock.time_msec() - start
+        transaction_duration.observe(response_time_ms / 1000.)
+        batching_policy.on_response(response_time_ms, len(pdus))
 
         logger.info(
             "TX [%s] {%s} got %d response",
@@ -35,7 +35,7 @@ class TransportLayerClient(object):
         self.client = hs.get_http_client()
 
     @log_function
-    def get_room_state(self, destination, room_id, event_id):
+    def get_room_state(self, destination, room_id, event_id, parser=None):
         """ Requests all state for a given room from the given server at the
         given event.
 
@@ -44,6 +44,8 @@ class TransportLayerClient(object):
                 to get the state from.
             context (str): The name of the context we want the state of
             event_id (str): The event we want the context at.
+            parser (JsonStreamParser|None): if set, used to parse the
+                response as it arrives.
 
         Returns:
             Deferred: Results in a dict received from the remote homeserver.
@@ -53,7 +55,7 @@ class TransportLayerClient(object):
 
         path = _create_v1_path("/state/%s/", room_id)
         return self.client.get_json(
-            destination, path=path, args={"event_id": event_id},
+            destination, path=path, args={"event_id": event_id}, parser=parser,
         )
 
     @log_function
@@ -99,7 +101,7 @@ class TransportLayerClient(object):
         return self.client.get_json(destination, path=path, timeout=timeout)
 
     @log_function
-    def backfill(self, destination, room_id, event_tuples, limit):
+    def backfill(self, destination, room_id, event_tuples, limit, parser=None):
         """ Requests `limit` previous PDUs in a given context before list of
         PDUs.
 
@@ -108,6 +110,8 @@ class TransportLayerClient(object):
             room_id (str)
             event_tuples (list)
             limit (int)
+            parser (JsonStreamParser|None): if set, used to parse the
+                response as it arrives.
 
         Returns:
             Deferred: Results in a dict received from the remote homeserver.
@@ -132,6 +136,7 @@ class TransportLayerClient(object):
             destination,
             path=path,
             args=args,
+            parser=parser,
         )
 
     @defer.inlineCallbacks
@@ -257,13 +262,14 @@ class TransportLayerClient(object):
 
     @defer.inlineCallbacks
     @log_function
-    def send_join(self, destination, room_id, event_id, content):
+    def send_join(self, destination, room_id, event_id, content, parser=None):
         path = _create_v1_path("/send_join/%s/%s", room_id, event_id)
 
         response = yield self.client.put_json(
             destination=destination,
             path=path,
             data=content,
+            parser=parser,
         )
 
         defer.returnValue(response)
@@ -482,7 +488,7 @@ class TransportLayerClient(object):
     @defer.inlineCallbacks
     @log_function
     def get_missing_events(self, destination, room_id, earliest_events,
-                           latest_events, limit, min_depth, timeout):
+                           latest_events, limit, min_depth, timeout, parser=None):
         path = _create_v1_path("/get_missing_events/%s", room_id,)
 
         content = yield self.client.post_json(
@@ -495,6 +501,7 @@ class TransportLayerClient(object):
                 "latest_events": latest_events,
             },
             timeout=timeout,
+            parser=parser,
         )
 
         defer.returnValue(content)
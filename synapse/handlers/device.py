@@ -178,6 +178,8 @@ class DeviceHandler(BaseHandler):
             user_id=user_id, device_id=device_id
         )
 
+        yield self.store.delete_sent_lazy_loaded_members(user_id, device_id)
+
         yield self.notify_device_update(user_id, [device_id])
 
     @defer.inlineCallbacks
@@ -228,6 +230,7 @@ class DeviceHandler(BaseHandler):
             yield self.store.delete_e2e_keys_by_device(
                 user_id=user_id, device_id=device_id
             )
+            yield self.store.delete_sent_lazy_loaded_members(user_id, device_id)
 
         yield self.notify_device_update(user_id, device_ids)
 
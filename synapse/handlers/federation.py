@@ -28,7 +28,9 @@ from signedjson.sign import verify_signed_json
 from unpaddedbase64 import decode_base64
 
 from twisted.internet import defer
+from twisted.python.failure import Failure
 
+from synapse import event_auth
 from synapse.api.constants import (
     KNOWN_ROOM_VERSIONS,
     EventTypes,
@@ -46,6 +48,7 @@ from synapse.api.errors import (
 )
 from synapse.crypto.event_signing import compute_event_signature
 from synapse.events.validator import EventValidator
+from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.replication.http.federation import (
     ReplicationCleanRoomRestServlet,
     ReplicationFederationSendEventsRestServlet,
@@ -64,6 +67,13 @@ from ._base import BaseHandler
 
 logger = logging.getLogger(__name__)
 
+# the maximum number of rooms we fetch missing prev_events for at once.
+MISSING_EVENTS_CONCURRENCY_LIMIT = 10
+
+# the number of servers we may ask for each page of backfill. We only ask the
+# next one if the previous ones are slower than usual to respond, or fail.
+BACKFILL_PARALLELISM = 2
+
 
 def shortstr(iterable, maxitems=5):
     """If iterable has maxitems or fewer, return the stringification of a list
@@ -86,6 +96,99 @@ def shortstr(iterable, maxitems=5):
     return u"[" + u", ".join(repr(r) for r in items[:maxitems]) + u", ...]"
 
 
+class _BackfillPlanner(object):
+    """Decides which servers to backfill from first, based on how they have
+    responded to our recent backfill requests.
+
+    Servers which have failed recently are tried last. The others are tried
+    quickest first, with servers we haven't backfilled from before ranked as if
+    they took DEFAULT_RESPONSE_TIME_MS. Ties keep their original order.
+    """
+
+    # How long we try servers last for after they fail a backfill request.
+    FAILURE_BACKOFF_MS = 10 * 60 * 1000
+
+    DEFAULT_RESPONSE_TIME_MS = 2000
+
+    # The weight given to the latest response time in the average.
+    RESPONSE_TIME_SMOOTHING = 0.3
+
+    # How many times longer than usual we wait for a server to respond before
+    # asking another one as well.
+    HEDGE_RESPONSE_TIME_FACTOR = 2
+
+    def __init__(self):
+        # map from server name to moving average of its response time
+        self._response_time_ms = {}
+
+        # map from server name to when it last failed a backfill request
+        self._last_failure_ms = {}
+
+    def rank(self, destinations, now_ms):
+        """Orders servers by which we should backfill from first.
+
+        Args:
+            destinations (list[str]): candidate servers, in the order we would
+                otherwise try them.
+            now_ms (int): the current time
+
+        Returns:
+            list[str]
+        """
+        def key(destination):
+            last_failure_ms = self._last_failure_ms.get(destination)
+            failed_recently = (
+                last_failure_ms is not None
+                and now_ms - last_failure_ms < self.FAILURE_BACKOFF_MS
+            )
+            response_time_ms = self._response_time_ms.get(
+                destination, self.DEFAULT_RESPONSE_TIME_MS,
+            )
+            return (failed_recently, response_time_ms)
+
+        return sorted(destinations, key=key)
+
+    def get_hedge_delay_ms(self, destination):
+        """Gets how long we should wait for a server to respond to a backfill
+        request before asking another server for the same page.
+
+        Args:
+            destination (str)
+
+        Returns:
+            int
+        """
+        response_time_ms = self._response_time_ms.get(
+            destination, self.DEFAULT_RESPONSE_TIME_MS,
+        )
+        return int(response_time_ms * self.HEDGE_RESPONSE_TIME_FACTOR)
+
+    def on_response(self, destination, response_time_ms):
+        """Called when a server responds to a backfill request.
+
+        Args:
+            destination (str)
+            response_time_ms (int)
+        """
+        self._last_failure_ms.pop(destination, None)
+
+        average = self._response_time_ms.get(destination)
+        if average is None:
+            average = response_time_ms
+        else:
+            average += self.RESPONSE_TIME_SMOOTHING * (response_time_ms - average)
+        self._response_time_ms[destination] = average
+
+    def on_failure(self, destination, now_ms):
+        """Called when a backfill request to a server fails.
+
+        Args:
+            destination (str)
+            now_ms (int): the current time
+        """
+        self._last_failure_ms[destination] = now_ms
+
+
 class FederationHandler(BaseHandler):
     """Handles events that originated from federation.
         Responsible for:
@@ -130,6 +233,14 @@ class FederationHandler(BaseHandler):
         self.room_queues = {}
         self._room_pdu_linearizer = Linearizer("fed_room_pdu")
 
+        # Limits how many rooms we fetch missing events for at once, so that
+        # a few slow servers can't tie up all of our outbound requests.
+        self._missing_events_limiter = Linearizer(
+            "fed_missing_events", max_count=MISSING_EVENTS_CONCURRENCY_LIMIT,
+        )
+
+        self._backfill_planner = _BackfillPlanner()
+
     @defer.inlineCallbacks
     def on_receive_pdu(
             self, origin, pdu, sent_to_us_directly=False,
@@ -255,9 +366,10 @@ class FederationHandler(BaseHandler):
                             room_id, event_id, len(missing_prevs),
                         )
 
-                        yield self._get_missing_events_for_pdu(
-                            origin, pdu, prevs, min_depth
-                        )
+                        with (yield self._missing_events_limiter.queue(None)):
+                            yield self._get_missing_events_for_pdu(
+                                origin, pdu, prevs, min_depth
+                            )
 
                         # Update the set of things we've seen after trying to
                         # fetch the missing stuff
@@ -653,8 +765,6 @@ class FederationHandler(BaseHandler):
         if dest == self.server_name:
             raise SynapseError(400, "Can't backfill from self.")
 
-        room_version = yield self.store.get_room_version(room_id)
-
         events = yield self.federation_client.backfill(
             dest,
             room_id,
@@ -662,6 +772,129 @@ class FederationHandler(BaseHandler):
             extremities=extremities,
         )
 
+        events = yield self._process_backfilled_events(dest, room_id, events)
+        defer.returnValue(events)
+
+    @defer.inlineCallbacks
+    def _backfill_from_any(self, destinations, room_id, limit, extremities):
+        """Asks several servers for the same page of backfill, and persists the
+        events from whichever responds first.
+
+        Each server is only asked once the ones before it have failed, or have
+        taken longer than usual to respond. The requests run as background
+        processes, so any which are still going once we have our answer just
+        finish in their own time, and tell the backfill planner how the server
+        did.
+
+        Args:
+            destinations (list[str]): the servers to ask
+            room_id (str)
+            limit (int)
+            extremities (iterable[str]): the event ids to backfill from
+
+        Returns:
+            Deferred[list[FrozenEvent]]: the new events which were persisted
+
+        Raises:
+            the failure from the first server, if none of them responded.
+        """
+        if self.server_name in destinations:
+            raise SynapseError(400, "Can't backfill from self.")
+
+        # resolves to the first response, or to the failure from the first
+        # server once they have all failed.
+        result = defer.Deferred()
+        failures = {}
+
+        # fired when we should stop waiting for the latest server on its own.
+        wakeup = [None]
+
+        def wake():
+            d, wakeup[0] = wakeup[0], None
+            if d is not None:
+                with logcontext.PreserveLoggingContext():
+                    d.callback(None)
+
+        @defer.inlineCallbacks
+        def request(dest):
+            try:
+                res = yield self._request_backfill(
+                    dest, room_id, limit, extremities,
+                )
+            except Exception:
+                failures[dest] = Failure()
+                if len(failures) == len(destinations) and not result.called:
+                    with logcontext.PreserveLoggingContext():
+                        result.errback(failures[destinations[0]])
+            else:
+                if not result.called:
+                    with logcontext.PreserveLoggingContext():
+                        result.callback(res)
+            wake()
+
+        for i, dest in enumerate(destinations):
+            if result.called:
+                break
+
+            run_as_background_process("backfill_request", request, dest)
+
+            # the request may already have finished, eg if the response was
+            # cached, in which case there's nothing left to wait for.
+            if result.called:
+                break
+
+            if i + 1 == len(destinations) or dest in failures:
+                continue
+
+            wakeup[0] = defer.Deferred()
+            delayed_call = self.clock.call_later(
+                self._backfill_planner.get_hedge_delay_ms(dest) / 1000., wake,
+            )
+            yield logcontext.make_deferred_yieldable(wakeup[0])
+            if delayed_call.active():
+                delayed_call.cancel()
+
+        dest, events = yield logcontext.make_deferred_yieldable(result)
+        events = yield self._process_backfilled_events(dest, room_id, events)
+        defer.returnValue(events)
+
+    @defer.inlineCallbacks
+    def _request_backfill(self, dest, room_id, limit, extremities):
+        """Requests a page of backfill from a server, and records how long it
+        took for the backfill planner.
+
+        Returns:
+            Deferred[(str, list[FrozenEvent])]: the server and the events it
+                returned
+        """
+        start = self.clock.time_msec()
+        try:
+            events = yield self.federation_client.backfill(
+                dest,
+                room_id,
+                limit=limit,
+                extremities=extremities,
+            )
+        except Exception:
+            self._backfill_planner.on_failure(dest, self.clock.time_msec())
+            raise
+
+        self._backfill_planner.on_response(dest, self.clock.time_msec() - start)
+        defer.returnValue((dest, events))
+
+    @defer.inlineCallbacks
+    def _process_backfilled_events(self, dest, room_id, events):
+        """Fetches the state and auth events needed for a page of backfill from
+        the server which sent it, and persists the events.
+
+        Args:
+            dest (str): the server which sent the events
+            room_id (str)
+            events (list[FrozenEvent])
+
+        Returns:
+            Deferred[list[FrozenEvent]]: the new events which were persisted
+        """
         # ideally we'd sanity check the events here for excess prev_events etc,
         # but it's hard to reject events at this point without completely
         # breaking backfill in the same way that it is currently broken by
@@ -682,6 +915,8 @@ class FederationHandler(BaseHandler):
         if not events:
             defer.returnValue([])
 
+        room_version = yield self.store.get_room_version(room_id)
+
         event_map = {e.event_id: e for e in events}
 
         event_ids = set(e.event_id for e in events)
@@ -924,11 +1159,15 @@ class FederationHandler(BaseHandler):
 
         @defer.inlineCallbacks
         def try_backfill(domains):
-            # TODO: Should we try multiple of these at a time?
-            for dom in domains:
+            # Ask the servers which have been quickest to respond recently
+            # first, a few at a time.
+            domains = self._backfill_planner.rank(domains, self.clock.time_msec())
+            for i in range(0, len(domains), BACKFILL_PARALLELISM):
+                group = domains[i:i + BACKFILL_PARALLELISM]
+                dom = shortstr(group)
                 try:
-                    yield self.backfill(
-                        dom, room_id,
+                    yield self._backfill_from_any(
+                        group, room_id,
                         limit=100,
                         extremities=extremities,
                     )
@@ -1705,6 +1944,9 @@ class FederationHandler(BaseHandler):
             else:
                 logger.info("Failed to find auth event %r", e_id)
 
+        # the events mostly share the same power levels, so check them all
+        # with one checker.
+        auth_checker = event_auth.BatchAuthChecker(room_version)
         for e in itertools.chain(auth_events, state, [event]):
             auth_for_e = {
                 (event_map[e_id].type, event_map[e_id].state_key): event_map[e_id]
@@ -1715,7 +1957,7 @@ class FederationHandler(BaseHandler):
                 auth_for_e[(EventTypes.Create, "")] = create_event
 
             try:
-                self.auth.check(room_version, e, auth_events=auth_for_e)
+                auth_checker.check(e, auth_events=auth_for_e)
             except SynapseError as err:
                 # we may get SynapseErrors here as well as AuthErrors. For
                 # instance, there are a couple of (ancient) events in some
@@ -21,6 +21,7 @@ from twisted.python.failure import Failure
 from synapse.api.constants import EventTypes, Membership
 from synapse.api.errors import SynapseError
 from synapse.events.utils import serialize_event
+from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.storage.state import StateFilter
 from synapse.types import RoomStreamToken
 from synapse.util.async_helpers import ReadWriteLock
@@ -79,6 +80,9 @@ class PaginationHandler(object):
         # map from purge id to PurgeStatus
         self._purges_by_id = {}
 
+        # the rooms we are backfilling the next page of history for
+        self._backfill_prefetches_by_room = set()
+
     def start_purge_history(self, room_id, token,
                             delete_local_events=False):
         """Start off a history purge on a room.
@@ -150,6 +154,34 @@ class PaginationHandler(object):
                 del self._purges_by_id[purge_id]
             self.hs.get_reactor().callLater(24 * 3600, clear_purge)
 
+    def _start_prefetch_backfill(self, room_id, depth):
+        if room_id in self._backfill_prefetches_by_room:
+            return
+
+        return run_as_background_process(
+            "prefetch_backfill", self._prefetch_backfill, room_id, depth,
+        )
+
+    @defer.inlineCallbacks
+    def _prefetch_backfill(self, room_id, depth):
+        """Backfills the page of history before the one a client has just
+        paginated back to, so that their next request can be served from the
+        database.
+
+        Args:
+            room_id (str): The room to backfill
+            depth (int): the depth of the oldest event in the page the client
+                has just been sent
+        """
+        self._backfill_prefetches_by_room.add(room_id)
+        try:
+            with (yield self.pagination_lock.read(room_id)):
+                yield self.hs.get_handlers().federation_handler.maybe_backfill(
+                    room_id, depth,
+                )
+        finally:
+            self._backfill_prefetches_by_room.discard(room_id)
+
     def get_purge_status(self, purge_id):
         """Get the current status of an active purge
 
@@ -201,6 +233,7 @@ class PaginationHandler(object):
                 room_id, user_id
             )
 
+            backfilled = False
             if source_config.direction == 'b':
                 # if we're going backwards, we might need to backfill. This
                 # requires that we have a topo token.
@@ -222,8 +255,10 @@ class PaginationHandler(object):
                     if leave_token.topological < max_topo:
                         source_config.from_key = str(leave_token)
 
-                yield self.hs.get_handlers().federation_handler.maybe_backfill(
-                    room_id, max_topo
+                backfilled = yield (
+                    self.hs.get_handlers().federation_handler.maybe_backfill(
+                        room_id, max_topo
+                    )
                 )
 
             events, next_key = yield self.store.paginate_room_events(
@@ -235,6 +270,11 @@ class PaginationHandler(object):
                 event_filter=event_filter,
             )
 
+            if backfilled and events:
+                # the client is likely to carry on paginating, so fetch the
+                # page before this one in the background.
+                self._start_prefetch_backfill(room_id, events[-1].depth)
+
             next_token = pagin_config.from_token.copy_and_replace(
                 "room_key", next_key
             )
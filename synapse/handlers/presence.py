@@ -1305,7 +1305,7 @@ def get_interested_parties(store, states):
 
 
 @defer.inlineCallbacks
-def get_interested_remotes(store, states, state_handler):
+def get_interested_remotes(store, states):
     """Given a list of presence states figure out which remote servers
     should be sent which.
 
@@ -1328,7 +1328,7 @@ def get_interested_remotes(store, states, state_handler):
     room_ids_to_states, users_to_states = yield get_interested_parties(store, states)
 
     for room_id, states in iteritems(room_ids_to_states):
-        hosts = yield state_handler.get_current_hosts_in_room(room_id)
+        hosts = yield store.get_hosts_in_room(room_id)
         hosts_and_states.append((hosts, states))
 
     for user_id, states in iteritems(users_to_states):
@@ -17,7 +17,6 @@ import logging
 from twisted.internet import defer
 
 from synapse.metrics.background_process_metrics import run_as_background_process
-from synapse.types import get_domain_from_id
 
 from ._base import BaseHandler
 
@@ -36,7 +35,6 @@ class ReceiptsHandler(BaseHandler):
             "m.receipt", self._received_remote_receipt
         )
         self.clock = self.hs.get_clock()
-        self.state = hs.get_state_handler()
 
     @defer.inlineCallbacks
     def received_client_receipt(self, room_id, receipt_type, user_id,
@@ -140,9 +138,8 @@ class ReceiptsHandler(BaseHandler):
             event_ids = receipt["event_ids"]
             data = receipt["data"]
 
-            users = yield self.state.get_current_user_in_room(room_id)
-            remotedomains = set(get_domain_from_id(u) for u in users)
-            remotedomains = remotedomains.copy()
+            hosts = yield self.store.get_hosts_in_room(room_id)
+            remotedomains = set(hosts)
             remotedomains.discard(self.server_name)
 
             logger.debug("Sending receipt to: %r", remotedomains)
@@ -15,25 +15,34 @@
 # limitations under the License.
 
 import collections
+import heapq
 import itertools
 import logging
+import random
+from contextlib import contextmanager
 
 from six import iteritems, itervalues
 
-from prometheus_client import Counter
+from canonicaljson import encode_canonical_json
+from prometheus_client import Counter, Histogram
 
 from twisted.internet import defer
 
-from synapse.api.constants import EventTypes, Membership
+from synapse.api.constants import EventTypes, Membership, PresenceState
+from synapse.metrics import LaterGauge
+from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.push.clientformat import format_push_rules_for_user
 from synapse.storage.roommember import MemberSummary
 from synapse.storage.state import StateFilter
 from synapse.types import RoomStreamToken
 from synapse.util.async_helpers import concurrently_execute
 from synapse.util.caches.expiringcache import ExpiringCache
-from synapse.util.caches.lrucache import LruCache
 from synapse.util.caches.response_cache import ResponseCache
-from synapse.util.logcontext import LoggingContext
+from synapse.util.logcontext import (
+    LoggingContext,
+    PreserveLoggingContext,
+    make_deferred_yieldable,
+)
 from synapse.util.metrics import Measure, measure_func
 from synapse.visibility import filter_events_for_client
 
@@ -52,13 +61,52 @@ non_empty_sync_counter = Counter(
     ["type", "lazy_loaded"],
 )
 
-# Store the cache that tracks which lazy-loaded members have been sent to a given
-# client for no more than 30 minutes.
-LAZY_LOADED_MEMBERS_CACHE_MAX_AGE = 30 * 60 * 1000
+# Keep the snapshot of a sync response for 5 minutes after it was generated. A
+# client that comes back later than that gets a fresh computation.
+SYNC_SNAPSHOT_CACHE_MAX_AGE = 5 * 60 * 1000
+
+# The most sync snapshots to keep at once. Each active device normally only
+# needs the snapshot for its latest response.
+SYNC_SNAPSHOT_CACHE_MAX_ENTRIES = 10000
+
+# Stop maintaining a precomputed initial sync response once it hasn't been used
+# for a day.
+INITIAL_SYNC_CACHE_MAX_IDLE = 24 * 60 * 60 * 1000
+
+# Counts initial syncs by users with precomputed initial sync responses.
+# `result` is "hit" if we had a response for the device and filter, "miss"
+# otherwise.
+initial_sync_cache_counter = Counter(
+    "synapse_handlers_sync_initial_sync_cache_total",
+    "Count of initial syncs served (or not) from a precomputed response",
+    ["result"],
+)
+
+# Counts whether an incremental sync could be built on top of the snapshot of
+# the sync response that produced its `since` token. `result` is "hit" or
+# "miss".
+sync_snapshot_counter = Counter(
+    "synapse_handlers_sync_snapshot_total",
+    "Count of incremental syncs which could (or could not) reuse the snapshot "
+    "of the previous sync response",
+    ["result"],
+)
+
+# Counts incremental syncs which we could tell had nothing new for the client
+# without computing them.
+idle_sync_counter = Counter(
+    "synapse_handlers_sync_idle_total",
+    "Count of incremental syncs answered as empty without being computed",
+)
 
-# Remember the last 100 members we sent to a client for the purposes of
-# avoiding redundantly sending the same lazy-loaded members to the client
-LAZY_LOADED_MEMBERS_CACHE_MAX_SIZE = 100
+# How long syncs waited to be admitted by the SyncAdmissionScheduler. `type` is
+# "incremental" or "initial" (which includes full_state syncs).
+sync_admission_wait_timer = Histogram(
+    "synapse_handlers_sync_admission_wait_seconds",
+    "Time spent waiting for a slot to compute a sync response",
+    ["type"],
+    buckets=[0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60],
+)
 
 
 SyncConfig = collections.namedtuple("SyncConfig", [
@@ -70,6 +118,16 @@ SyncConfig = collections.namedtuple("SyncConfig", [
 ])
 
 
+# A summary of a sync response, which the next incremental sync in the same
+# sequence can build on.
+SyncSnapshot = collections.namedtuple("SyncSnapshot", [
+    "filter_json",  # dict: the filter the response was generated with
+    "room_positions",  # dict[str, str]: room_id -> event ID of the last
+                       # event in that room at the response's stream
+                       # position, before filtering
+])
+
+
 class TimelineBatch(collections.namedtuple("TimelineBatch", [
     "prev_batch",
     "events",
@@ -212,12 +270,30 @@ class SyncHandler(object):
         self.state = hs.get_state_handler()
         self.auth = hs.get_auth()
 
-        # ExpiringCache((User, Device)) -> LruCache(state_key => event_id)
-        self.lazy_loaded_members_cache = ExpiringCache(
-            "lazy_loaded_members_cache", self.clock,
-            max_len=0, expiry_ms=LAZY_LOADED_MEMBERS_CACHE_MAX_AGE,
+        # ExpiringCache((user_id, device_id, next_batch)) -> SyncSnapshot
+        self.sync_snapshot_cache = ExpiringCache(
+            "sync_snapshot_cache", self.clock,
+            max_len=SYNC_SNAPSHOT_CACHE_MAX_ENTRIES,
+            expiry_ms=SYNC_SNAPSHOT_CACHE_MAX_AGE,
         )
 
+        self._sync_timeout_jitter = hs.config.sync_timeout_jitter
+        self._admission_scheduler = SyncAdmissionScheduler(
+            hs.config.sync_max_concurrent_computations,
+        )
+
+        self._initial_sync_cache_users = hs.config.initial_sync_cache_users
+
+        # dict((user_id, filter)) -> InitialSyncCacheEntry
+        self._initial_sync_cache = {}
+        self._refreshing_initial_sync_cache = False
+
+        if self._initial_sync_cache_users:
+            self.clock.looping_call(
+                self._start_refresh_initial_sync_cache,
+                hs.config.initial_sync_cache_refresh_interval,
+            )
+
     @defer.inlineCallbacks
     def wait_for_sync_for_user(self, sync_config, since_token=None, timeout=0,
                                full_state=False):
@@ -254,18 +330,24 @@ class SyncHandler(object):
         if context:
             context.tag = sync_type
 
-        if timeout == 0 or since_token is None or full_state:
-            # we are going to return immediately, so don't bother calling
-            # notifier.wait_for_events.
+        if since_token is None or full_state:
             result = yield self.current_sync_for_user(
                 sync_config, since_token, full_state=full_state,
             )
+        elif timeout == 0:
+            # we are going to return immediately, so don't bother calling
+            # notifier.wait_for_events.
+            result = yield self._incremental_sync_if_changed(
+                sync_config, since_token,
+            )
         else:
             def current_sync_callback(before_token, after_token):
-                return self.current_sync_for_user(sync_config, since_token)
+                return self._incremental_sync_if_changed(sync_config, since_token)
 
             result = yield self.notifier.wait_for_events(
-                sync_config.user.to_string(), timeout, current_sync_callback,
+                sync_config.user.to_string(),
+                self._jitter_timeout(timeout),
+                current_sync_callback,
                 from_token=since_token,
             )
 
@@ -278,13 +360,242 @@ class SyncHandler(object):
 
         defer.returnValue(result)
 
+    def _incremental_sync_if_changed(self, sync_config, since_token):
+        """Get an incremental sync for the client, unless the notifier can
+        tell us that nothing has happened for the user since `since_token`, in
+        which case an empty response is returned without computing one.
+
+        Args:
+            sync_config (SyncConfig)
+            since_token (StreamToken)
+
+        Returns:
+            Deferred[SyncResult]
+        """
+        user_id = sync_config.user.to_string()
+        if self.notifier.has_changed_for_user_since(user_id, since_token):
+            return self.current_sync_for_user(sync_config, since_token)
+
+        idle_sync_counter.inc()
+        return self._empty_sync_result(sync_config, since_token)
+
+    @defer.inlineCallbacks
+    def _empty_sync_result(self, sync_config, since_token):
+        """Build an incremental sync response with no updates in it.
+
+        Args:
+            sync_config (SyncConfig)
+            since_token (StreamToken): the token the client synced from, which
+                is also the one it should sync from next.
+
+        Returns:
+            Deferred[SyncResult]
+        """
+        # One-time key counts go down as other users claim keys, which doesn't
+        # wake the client up, so we look them up regardless.
+        one_time_key_counts = {}
+        if sync_config.device_id:
+            one_time_key_counts = yield self.store.count_e2e_one_time_keys(
+                sync_config.user.to_string(), sync_config.device_id,
+            )
+
+        defer.returnValue(SyncResult(
+            presence=[],
+            account_data=[],
+            joined=[],
+            invited=[],
+            archived=[],
+            to_device=[],
+            device_lists=DeviceLists(changed=[], left=[]),
+            groups=GroupsSyncResult(join={}, invite={}, leave={}),
+            device_one_time_keys_count=one_time_key_counts,
+            next_batch=since_token,
+        ))
+
+    def _jitter_timeout(self, timeout):
+        """Shorten a long-poll timeout by a random fraction of up to
+        `sync_timeout_jitter`, so that clients which started syncing together
+        (e.g. after a restart) don't all come back at the same moment.
+
+        Args:
+            timeout (int): the timeout the client asked for, in ms.
+
+        Returns:
+            int
+        """
+        if not self._sync_timeout_jitter:
+            return timeout
+        return timeout - int(timeout * self._sync_timeout_jitter * random.random())
+
+    @defer.inlineCallbacks
     def current_sync_for_user(self, sync_config, since_token=None,
                               full_state=False):
         """Get the sync for client needed to match what the server has now.
         Returns:
             A Deferred SyncResult.
         """
-        return self.generate_sync_result(sync_config, since_token, full_state)
+        is_initial = since_token is None or full_state
+
+        start = self.clock.time()
+        with (yield self._admission_scheduler.admit(is_initial)):
+            sync_admission_wait_timer.labels(
+                "initial" if is_initial else "incremental",
+            ).observe(self.clock.time() - start)
+
+            if (
+                since_token is None
+                and not full_state
+                and sync_config.user.to_string() in self._initial_sync_cache_users
+            ):
+                result = yield self._get_initial_sync_from_cache(sync_config)
+            else:
+                result = yield self.generate_sync_result(
+                    sync_config, since_token, full_state,
+                )
+
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def _get_initial_sync_from_cache(self, sync_config):
+        """Get an initial sync for the client from the precomputed responses,
+        computing (and then maintaining) one if we don't have it yet.
+
+        The response will be as of the last time it was refreshed, so the
+        client's next incremental sync brings it up to date. The to-device
+        messages and one-time key counts are always fetched afresh, as they
+        are consumed by the client.
+
+        Args:
+            sync_config (SyncConfig)
+
+        Returns:
+            Deferred[SyncResult]
+        """
+        user_id = sync_config.user.to_string()
+        device_id = sync_config.device_id
+        key = (
+            user_id,
+            encode_canonical_json(sync_config.filter_collection.get_filter_json()),
+        )
+
+        now = self.clock.time_msec()
+        entry = self._initial_sync_cache.get(key)
+        if entry is None:
+            initial_sync_cache_counter.labels("miss").inc()
+
+            result = yield self.generate_sync_result(sync_config)
+
+            # The response is shared by all of the user's devices, so we keep
+            # it up to date without reference to any particular one.
+            self._initial_sync_cache[key] = InitialSyncCacheEntry(
+                sync_config._replace(request_key=None, device_id=None),
+                result, now,
+            )
+            defer.returnValue(result)
+
+        initial_sync_cache_counter.labels("hit").inc()
+        entry.last_used_ms = now
+        result = entry.result
+
+        # We may have sent lazy-loaded members to this device since the
+        # response was computed, so make sure we don't treat them as already
+        # known to the client.
+        if sync_config.filter_collection.lazy_load_members():
+            yield self.store.delete_sent_lazy_loaded_members(
+                user_id, _lazy_loaded_members_device_id(sync_config),
+            )
+
+        now_token = yield self.event_sources.get_current_token()
+        sync_result_builder = SyncResultBuilder(
+            sync_config, full_state=False,
+            since_token=None,
+            now_token=now_token,
+            joined_room_ids=frozenset(),
+        )
+        yield self._generate_sync_entry_for_to_device(sync_result_builder)
+
+        one_time_key_counts = {}
+        if device_id:
+            one_time_key_counts = yield self.store.count_e2e_one_time_keys(
+                user_id, device_id
+            )
+
+        defer.returnValue(result._replace(
+            to_device=sync_result_builder.to_device,
+            device_one_time_keys_count=one_time_key_counts,
+            next_batch=result.next_batch.copy_and_replace(
+                "to_device_key", sync_result_builder.now_token.to_device_key,
+            ),
+        ))
+
+    def _start_refresh_initial_sync_cache(self):
+        return run_as_background_process(
+            "refresh_initial_sync_cache", self._refresh_initial_sync_cache,
+        )
+
+    @defer.inlineCallbacks
+    def _refresh_initial_sync_cache(self):
+        """Brings the precomputed initial sync responses up to date, and drops
+        those which have not been used for a while.
+        """
+        if self._refreshing_initial_sync_cache:
+            # The previous refresh is still going: there's no point starting
+            # another on top of it.
+            return
+
+        self._refreshing_initial_sync_cache = True
+        try:
+            now = self.clock.time_msec()
+            for key, entry in list(self._initial_sync_cache.items()):
+                if now - entry.last_used_ms > INITIAL_SYNC_CACHE_MAX_IDLE:
+                    self._initial_sync_cache.pop(key, None)
+                    continue
+
+                try:
+                    yield self._update_initial_sync_cache_entry(entry)
+                except Exception:
+                    logger.exception(
+                        "Failed to refresh initial sync for %r", key[0],
+                    )
+        finally:
+            self._refreshing_initial_sync_cache = False
+
+    @defer.inlineCallbacks
+    def _update_initial_sync_cache_entry(self, entry):
+        """Brings a precomputed initial sync response up to date, by computing
+        an incremental sync from where it left off and applying that to it.
+
+        Args:
+            entry (InitialSyncCacheEntry)
+
+        Returns:
+            Deferred
+        """
+        sync_config = entry.sync_config
+        user_id = sync_config.user.to_string()
+        since_token = entry.result.next_batch
+
+        if not self.notifier.has_changed_for_user_since(user_id, since_token):
+            return
+
+        delta = yield self.generate_sync_result(
+            sync_config, since_token=since_token,
+            track_lazy_loaded_members=False,
+        )
+
+        # Incremental syncs only mention the rooms the user has left if the
+        # filter asks for them, so we check the memberships directly.
+        joined_room_ids = yield self.get_rooms_for_user_at(
+            user_id, delta.next_batch.room_stream_id,
+        )
+        invites = yield self.store.get_invited_rooms_for_user(user_id)
+
+        entry.result = _apply_sync_delta(
+            entry.result, delta,
+            timeline_limit=sync_config.filter_collection.timeline_limit(),
+            joined_room_ids=joined_room_ids,
+            invited_room_ids=frozenset(invite.room_id for invite in invites),
+        )
 
     @defer.inlineCallbacks
     def push_rules_for_user(self, user):
@@ -358,8 +669,15 @@ class SyncHandler(object):
 
     @defer.inlineCallbacks
     def _load_filtered_recents(self, room_id, sync_config, now_token,
-                               since_token=None, recents=None, newly_joined_room=False):
+                               since_token=None, recents=None, newly_joined_room=False,
+                               prefetched_recents=None):
         """
+        Args:
+            prefetched_recents (tuple[list[FrozenEvent], str]|None): The result
+                of calling `get_recent_events_for_room` for this room with a
+                limit of `_get_recents_load_limit(timeline_limit) + 1` up to
+                `now_token`, if it has already been fetched.
+
         Returns:
             a Deferred TimelineBatch
         """
@@ -399,8 +717,7 @@ class SyncHandler(object):
                     limited=False
                 ))
 
-            filtering_factor = 2
-            load_limit = max(timeline_limit * filtering_factor, 10)
+            load_limit = _get_recents_load_limit(timeline_limit)
             max_repeat = 5  # Only try a few times per room, otherwise
             room_key = now_token.room_key
             end_key = room_key
@@ -415,7 +732,10 @@ class SyncHandler(object):
                 # can just use `get_room_events_stream_for_room`.
                 # Otherwise, we want to return the last N events in the room
                 # in toplogical ordering.
-                if since_key:
+                if prefetched_recents is not None and not since_key:
+                    events, end_key = prefetched_recents
+                    prefetched_recents = None
+                elif since_key:
                     events, end_key = yield self.store.get_room_events_stream_for_room(
                         room_id,
                         limit=load_limit + 1,
@@ -523,7 +843,8 @@ class SyncHandler(object):
         defer.returnValue(state)
 
     @defer.inlineCallbacks
-    def compute_summary(self, room_id, sync_config, batch, state, now_token):
+    def compute_summary(self, room_id, sync_config, batch, state, now_token,
+                        lazy_loaded_members_sent=None):
         """ Works out a room summary block for this room, summarising the number
         of joined members in the room, and providing the 'hero' members if the
         room has no name so clients can consistently name rooms.  Also adds
@@ -537,6 +858,10 @@ class SyncHandler(object):
             state(dict): dict of (type, state_key) -> Event as returned by
                 compute_state_delta
             now_token(str): Token of the end of the current batch.
+            lazy_loaded_members_sent(set[str]|None): The IDs of the membership
+                events being sent to the client in this response, which any
+                hero membership events added to `state` are added to. None if
+                the response is not going to be sent straight away.
 
         Returns:
              A deferred dict describing the room summary
@@ -640,9 +965,6 @@ class SyncHandler(object):
             defer.returnValue(summary)
 
         # ensure we send membership events for heroes if needed
-        cache_key = (sync_config.user.to_string(), sync_config.device_id)
-        cache = self.get_lazy_loaded_members_cache(cache_key)
-
         # track which members the client should already know about via LL:
         # Ones which are already in state...
         existing_members = set(
@@ -659,34 +981,95 @@ class SyncHandler(object):
         missing_hero_event_ids = [
             member_ids[hero_id]
             for hero_id in summary['m.heroes']
-            if (
-                cache.get(hero_id) != member_ids[hero_id] and
-                hero_id not in existing_members
-            )
+            if hero_id not in existing_members
         ]
 
+        if lazy_loaded_members_sent is not None:
+            # ...unless we've sent them to the client before.
+            already_sent = yield self.store.get_sent_lazy_loaded_members(
+                sync_config.user.to_string(),
+                _lazy_loaded_members_device_id(sync_config),
+                (
+                    event_id for event_id in missing_hero_event_ids
+                    if event_id not in lazy_loaded_members_sent
+                ),
+            )
+            missing_hero_event_ids = [
+                event_id for event_id in missing_hero_event_ids
+                if event_id not in already_sent
+                and event_id not in lazy_loaded_members_sent
+            ]
+
         missing_hero_state = yield self.store.get_events(missing_hero_event_ids)
         missing_hero_state = missing_hero_state.values()
 
         for s in missing_hero_state:
-            cache.set(s.state_key, s.event_id)
+            if lazy_loaded_members_sent is not None:
+                lazy_loaded_members_sent.add(s.event_id)
             state[(EventTypes.Member, s.state_key)] = s
 
         defer.returnValue(summary)
 
-    def get_lazy_loaded_members_cache(self, cache_key):
-        cache = self.lazy_loaded_members_cache.get(cache_key)
-        if cache is None:
-            logger.debug("creating LruCache for %r", cache_key)
-            cache = LruCache(LAZY_LOADED_MEMBERS_CACHE_MAX_SIZE)
-            self.lazy_loaded_members_cache[cache_key] = cache
-        else:
-            logger.debug("found LruCache for %r", cache_key)
-        return cache
+    def get_sync_snapshot(self, sync_config, since_token):
+        """Get the snapshot of the sync response which returned `since_token`
+        to this client, if we still have it and it was generated with the same
+        filter.
+
+        Args:
+            sync_config(SyncConfig)
+            since_token(StreamToken|None)
+
+        Returns:
+            SyncSnapshot|None
+        """
+        if since_token is None:
+            return None
+
+        snapshot = self.sync_snapshot_cache.get((
+            sync_config.user.to_string(),
+            sync_config.device_id,
+            since_token.to_string(),
+        ))
+
+        filter_json = sync_config.filter_collection.get_filter_json()
+        if snapshot is None or snapshot.filter_json != filter_json:
+            sync_snapshot_counter.labels("miss").inc()
+            return None
+
+        sync_snapshot_counter.labels("hit").inc()
+        return snapshot
+
+    def store_sync_snapshot(self, sync_result_builder):
+        """Remember a summary of the sync response being returned, so that the
+        next incremental sync from the same client can be built on top of it.
+
+        Args:
+            sync_result_builder(SyncResultBuilder)
+        """
+        sync_config = sync_result_builder.sync_config
+
+        joined_room_ids = sync_result_builder.joined_room_ids
+        room_positions = sync_result_builder.room_positions
+        if any(room_id not in joined_room_ids for room_id in room_positions):
+            room_positions = {
+                room_id: event_id
+                for room_id, event_id in iteritems(room_positions)
+                if room_id in joined_room_ids
+            }
+
+        self.sync_snapshot_cache[(
+            sync_config.user.to_string(),
+            sync_config.device_id,
+            sync_result_builder.now_token.to_string(),
+        )] = SyncSnapshot(
+            filter_json=sync_config.filter_collection.get_filter_json(),
+            room_positions=room_positions,
+        )
 
     @defer.inlineCallbacks
     def compute_state_delta(self, room_id, batch, sync_config, since_token, now_token,
-                            full_state):
+                            full_state, previous_event_id=None,
+                            lazy_loaded_members_sent=None):
         """ Works out the difference in state between the start of the timeline
         and the previous sync.
 
@@ -699,6 +1082,15 @@ class SyncHandler(object):
                 be None.
             now_token(str): Token of the end of the current batch.
             full_state(bool): Whether to force returning the full state.
+            previous_event_id(str|None): The last event in this room at the
+                previous sync's stream position, if known. The state after this
+                event is used as the state at the previous sync.
+            lazy_loaded_members_sent(set[str]|None): The IDs of the membership
+                events being sent to the client in this response so far. When
+                lazy-loading members, membership events which are in here or
+                which were sent by previous syncs in this sync sequence are
+                left out, and those being returned are added to it. None if the
+                response is not going to be sent straight away.
 
         Returns:
              A deferred dict of (type, state_key) -> Event
@@ -786,10 +1178,15 @@ class SyncHandler(object):
                 # about them).
                 state_filter = StateFilter.all()
 
-                state_at_previous_sync = yield self.get_state_at(
-                    room_id, stream_position=since_token,
-                    state_filter=state_filter,
-                )
+                if previous_event_id:
+                    state_at_previous_sync = yield self.store.get_state_ids_for_event(
+                        previous_event_id, state_filter=state_filter,
+                    )
+                else:
+                    state_at_previous_sync = yield self.get_state_at(
+                        room_id, stream_position=since_token,
+                        state_filter=state_filter,
+                    )
 
                 current_state_ids = yield self.store.get_state_ids_for_event(
                     batch.events[-1].event_id, state_filter=state_filter,
@@ -824,35 +1221,44 @@ class SyncHandler(object):
                             ),
                         )
 
-            if lazy_load_members and not include_redundant_members:
-                cache_key = (sync_config.user.to_string(), sync_config.device_id)
-                cache = self.get_lazy_loaded_members_cache(cache_key)
-
+            if (
+                lazy_load_members
+                and not include_redundant_members
+                and lazy_loaded_members_sent is not None
+            ):
                 # if it's a new sync sequence, then assume the client has had
                 # amnesia and doesn't want any recent lazy-loaded members
-                # de-duplicated.
-                if since_token is None:
-                    logger.debug("clearing LruCache for %r", cache_key)
-                    cache.clear()
-                else:
-                    # only send members which aren't in our LruCache (either
-                    # because they're new to this client or have been pushed out
-                    # of the cache)
+                # de-duplicated. (`generate_sync_result` forgets what was sent
+                # by previous sequences.)
+                if since_token is not None:
+                    # only send members which the client hasn't already been
+                    # sent.
+                    already_sent = yield self.store.get_sent_lazy_loaded_members(
+                        sync_config.user.to_string(),
+                        _lazy_loaded_members_device_id(sync_config),
+                        (
+                            event_id for (typ, _), event_id in iteritems(state_ids)
+                            if typ == EventTypes.Member
+                            and event_id not in lazy_loaded_members_sent
+                        ),
+                    )
                     logger.debug("filtering state from %r...", state_ids)
                     state_ids = {
                         t: event_id
                         for t, event_id in iteritems(state_ids)
-                        if cache.get(t[1]) != event_id
+                        if event_id not in already_sent
+                        and event_id not in lazy_loaded_members_sent
                     }
                     logger.debug("...to %r", state_ids)
 
-                # add any member IDs we are about to send into our LruCache
+                # add any member IDs we are about to send to the ones we record
+                # as sent
                 for t, event_id in itertools.chain(
                     state_ids.items(),
                     timeline_state.items(),
                 ):
                     if t[0] == EventTypes.Member:
-                        cache.set(t[1], event_id)
+                        lazy_loaded_members_sent.add(event_id)
 
         state = {}
         if state_ids:
@@ -884,13 +1290,46 @@ class SyncHandler(object):
         defer.returnValue(None)
 
     @defer.inlineCallbacks
-    def generate_sync_result(self, sync_config, since_token=None, full_state=False):
+    def unread_notifs_for_room_ids(self, room_ids, sync_config):
+        """Batched version of `unread_notifs_for_room_id`.
+
+        Args:
+            room_ids (Iterable[str])
+            sync_config (SyncConfig)
+
+        Returns:
+            Deferred[dict[str, dict|None]]: map from room_id to the result of
+            `unread_notifs_for_room_id` for that room.
+        """
+        with Measure(self.clock, "unread_notifs_for_room_ids"):
+            user_id = sync_config.user.to_string()
+
+            receipts = yield self.store.get_receipts_for_user(user_id, "m.read")
+
+            last_read_event_ids = {
+                room_id: receipts[room_id]
+                for room_id in room_ids
+                if receipts.get(room_id)
+            }
+
+            notifs = yield self.store.get_unread_event_push_actions_by_rooms_for_user(
+                user_id, last_read_event_ids,
+            )
+
+        defer.returnValue({room_id: notifs.get(room_id) for room_id in room_ids})
+
+    @defer.inlineCallbacks
+    def generate_sync_result(self, sync_config, since_token=None, full_state=False,
+                             track_lazy_loaded_members=True):
         """Generates a sync result.
 
         Args:
             sync_config (SyncConfig)
             since_token (StreamToken)
             full_state (bool)
+            track_lazy_loaded_members (bool): Whether to record the lazy-loaded
+                members in the result as sent to the client. False if the
+                result is not going to be sent straight away.
 
         Returns:
             Deferred(SyncResult)
@@ -917,11 +1356,29 @@ class SyncHandler(object):
                 user_id, now_token.room_stream_id,
             )
 
+        snapshot = None
+        if not full_state:
+            snapshot = self.get_sync_snapshot(sync_config, since_token)
+
+        track_lazy_loaded_members = (
+            track_lazy_loaded_members
+            and sync_config.filter_collection.lazy_load_members()
+            and not sync_config.filter_collection.include_redundant_members()
+        )
+        if track_lazy_loaded_members and since_token is None:
+            # This is a new sync sequence, so forget about any members that
+            # were sent by previous ones.
+            yield self.store.delete_sent_lazy_loaded_members(
+                user_id, _lazy_loaded_members_device_id(sync_config),
+            )
+
         sync_result_builder = SyncResultBuilder(
             sync_config, full_state,
             since_token=since_token,
             now_token=now_token,
             joined_room_ids=joined_room_ids,
+            snapshot=snapshot,
+            track_lazy_loaded_members=track_lazy_loaded_members,
         )
 
         account_data_by_room = yield self._generate_sync_entry_for_account_data(
@@ -962,6 +1419,14 @@ class SyncHandler(object):
 
         yield self._generate_sync_entry_for_groups(sync_result_builder)
 
+        if sync_result_builder.lazy_loaded_members_sent:
+            yield self.store.add_sent_lazy_loaded_members(
+                user_id, _lazy_loaded_members_device_id(sync_config),
+                sync_result_builder.lazy_loaded_members_sent,
+            )
+
+        self.store_sync_snapshot(sync_result_builder)
+
         defer.returnValue(SyncResult(
             presence=sync_result_builder.presence,
             account_data=sync_result_builder.account_data,
@@ -1287,6 +1752,8 @@ class SyncHandler(object):
 
             tags_by_room = yield self.store.get_tags_for_user(user_id)
 
+        yield self._prefetch_for_room_entries(sync_result_builder, room_entries)
+
         def handle_room_entries(room_entry):
             return self._generate_room_entry(
                 sync_result_builder,
@@ -1329,6 +1796,51 @@ class SyncHandler(object):
             newly_left_users,
         ))
 
+    @defer.inlineCallbacks
+    def _prefetch_for_room_entries(self, sync_result_builder, room_entries):
+        """Fetches, for all of `room_entries` at once, the data that
+        `_generate_room_entry` would otherwise look up for each room in turn.
+
+        Populates `prefetched_recents` and `prefetched_unread_notifs` of
+        `sync_result_builder`.
+
+        Args:
+            sync_result_builder(SyncResultBuilder)
+            room_entries(list[RoomSyncResultBuilder])
+        """
+        sync_config = sync_result_builder.sync_config
+        filter_collection = sync_config.filter_collection
+        now_room_key = sync_result_builder.now_token.room_key
+
+        # Rooms whose timeline we'd have to load from scratch, i.e. all of
+        # them on an initial sync.
+        rooms_needing_recents = [
+            room_entry.room_id for room_entry in room_entries
+            if room_entry.events is None
+            and room_entry.rtype == "joined"
+            and room_entry.upto_token.room_key == now_room_key
+        ]
+        if rooms_needing_recents and not filter_collection.blocks_all_room_timeline():
+            load_limit = _get_recents_load_limit(filter_collection.timeline_limit())
+            sync_result_builder.prefetched_recents = (
+                yield self.store.get_recent_events_for_rooms(
+                    rooms_needing_recents,
+                    limit=load_limit + 1,
+                    end_token=now_room_key,
+                )
+            )
+
+        # Unread counts get looked up for every joined room which ends up in the
+        # response, which we can do in one go.
+        joined_room_ids = [
+            room_entry.room_id for room_entry in room_entries
+            if room_entry.rtype == "joined"
+        ]
+        if joined_room_ids:
+            sync_result_builder.prefetched_unread_notifs = (
+                yield self.unread_notifs_for_room_ids(joined_room_ids, sync_config)
+            )
+
     @defer.inlineCallbacks
     def _have_rooms_changed(self, sync_result_builder):
         """Returns whether there may be any new events that should be sent down
@@ -1661,8 +2173,24 @@ class SyncHandler(object):
             since_token=since_token,
             recents=events,
             newly_joined_room=newly_joined,
+            prefetched_recents=sync_result_builder.prefetched_recents.get(room_id),
         )
 
+        # Remember the last event in the room at this point in the stream,
+        # before any filtering, so that the next sync can use the state after
+        # it as the state at its since token. The recent events we have
+        # fetched for an initial sync are in topological order, so we look it
+        # up by stream ordering instead.
+        if events:
+            sync_result_builder.record_room_position(room_id, events[-1].event_id)
+        elif events is None:
+            last_event_id = yield (
+                self.store.get_last_event_in_room_before_stream_ordering(
+                    room_id, upto_token.room_key,
+                )
+            )
+            sync_result_builder.record_room_position(room_id, last_event_id)
+
         # When we join the room (or the client requests full_state), we should
         # send down any existing tags. Usually the user won't have tags in a
         # newly joined room, unless either a) they've joined before or b) the
@@ -1702,9 +2230,17 @@ class SyncHandler(object):
                 or full_state):
             return
 
+        previous_event_id = None
+        if since_token:
+            previous_event_id = sync_result_builder.previous_room_positions.get(
+                room_id,
+            )
+
         state = yield self.compute_state_delta(
             room_id, batch, sync_config, since_token, now_token,
-            full_state=full_state
+            full_state=full_state,
+            previous_event_id=previous_event_id,
+            lazy_loaded_members_sent=sync_result_builder.lazy_loaded_members_sent,
         )
 
         summary = {}
@@ -1730,7 +2266,8 @@ class SyncHandler(object):
             )
         ):
             summary = yield self.compute_summary(
-                room_id, sync_config, batch, state, now_token
+                room_id, sync_config, batch, state, now_token,
+                lazy_loaded_members_sent=sync_result_builder.lazy_loaded_members_sent,
             )
 
         if room_builder.rtype == "joined":
@@ -1746,9 +2283,12 @@ class SyncHandler(object):
             )
 
             if room_sync or always_include:
-                notifs = yield self.unread_notifs_for_room_id(
-                    room_id, sync_config
-                )
+                if room_id in sync_result_builder.prefetched_unread_notifs:
+                    notifs = sync_result_builder.prefetched_unread_notifs[room_id]
+                else:
+                    notifs = yield self.unread_notifs_for_room_id(
+                        room_id, sync_config
+                    )
 
                 if notifs is not None:
                     unread_notifications["notification_count"] = notifs["notify_count"]
@@ -1826,6 +2366,241 @@ class SyncHandler(object):
         defer.returnValue(joined_room_ids)
 
 
+def _get_recents_load_limit(timeline_limit):
+    """Works out how many events to load at a time when filling the timeline
+    of a room, allowing for some of them being filtered out.
+
+    Args:
+        timeline_limit (int): The timeline limit of the filter.
+
+    Returns:
+        int
+    """
+    filtering_factor = 2
+    return max(timeline_limit * filtering_factor, 10)
+
+
+def _lazy_loaded_members_device_id(sync_config):
+    """The device ID to record lazy-loaded members as sent to. Access tokens
+    which predate devices have no device ID, so we share a single entry for
+    all of them.
+
+    Args:
+        sync_config (SyncConfig)
+
+    Returns:
+        str
+    """
+    return sync_config.device_id or ""
+
+
+def _apply_sync_delta(result, delta, timeline_limit, joined_room_ids,
+                      invited_room_ids):
+    """Brings an initial sync response up to date by applying an incremental
+    sync response which follows on from it.
+
+    The result is what an initial sync would return as of `delta`, except that
+    lazy-loaded members which are no longer needed are not removed from the
+    state, which clients are expected to cope with.
+
+    Args:
+        result (SyncResult): The initial sync response.
+        delta (SyncResult): An incremental sync response from
+            `result.next_batch`, generated with the same config.
+        timeline_limit (int): The timeline limit of the filter.
+        joined_room_ids (frozenset[str]): The rooms the user is joined to as
+            of `delta.next_batch`.
+        invited_room_ids (frozenset[str]): The rooms the user is invited to.
+
+    Returns:
+        SyncResult
+    """
+    joined = collections.OrderedDict((r.room_id, r) for r in result.joined)
+    invited = collections.OrderedDict((r.room_id, r) for r in result.invited)
+    archived = collections.OrderedDict((r.room_id, r) for r in result.archived)
+
+    for room in delta.invited:
+        joined.pop(room.room_id, None)
+        archived.pop(room.room_id, None)
+        invited[room.room_id] = room
+
+    for rooms, room_result in ((delta.joined, joined), (delta.archived, archived)):
+        for room in rooms:
+            previous = (
+                joined.pop(room.room_id, None)
+                or archived.pop(room.room_id, None)
+            )
+            invited.pop(room.room_id, None)
+            if previous is not None:
+                room = _apply_room_sync_delta(previous, room, timeline_limit)
+            room_result[room.room_id] = room
+
+    presence = {p.user_id: p for p in result.presence}
+    presence.update((p.user_id, p) for p in delta.presence)
+
+    groups = GroupsSyncResult(
+        join=dict(result.groups.join),
+        invite=dict(result.groups.invite),
+        leave=dict(result.groups.leave),
+    )
+    for group_id, content in iteritems(delta.groups.join):
+        groups.invite.pop(group_id, None)
+        groups.leave.pop(group_id, None)
+        groups.join.setdefault(group_id, {}).update(content)
+    for group_id, content in iteritems(delta.groups.invite):
+        groups.leave.pop(group_id, None)
+        groups.invite[group_id] = content
+    for group_id, content in iteritems(delta.groups.leave):
+        groups.join.pop(group_id, None)
+        groups.invite.pop(group_id, None)
+        groups.leave[group_id] = content
+
+    return result._replace(
+        presence=[
+            p for p in itervalues(presence) if p.state != PresenceState.OFFLINE
+        ],
+        account_data=_apply_account_data_delta(
+            result.account_data, delta.account_data,
+        ),
+        joined=[r for r in itervalues(joined) if r.room_id in joined_room_ids],
+        invited=[r for r in itervalues(invited) if r.room_id in invited_room_ids],
+        archived=list(itervalues(archived)),
+        groups=groups,
+        next_batch=delta.next_batch,
+    )
+
+
+def _apply_room_sync_delta(previous, room, timeline_limit):
+    """Applies a room's entry in an incremental sync response to its entry in
+    the initial sync response it follows on from.
+
+    Args:
+        previous (JoinedSyncResult|ArchivedSyncResult): The room in the initial
+            sync response.
+        room (JoinedSyncResult|ArchivedSyncResult): The room in the incremental
+            sync response.
+        timeline_limit (int): The timeline limit of the filter.
+
+    Returns:
+        JoinedSyncResult|ArchivedSyncResult: of the same type as `room`.
+    """
+    previous_events = list(previous.timeline.events)
+    if room.timeline.limited:
+        # There is a gap between the two timelines, so only the new one is
+        # any use.
+        events = list(room.timeline.events)
+        dropped = previous_events
+        timeline = room.timeline
+    else:
+        # The new timeline is no longer than the limit, so only the old
+        # events can need dropping.
+        events = previous_events + list(room.timeline.events)
+        dropped = events[:max(len(events) - timeline_limit, 0)]
+        events = events[len(dropped):]
+
+        if not dropped:
+            timeline = previous.timeline._replace(events=events)
+        elif events:
+            timeline = TimelineBatch(
+                events=events,
+                prev_batch=room.timeline.prev_batch.copy_and_replace(
+                    "room_key", events[0].internal_metadata.before,
+                ),
+                limited=True,
+            )
+        else:
+            timeline = room.timeline._replace(events=events, limited=True)
+
+    # The state at the start of the timeline is the state at the start of the
+    # old one, with any events which have dropped off the front of the
+    # timeline and then the state from the incremental sync applied. Anything
+    # which is in the timeline itself is left out.
+    state = dict(previous.state)
+    for event in dropped:
+        if event.is_state():
+            state[(event.type, event.state_key)] = event
+    state.update(room.state)
+
+    timeline_event_ids = set(e.event_id for e in events)
+    state = {
+        key: event for key, event in iteritems(state)
+        if event.event_id not in timeline_event_ids
+    }
+
+    room = room._replace(
+        timeline=timeline,
+        state=state,
+        account_data=_apply_account_data_delta(
+            previous.account_data, room.account_data,
+        ),
+    )
+
+    if isinstance(room, JoinedSyncResult) and isinstance(previous, JoinedSyncResult):
+        room = room._replace(
+            ephemeral=_apply_ephemeral_delta(previous.ephemeral, room.ephemeral),
+            summary=room.summary or previous.summary,
+        )
+
+    return room
+
+
+def _apply_account_data_delta(account_data, delta):
+    """Merges lists of account data events, with those in `delta` replacing
+    any of the same type in `account_data`.
+
+    Args:
+        account_data (list[dict])
+        delta (list[dict])
+
+    Returns:
+        list[dict]
+    """
+    by_type = collections.OrderedDict((e["type"], e) for e in account_data)
+    by_type.update((e["type"], e) for e in delta)
+    return list(itervalues(by_type))
+
+
+def _apply_ephemeral_delta(ephemeral, delta):
+    """Merges lists of ephemeral events for a room, keeping the latest typing
+    notification and the latest receipt of each type from each user.
+
+    Args:
+        ephemeral (list[dict])
+        delta (list[dict])
+
+    Returns:
+        list[dict]
+    """
+    others = []
+    typing = None
+    # (receipt_type, user_id) -> (event_id, receipt)
+    receipts = collections.OrderedDict()
+    for event in itertools.chain(ephemeral, delta):
+        if event["type"] == "m.typing":
+            typing = event
+        elif event["type"] == "m.receipt":
+            for event_id, content in iteritems(event["content"]):
+                for receipt_type, user_receipts in iteritems(content):
+                    for user_id, receipt in iteritems(user_receipts):
+                        receipts.pop((receipt_type, user_id), None)
+                        receipts[(receipt_type, user_id)] = (event_id, receipt)
+        else:
+            others.append(event)
+
+    if typing is not None:
+        others.append(typing)
+
+    if receipts:
+        content = {}
+        for (receipt_type, user_id), (event_id, receipt) in iteritems(receipts):
+            content.setdefault(event_id, {}).setdefault(
+                receipt_type, {},
+            )[user_id] = receipt
+        others.append({"type": "m.receipt", "content": content})
+
+    return others
+
+
 def _action_has_highlight(actions):
     for action in actions:
         try:
@@ -1893,16 +2668,127 @@ def _calculate_state(
     }
 
 
+class SyncAdmissionScheduler(object):
+    """Limits how many sync responses are computed at once.
+
+    Syncs beyond the limit are queued, and incremental syncs are admitted
+    before initial (and full_state) syncs, as they are much cheaper and are
+    what keeps connected clients up to date. Within a priority, syncs are
+    admitted in the order they arrived.
+
+    Example:
+
+        with (yield scheduler.admit(is_initial)):
+            # compute the sync response
+    """
+
+    def __init__(self, max_concurrent):
+        """
+        Args:
+            max_concurrent (int): the maximum number of syncs to compute at
+                once. 0 means no limit.
+        """
+        self.max_concurrent = max_concurrent
+        self._running = 0
+
+        # heap of (is_initial, sequence number, Deferred)
+        self._queue = []
+        self._seq = itertools.count()
+
+        LaterGauge(
+            "synapse_handlers_sync_admission_running", "", [],
+            lambda: self._running,
+        )
+        LaterGauge(
+            "synapse_handlers_sync_admission_queue_depth", "", ["type"],
+            self._get_queue_depths,
+        )
+
+    def _get_queue_depths(self):
+        depths = {("incremental",): 0, ("initial",): 0}
+        for is_initial, _, d in self._queue:
+            if not d.called:
+                depths[("initial",) if is_initial else ("incremental",)] += 1
+        return depths
+
+    def admit(self, is_initial):
+        """Wait for a slot to compute a sync response.
+
+        Args:
+            is_initial (bool): whether this is an initial (or full_state) sync,
+                which is admitted after any queued incremental syncs.
+
+        Returns:
+            Deferred[ContextManager]: resolves once the sync may be computed.
+                The slot is released when the context manager exits.
+        """
+        if not self.max_concurrent or self._running < self.max_concurrent:
+            self._running += 1
+            res = defer.succeed(None)
+        else:
+            d = defer.Deferred()
+            heapq.heappush(self._queue, (is_initial, next(self._seq), d))
+            res = make_deferred_yieldable(d)
+
+        @contextmanager
+        def _ctx_manager(_):
+            try:
+                yield
+            finally:
+                self._release()
+
+        res.addCallback(_ctx_manager)
+        return res
+
+    def _release(self):
+        # Hand the slot straight over to the next queued sync, skipping any
+        # that have been cancelled while they waited.
+        while self._queue:
+            _, _, d = heapq.heappop(self._queue)
+            if not d.called:
+                with PreserveLoggingContext():
+                    d.callback(None)
+                return
+
+        self._running -= 1
+
+
+class InitialSyncCacheEntry(object):
+    """A precomputed response to an initial sync for a particular user and
+    filter.
+    """
+    __slots__ = ["sync_config", "result", "last_used_ms"]
+
+    def __init__(self, sync_config, result, last_used_ms):
+        """
+        Args:
+            sync_config(SyncConfig): The config to update the response with.
+                This has no device ID.
+            result(SyncResult): The response.
+            last_used_ms(int): When the response was last served to a client.
+        """
+        self.sync_config = sync_config
+        self.result = result
+        self.last_used_ms = last_used_ms
+
+
 class SyncResultBuilder(object):
     "Used to help build up a new SyncResult for a user"
     def __init__(self, sync_config, full_state, since_token, now_token,
-                 joined_room_ids):
+                 joined_room_ids, snapshot=None, track_lazy_loaded_members=True):
         """
         Args:
             sync_config(SyncConfig)
             full_state(bool): The full_state flag as specified by user
             since_token(StreamToken): The token supplied by user, or None.
             now_token(StreamToken): The token to sync up to.
+            joined_room_ids(frozenset[str]): The rooms the user is joined to
+                at `now_token`.
+            snapshot(SyncSnapshot|None): The snapshot of the sync response
+                which returned `since_token`, if any.
+            track_lazy_loaded_members(bool): Whether to record lazy-loaded
+                members as sent to the client, see
+                `SyncHandler.generate_sync_result`.
         """
         self.sync_config = sync_config
         self.full_state = full_state
@@ -1910,6 +2796,22 @@ class SyncResultBuilder(object):
         self.now_token = now_token
         self.joined_room_ids = joined_room_ids
 
+        # The IDs of the lazy-loaded membership events in the response, which
+        # are recorded as sent to the client once it has been generated. None
+        # if we're not recording them.
+        self.lazy_loaded_members_sent = (
+            set() if track_lazy_loaded_members else None
+        )
+
+        if snapshot:
+            self.previous_room_positions = snapshot.room_positions
+        else:
+            self.previous_room_positions = {}
+
+        # Shared with the previous snapshot until a room's position changes,
+        # so that syncs with nothing new don't copy it.
+        self.room_positions = self.previous_room_positions
+
         self.presence = []
         self.account_data = []
         self.joined = []
@@ -1919,6 +2821,30 @@ class SyncResultBuilder(object):
         self.groups = None
         self.to_device = []
 
+        # Data looked up for many rooms at once by
+        # `SyncHandler._prefetch_for_room_entries`, keyed by room_id.
+        self.prefetched_recents = {}
+        self.prefetched_unread_notifs = {}
+
+    def record_room_position(self, room_id, event_id):
+        """Record the last event in a room up to the point in the stream that
+        the client is being synced to.
+
+        Args:
+            room_id(str)
+            event_id(str|None): the event, or None if it isn't known
+        """
+        if self.room_positions.get(room_id) == event_id:
+            return
+
+        if self.room_positions is self.previous_room_positions:
+            self.room_positions = dict(self.previous_room_positions)
+
+        if event_id is None:
+            self.room_positions.pop(room_id, None)
+        else:
+            self.room_positions[room_id] = event_id
+
 
 class RoomSyncResultBuilder(object):
     """Stores information needed to create either a `JoinedSyncResult` or
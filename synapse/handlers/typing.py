@@ -19,7 +19,7 @@ from collections import namedtuple
 from twisted.internet import defer
 
 from synapse.api.errors import AuthError, SynapseError
-from synapse.types import UserID, get_domain_from_id
+from synapse.types import UserID
 from synapse.util.caches.stream_change_cache import StreamChangeCache
 from synapse.util.logcontext import run_in_background
 from synapse.util.metrics import Measure
@@ -47,7 +47,6 @@ class TypingHandler(object):
         self.auth = hs.get_auth()
         self.is_mine_id = hs.is_mine_id
         self.notifier = hs.get_notifier()
-        self.state = hs.get_state_handler()
 
         self.hs = hs
 
@@ -218,7 +217,7 @@ class TypingHandler(object):
     @defer.inlineCallbacks
     def _push_remote(self, member, typing):
         try:
-            users = yield self.state.get_current_user_in_room(member.room_id)
+            hosts = yield self.store.get_hosts_in_room(member.room_id)
             self._member_last_federation_poke[member] = self.clock.time_msec()
 
             now = self.clock.time_msec()
@@ -228,7 +227,7 @@ class TypingHandler(object):
                 then=now + FEDERATION_PING_INTERVAL,
             )
 
-            for domain in set(get_domain_from_id(u) for u in users):
+            for domain in hosts:
                 if domain != self.server_name:
                     logger.debug("sending typing update to %s", domain)
                     self.federation.send_edu(
@@ -261,10 +260,9 @@ class TypingHandler(object):
             )
             return
 
-        users = yield self.state.get_current_user_in_room(room_id)
-        domains = set(get_domain_from_id(u) for u in users)
+        hosts = yield self.store.get_hosts_in_room(room_id)
 
-        if self.server_name in domains:
+        if self.server_name in hosts:
             logger.info("Got typing update from %s: %r", user_id, content)
             now = self.clock.time_msec()
             self._member_typing_until[member] = now + FEDERATION_TIMEOUT
@@ -16,9 +16,11 @@ import json
 import logging
 import random
 import time
+from collections import OrderedDict
 
 import attr
 from netaddr import IPAddress
+from prometheus_client import Counter, Histogram
 from zope.interface import implementer
 
 from twisted.internet import defer
@@ -31,8 +33,9 @@ from twisted.web.iweb import IAgent
 
 from synapse.http.federation.srv_resolver import SrvResolver, pick_server_from_list
 from synapse.util import Clock
+from synapse.util.async_helpers import ObservableDeferred
 from synapse.util.caches.ttlcache import TTLCache
-from synapse.util.logcontext import make_deferred_yieldable
+from synapse.util.logcontext import make_deferred_yieldable, run_in_background
 from synapse.util.metrics import Measure
 
 # period to cache .well-known results for by default
@@ -50,6 +53,21 @@ WELL_KNOWN_MAX_CACHE_PERIOD = 48 * 3600
 logger = logging.getLogger(__name__)
 well_known_cache = TTLCache('well-known')
 
+connections_opened_counter = Counter(
+    "synapse_http_federation_client_connections_opened",
+    "Number of new connections made to remote servers",
+)
+
+connections_reused_counter = Counter(
+    "synapse_http_federation_client_connections_reused",
+    "Number of requests sent over a pooled connection to a remote server",
+)
+
+connect_timer = Histogram(
+    "synapse_http_federation_client_connect_seconds",
+    "Time taken to resolve and connect to remote servers, not including TLS",
+)
+
 
 @implementer(IAgent)
 class MatrixFederationAgent(object):
@@ -71,6 +89,15 @@ class MatrixFederationAgent(object):
         srv_resolver (SrvResolver|None):
             SRVResolver impl to use for looking up SRV records. None to use a default
             implementation.
+
+        max_connections_per_host (int): the maximum number of idle connections to
+            keep open to each remote server.
+
+        idle_connection_timeout (int): how long to keep idle connections open for,
+            in seconds.
+
+        max_idle_connections (int|None): the maximum number of idle connections to
+            keep open in total, or None for no limit.
     """
 
     def __init__(
@@ -78,6 +105,9 @@ class MatrixFederationAgent(object):
         _well_known_tls_policy=None,
         _srv_resolver=None,
         _well_known_cache=well_known_cache,
+        max_connections_per_host=5,
+        idle_connection_timeout=2 * 60,
+        max_idle_connections=None,
     ):
         self._reactor = reactor
         self._clock = Clock(reactor)
@@ -87,10 +117,10 @@ class MatrixFederationAgent(object):
             _srv_resolver = SrvResolver()
         self._srv_resolver = _srv_resolver
 
-        self._pool = HTTPConnectionPool(reactor)
+        self._pool = _FederationConnectionPool(reactor, max_idle_connections)
         self._pool.retryAutomatically = False
-        self._pool.maxPersistentPerHost = 5
-        self._pool.cachedConnectionTimeout = 2 * 60
+        self._pool.maxPersistentPerHost = max_connections_per_host
+        self._pool.cachedConnectionTimeout = idle_connection_timeout
 
         agent_args = {}
         if _well_known_tls_policy is not None:
@@ -108,6 +138,11 @@ class MatrixFederationAgent(object):
         #   `None`:      there is no (valid) .well-known here
         self._well_known_cache = _well_known_cache
 
+        # .well-known lookups which are in flight, so that concurrent requests to
+        # a server we haven't seen before share a lookup (and a TLS handshake).
+        # Maps from server name to ObservableDeferred.
+        self._well_known_lookups = {}
+
     @defer.inlineCallbacks
     def request(self, method, uri, headers=None, bodyProducer=None):
         """
@@ -290,13 +325,37 @@ class MatrixFederationAgent(object):
         try:
             result = self._well_known_cache[server_name]
         except KeyError:
-            # TODO: should we linearise so that we don't end up doing two .well-known
-            # requests for the same server in parallel?
-            with Measure(self._clock, "get_well_known"):
-                result, cache_period = yield self._do_get_well_known(server_name)
+            lookup = self._well_known_lookups.get(server_name)
+            if lookup is None:
+                d = run_in_background(self._fetch_well_known, server_name)
+                lookup = ObservableDeferred(d, consumeErrors=True)
+                if not lookup.has_called():
+                    self._well_known_lookups[server_name] = lookup
+                    d.addBoth(
+                        lambda _: self._well_known_lookups.pop(server_name, None),
+                    )
+
+            result = yield make_deferred_yieldable(lookup.observe())
 
-            if cache_period > 0:
-                self._well_known_cache.set(server_name, result, cache_period)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def _fetch_well_known(self, server_name):
+        """Fetches the .well-known file for the given server, and caches the
+        result.
+
+        Args:
+            server_name (bytes): name of the server, from the requested url
+
+        Returns:
+            Deferred[bytes|None]: either the new server name, from the .well-known, or
+                None if there was no .well-known file.
+        """
+        with Measure(self._clock, "get_well_known"):
+            result, cache_period = yield self._do_get_well_known(server_name)
+
+        if cache_period > 0:
+            self._well_known_cache.set(server_name, result, cache_period)
 
         defer.returnValue(result)
 
@@ -367,7 +426,65 @@ class LoggingHostnameEndpoint(object):
 
     def connect(self, protocol_factory):
         logger.info("Connecting to %s:%i", self.host.decode("ascii"), self.port)
-        return self.ep.connect(protocol_factory)
+        start = time.time()
+
+        def on_connected(protocol):
+            connect_timer.observe(time.time() - start)
+            return protocol
+
+        return self.ep.connect(protocol_factory).addCallback(on_connected)
+
+
+class _FederationConnectionPool(HTTPConnectionPool):
+    """An HTTPConnectionPool which records whether connections are reused, and
+    can limit the number of idle connections it keeps open in total, as well
+    as per host.
+
+    Args:
+        reactor (IReactor)
+        max_idle_connections (int|None): the maximum number of idle connections
+            to keep open, or None for no limit. When the limit is reached, the
+            connection which has been idle the longest is closed.
+    """
+
+    def __init__(self, reactor, max_idle_connections=None):
+        HTTPConnectionPool.__init__(self, reactor)
+        self._max_idle_connections = max_idle_connections
+
+        # HTTPConnectionPool keeps a timeout for each idle connection, and we
+        # keep them in the order they were added so that we can find the
+        # connection which has been idle the longest.
+        self._timeouts = OrderedDict()
+        self._opened_connection = False
+
+    def getConnection(self, key, endpoint):
+        self._opened_connection = False
+        d = HTTPConnectionPool.getConnection(self, key, endpoint)
+        if not self._opened_connection:
+            connections_reused_counter.inc()
+        return d
+
+    def _newConnection(self, key, endpoint):
+        self._opened_connection = True
+        connections_opened_counter.inc()
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+    def _putConnection(self, key, connection):
+        HTTPConnectionPool._putConnection(self, key, connection)
+
+        if self._max_idle_connections is None:
+            return
+
+        while len(self._timeouts) > self._max_idle_connections:
+            oldest = next(iter(self._timeouts))
+            oldest_key = self._timeouts[oldest].args[0]
+            self._timeouts[oldest].cancel()
+            self._removeConnection(oldest_key, oldest)
+
+    def closeCachedConnections(self):
+        d = HTTPConnectionPool.closeCachedConnections(self)
+        self._timeouts = OrderedDict()
+        return d
 
 
 def _cache_period_from_headers(headers, time_now=time.time):
@@ -19,6 +19,7 @@ import random
 import time
 
 import attr
+from prometheus_client import Histogram
 
 from twisted.internet import defer
 from twisted.internet.error import ConnectError
@@ -31,6 +32,18 @@ logger = logging.getLogger(__name__)
 
 SERVER_CACHE = {}
 
+# period to cache the absence of a SRV record for, if the response doesn't
+# include an SOA record to tell us
+SRV_NEGATIVE_CACHE_DEFAULT_PERIOD = 5 * 60
+
+# cap for the period to cache the absence of a SRV record for
+SRV_NEGATIVE_CACHE_MAX_PERIOD = 60 * 60
+
+srv_lookup_timer = Histogram(
+    "synapse_http_federation_srv_lookup_seconds",
+    "Time taken to look up SRV records which weren't cached",
+)
+
 
 @attr.s
 class Server(object):
@@ -94,11 +107,18 @@ class SrvResolver(object):
         dns_client (twisted.internet.interfaces.IResolver): twisted resolver impl
         cache (dict): cache object
         get_time (callable): clock implementation. Should return seconds since the epoch
+        negative_cache (dict|None): cache of the names which have no SRV record,
+            mapping to when that should expire (in seconds since the epoch). None
+            to use a new cache.
     """
-    def __init__(self, dns_client=client, cache=SERVER_CACHE, get_time=time.time):
+    def __init__(self, dns_client=client, cache=SERVER_CACHE, get_time=time.time,
+                 negative_cache=None):
         self._dns_client = dns_client
         self._cache = cache
         self._get_time = get_time
+        if negative_cache is None:
+            negative_cache = {}
+        self._negative_cache = negative_cache
 
     @defer.inlineCallbacks
     def resolve_service(self, service_name):
@@ -122,13 +142,19 @@ class SrvResolver(object):
                 servers = list(cache_entry)
                 defer.returnValue(servers)
 
+        negative_cache_expires = self._negative_cache.get(service_name)
+        if negative_cache_expires is not None:
+            if negative_cache_expires > now:
+                defer.returnValue([])
+            del self._negative_cache[service_name]
+
         try:
-            answers, _, _ = yield make_deferred_yieldable(
-                self._dns_client.lookupService(service_name),
-            )
-        except DNSNameError:
-            # TODO: cache this. We can get the SOA out of the exception, and use
-            # the negative-TTL value.
+            with srv_lookup_timer.time():
+                answers, _, _ = yield make_deferred_yieldable(
+                    self._dns_client.lookupService(service_name),
+                )
+        except DNSNameError as e:
+            self._negative_cache[service_name] = now + _negative_cache_period(e)
             defer.returnValue([])
         except DomainError as e:
             # We failed to resolve the name (other than a NameError)
@@ -167,3 +193,25 @@ class SrvResolver(object):
 
         self._cache[service_name] = list(servers)
         defer.returnValue(servers)
+
+
+def _negative_cache_period(name_error):
+    """Works out how long to cache the absence of a SRV record for
+
+    Per RFC2308, this is the smaller of the TTL of the SOA record in the
+    authority section of the response and its MINIMUM field.
+
+    Args:
+        name_error (DNSNameError): the failure from the DNS client, whose
+            argument (if any) is the DNS response
+
+    Returns:
+        int: the cache period in seconds
+    """
+    message = name_error.args[0] if name_error.args else None
+    for record in getattr(message, "authority", ()):
+        if record.type == dns.SOA and record.payload:
+            period = min(record.ttl, record.payload.minimum)
+            return min(period, SRV_NEGATIVE_CACHE_MAX_PERIOD)
+
+    return SRV_NEGATIVE_CACHE_DEFAULT_PERIOD
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+class JsonStreamParser(object):
+    """Parses a JSON document as it is received, rather than buffering it and
+    parsing it all at once.
+
+    Each item in the given lists is passed to a function as soon as it has been
+    parsed, and is replaced in the result by whatever the function returns.
+    This lets us turn the items of large lists (such as the events in a
+    /send_join response) into something more useful, and drop the parsed JSON,
+    while the rest of the document is still arriving.
+
+    If ijson isn't installed we fall back to buffering the document, and then
+    calling the functions once it has all been parsed.
+
+    Args:
+        item_transforms (dict[str, callable]): map from the path to a list in
+            the document to a function to call with each item in that list.
+            Paths are dot-separated keys, with "item" matching every item in
+            a list; for example "item.state" for the "state" list in the
+            second item of `[200, {"state": [...]}]`. The functions are called
+            with no logcontext.
+    """
+
+    def __init__(self, item_transforms):
+        self._item_transforms = item_transforms
+
+        if ijson is None:
+            self._chunks = []
+            return
+
+        self._events = ijson.sendable_list()
+        self._coro = ijson.parse_coro(self._events, use_float=True)
+        self._builder = ijson.ObjectBuilder()
+
+        # the list we are currently building, as (path, transform, items), and
+        # a builder for the item we're currently building within that list.
+        self._current_list = None
+        self._item_builder = None
+
+    def feed(self, data):
+        """Parses some more of the document.
+
+        Args:
+            data (bytes)
+
+        Raises:
+            ValueError if the document is not valid JSON.
+        """
+        if ijson is None:
+            self._chunks.append(data)
+            return
+
+        try:
+            self._coro.send(data)
+        except ijson.JSONError as e:
+            raise ValueError("Invalid JSON: %s" % (e,))
+        self._handle_events()
+
+    def finish(self):
+        """Finishes parsing the document.
+
+        Returns:
+            object: the parsed document.
+
+        Raises:
+            ValueError if the document is not valid JSON.
+        """
+        if ijson is None:
+            body = b"".join(self._chunks).decode("utf-8")
+            result = json.loads(body)
+            for path, transform in self._item_transforms.items():
+                _transform_items(result, path.split("."), transform)
+            return result
+
+        try:
+            self._coro.close()
+        except ijson.JSONError as e:
+            raise ValueError("Invalid JSON: %s" % (e,))
+        self._handle_events()
+
+        if not hasattr(self._builder, "value"):
+            raise ValueError("Invalid JSON: no document")
+        return self._builder.value
+
+    def _handle_events(self):
+        for prefix, event, value in self._events:
+            if self._current_list is not None:
+                self._handle_list_event(prefix, event, value)
+            elif event == "start_array" and prefix in self._item_transforms:
+                self._current_list = (prefix, self._item_transforms[prefix], [])
+            else:
+                self._builder.event(event, value)
+
+        del self._events[:]
+
+    def _handle_list_event(self, prefix, event, value):
+        path, transform, items = self._current_list
+        item_prefix = path + ".item"
+
+        if prefix == path:
+            # this must be the end of the list: add it to the document as if it
+            # was a single value.
+            self._builder.event("string", items)
+            self._current_list = None
+        elif prefix != item_prefix:
+            # something nested within the current item
+            self._item_builder.event(event, value)
+        elif event in ("start_map", "start_array"):
+            self._item_builder = ijson.ObjectBuilder()
+            self._item_builder.event(event, value)
+        elif event in ("end_map", "end_array"):
+            self._item_builder.event(event, value)
+            items.append(transform(self._item_builder.value))
+            self._item_builder = None
+        elif self._item_builder is not None:
+            # a key within the current item
+            self._item_builder.event(event, value)
+        else:
+            # the item is a single value
+            items.append(transform(value))
+
+
+def _transform_items(value, keys, transform):
+    """Replaces the items in the lists at the given path in a parsed document
+    with the results of `transform`.
+    """
+    if not keys:
+        if isinstance(value, list):
+            value[:] = [transform(item) for item in value]
+        return
+
+    key, keys = keys[0], keys[1:]
+    if key == "item" and isinstance(value, list):
+        for item in value:
+            _transform_items(item, keys, transform)
+    elif isinstance(value, dict) and key in value:
+        _transform_items(value[key], keys, transform)
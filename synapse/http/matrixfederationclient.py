@@ -32,6 +32,7 @@ from twisted.internet import defer, protocol
 from twisted.internet.error import DNSLookupError
 from twisted.internet.task import _EPSILON, Cooperator
 from twisted.web._newclient import ResponseDone
+from twisted.web.http import PotentialDataLoss
 from twisted.web.http_headers import Headers
 
 import synapse.metrics
@@ -117,7 +118,7 @@ class MatrixFederationRequest(object):
 
 
 @defer.inlineCallbacks
-def _handle_json_response(reactor, timeout_sec, request, response):
+def _handle_json_response(reactor, timeout_sec, request, response, parser=None):
     """
     Reads the JSON body of a response, with a timeout
 
@@ -126,6 +127,8 @@ def _handle_json_response(reactor, timeout_sec, request, response):
         timeout_sec (float): number of seconds to wait for response to complete
         request (MatrixFederationRequest): the request that triggered the response
         response (IResponse): response to the request
+        parser (JsonStreamParser|None): if set, used to parse the body as it
+            arrives, rather than once it has all been received.
 
     Returns:
         dict: parsed JSON response
@@ -133,7 +136,10 @@ def _handle_json_response(reactor, timeout_sec, request, response):
     try:
         check_content_type_is_json(response.headers)
 
-        d = treq.json_content(response)
+        if parser:
+            d = _read_body_with_parser(response, parser)
+        else:
+            d = treq.json_content(response)
         d = timeout_deferred(
             d,
             timeout=timeout_sec,
@@ -177,6 +183,11 @@ class MatrixFederationHttpClient(object):
         self.agent = MatrixFederationAgent(
             hs.get_reactor(),
             tls_client_options_factory,
+            max_connections_per_host=hs.config.federation_client_max_connections_per_host,
+            idle_connection_timeout=(
+                hs.config.federation_client_idle_connection_timeout / 1000.
+            ),
+            max_idle_connections=hs.config.federation_client_max_idle_connections,
         )
         self.clock = hs.get_clock()
         self._store = hs.get_datastore()
@@ -473,7 +484,7 @@ class MatrixFederationHttpClient(object):
                  json_data_callback=None,
                  long_retries=False, timeout=None,
                  ignore_backoff=False,
-                 backoff_on_404=False):
+                 backoff_on_404=False, parser=None):
         """ Sends the specifed json data using PUT
 
         Args:
@@ -494,6 +505,8 @@ class MatrixFederationHttpClient(object):
             backoff_on_404 (bool): True if we should count a 404 response as
                 a failure of the server (and should therefore back off future
                 requests)
+            parser (JsonStreamParser|None): if set, used to parse the
+                response as it arrives.
 
         Returns:
             Deferred[dict|list]: Succeeds when we get a 2xx HTTP response. The
@@ -529,12 +542,13 @@ class MatrixFederationHttpClient(object):
 
         body = yield _handle_json_response(
             self.hs.get_reactor(), self.default_timeout, request, response,
+            parser=parser,
         )
         defer.returnValue(body)
 
     @defer.inlineCallbacks
     def post_json(self, destination, path, data={}, long_retries=False,
-                  timeout=None, ignore_backoff=False, args={}):
+                  timeout=None, ignore_backoff=False, args={}, parser=None):
         """ Sends the specifed json data using POST
 
         Args:
@@ -550,6 +564,8 @@ class MatrixFederationHttpClient(object):
             ignore_backoff (bool): true to ignore the historical backoff data and
                 try the request anyway.
             args (dict): query params
+            parser (JsonStreamParser|None): if set, used to parse the
+                response as it arrives.
         Returns:
             Deferred[dict|list]: Succeeds when we get a 2xx HTTP response. The
             result will be the decoded JSON body.
@@ -587,12 +603,13 @@ class MatrixFederationHttpClient(object):
 
         body = yield _handle_json_response(
             self.hs.get_reactor(), _sec_timeout, request, response,
+            parser=parser,
         )
         defer.returnValue(body)
 
     @defer.inlineCallbacks
     def get_json(self, destination, path, args=None, retry_on_dns_fail=True,
-                 timeout=None, ignore_backoff=False):
+                 timeout=None, ignore_backoff=False, parser=None):
         """ GETs some json from the given host homeserver and path
 
         Args:
@@ -606,6 +623,8 @@ class MatrixFederationHttpClient(object):
                 be retried.
             ignore_backoff (bool): true to ignore the historical backoff data
                 and try the request anyway.
+            parser (JsonStreamParser|None): if set, used to parse the
+                response as it arrives.
         Returns:
             Deferred[dict|list]: Succeeds when we get a 2xx HTTP response. The
             result will be the decoded JSON body.
@@ -640,6 +659,7 @@ class MatrixFederationHttpClient(object):
 
         body = yield _handle_json_response(
             self.hs.get_reactor(), self.default_timeout, request, response,
+            parser=parser,
         )
         defer.returnValue(body)
 
@@ -788,6 +808,54 @@ def _readBodyToFile(response, stream, max_size):
     return d
 
 
+class _ReadBodyWithParserProtocol(protocol.Protocol):
+    def __init__(self, parser, deferred):
+        self.parser = parser
+        self.deferred = deferred
+
+    def dataReceived(self, data):
+        if self.deferred.called:
+            return
+
+        try:
+            self.parser.feed(data)
+        except Exception:
+            self.deferred.errback()
+            self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        if self.deferred.called:
+            return
+
+        # like readBody, we treat a response without a content length as
+        # complete once the connection is closed.
+        if reason.check(ResponseDone, PotentialDataLoss):
+            try:
+                result = self.parser.finish()
+            except Exception:
+                self.deferred.errback()
+            else:
+                self.deferred.callback(result)
+        else:
+            self.deferred.errback(reason)
+
+
+def _read_body_with_parser(response, parser):
+    """Parses the body of a response with a JsonStreamParser as it arrives.
+
+    Args:
+        response (IResponse)
+        parser (JsonStreamParser)
+
+    Returns:
+        Deferred[object]: the parsed body
+    """
+    d = defer.Deferred(lambda _: prot.transport.stopProducing())
+    prot = _ReadBodyWithParserProtocol(parser, d)
+    response.deliverBody(prot)
+    return d
+
+
 def _flatten_response_never_received(e):
     if hasattr(e, "reasons"):
         reasons = ", ".join(
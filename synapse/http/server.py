@@ -22,8 +22,9 @@ from six import PY3
 from six.moves import http_client, urllib
 
 from canonicaljson import encode_canonical_json, encode_pretty_printed_json, json
+from zope.interface import implementer
 
-from twisted.internet import defer
+from twisted.internet import defer, interfaces
 from twisted.python import failure
 from twisted.web import resource
 from twisted.web.server import NOT_DONE_YET
@@ -97,7 +98,7 @@ def wrap_json_request_handler(h):
             else:
                 respond_with_json(
                     request, code, e.error_dict(), send_cors=True,
-                    pretty_print=_request_user_agent_is_curl(request),
+                    pretty_print=request_user_agent_is_curl(request),
                 )
 
         except Exception:
@@ -129,7 +130,7 @@ def wrap_json_request_handler(h):
                         "errcode": Codes.UNKNOWN,
                     },
                     send_cors=True,
-                    pretty_print=_request_user_agent_is_curl(request),
+                    pretty_print=request_user_agent_is_curl(request),
                 )
 
     return wrap_async_request_handler(wrapped_request_handler)
@@ -354,7 +355,7 @@ class JsonResource(HttpServer, resource.Resource):
             request, code, response_json_object,
             send_cors=True,
             response_code_message=response_code_message,
-            pretty_print=_request_user_agent_is_curl(request),
+            pretty_print=request_user_agent_is_curl(request),
             canonical_json=self.canonical_json,
         )
 
@@ -461,6 +462,97 @@ def respond_with_json_bytes(request, code, json_bytes, send_cors=False,
     return NOT_DONE_YET
 
 
+def respond_with_json_chunks(request, code, json_chunks, send_cors=False):
+    """Sends JSON in response to the given request, without first building the
+    whole body in memory.
+
+    The body is written with chunked transfer encoding, pulling from
+    `json_chunks` only as fast as the client reads the response.
+
+    Args:
+        request (twisted.web.http.Request): The http request to respond to.
+        code (int): The HTTP response code.
+        json_chunks (Iterator[bytes]): Iterator yielding fragments of the
+            encoded JSON body, which are concatenated to form the response.
+        send_cors (bool): Whether to send Cross-Origin Resource Sharing headers
+            http://www.w3.org/TR/cors/
+    Returns:
+        twisted.web.server.NOT_DONE_YET"""
+    if request._disconnected:
+        logger.warn(
+            "Not sending response to request %s, already disconnected.",
+            request)
+        return
+
+    request.setResponseCode(code)
+    request.setHeader(b"Content-Type", b"application/json")
+    request.setHeader(b"Cache-Control", b"no-cache, no-store, must-revalidate")
+
+    if send_cors:
+        set_cors_headers(request)
+
+    producer = _ByteChunksProducer(request, json_chunks)
+    producer.start()
+    return NOT_DONE_YET
+
+
+@implementer(interfaces.IPullProducer)
+class _ByteChunksProducer(object):
+    """A pull producer which writes the byte strings from an iterator to a
+    request, and then finishes the request.
+
+    Each time the transport asks for more data we write out at least
+    `min_chunk_size` bytes (unless the iterator is exhausted), so the iterator
+    is only advanced as fast as the client consumes the response.
+    """
+
+    min_chunk_size = 64 * 1024
+
+    def __init__(self, request, chunks):
+        self._request = request
+        self._chunks = iter(chunks)
+
+    def start(self):
+        self._request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        if not self._request:
+            return
+
+        buf = []
+        buf_size = 0
+        finished = False
+        try:
+            while buf_size < self.min_chunk_size:
+                chunk = next(self._chunks)
+                buf.append(chunk)
+                buf_size += len(chunk)
+        except StopIteration:
+            finished = True
+        except Exception:
+            # We've already sent the headers, so the best we can do is to drop
+            # the connection rather than send a truncated body.
+            logger.exception("Failed to produce response for %s", self._request)
+            request = self._request
+            self.stopProducing()
+            request.unregisterProducer()
+            request.loseConnection()
+            return
+
+        if buf:
+            self._request.write(b"".join(buf))
+
+        if finished:
+            request = self._request
+            self.stopProducing()
+            request.unregisterProducer()
+            finish_request(request)
+
+    def stopProducing(self):
+        self._request = None
+        self._chunks = None
+
+
 def set_cors_headers(request):
     """Set the CORs headers so that javascript running in a web browsers can
     use this API
@@ -497,7 +589,10 @@ def finish_request(request):
         logger.info("Connection disconnected before response was written: %r", e)
 
 
-def _request_user_agent_is_curl(request):
+def request_user_agent_is_curl(request):
+    """Whether the request came from curl, in which case JSON responses are
+    pretty-printed.
+    """
     user_agents = request.requestHeaders.getRawHeaders(
         b"User-Agent", default=[]
     )
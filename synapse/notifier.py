@@ -16,7 +16,7 @@
 import logging
 from collections import namedtuple
 
-from prometheus_client import Counter
+from prometheus_client import Counter, Histogram
 
 from twisted.internet import defer
 
@@ -39,6 +39,22 @@ notified_events_counter = Counter("synapse_notifier_notified_events", "")
 users_woken_by_stream_counter = Counter(
     "synapse_notifier_users_woken_by_stream", "", ["stream"])
 
+# How many user streams each call to `on_new_event` had to wake up.
+wakeups_per_event_histogram = Histogram(
+    "synapse_notifier_wakeups_per_event", "",
+    buckets=[0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000],
+)
+
+# Wake-ups which were folded into one that was already pending, because the
+# user stream had been poked again within the coalescing window.
+coalesced_wakeups_counter = Counter("synapse_notifier_coalesced_wakeups", "")
+
+# How many user streams were woken by each flush of the pending wake-ups.
+wakeup_batch_size_histogram = Histogram(
+    "synapse_notifier_wakeup_batch_size", "",
+    buckets=[1, 5, 10, 50, 100, 500, 1000, 5000, 10000],
+)
+
 
 # TODO(paul): Should be shared somewhere
 def count(func, l):
@@ -90,6 +106,19 @@ class _NotifierUserStream(object):
     def notify(self, stream_key, stream_id, time_now_ms):
         """Notify any listeners for this user of a new event from an
         event source.
+        Args:
+            stream_key(str): The stream the event came from.
+            stream_id(str): The new id for the stream the event came from.
+            time_now_ms(int): The current time in milliseconds.
+        """
+        self.advance(stream_key, stream_id, time_now_ms)
+        self.wake()
+
+    def advance(self, stream_key, stream_id, time_now_ms):
+        """Record a new event from an event source without waking up the
+        listeners. Any listener which is added after this will return
+        immediately, but existing listeners are only resolved by `wake`.
+
         Args:
             stream_key(str): The stream the event came from.
             stream_id(str): The new id for the stream the event came from.
@@ -100,10 +129,15 @@ class _NotifierUserStream(object):
         )
         self.last_notified_token = self.current_token
         self.last_notified_ms = time_now_ms
-        noify_deferred = self.notify_deferred
 
         users_woken_by_stream_counter.labels(stream_key).inc()
 
+    def wake(self):
+        """Resolve any listeners waiting on this stream with the current
+        token.
+        """
+        noify_deferred = self.notify_deferred
+
         with PreserveLoggingContext():
             self.notify_deferred = ObservableDeferred(defer.Deferred())
             noify_deferred.callback(self.current_token)
@@ -153,6 +187,11 @@ class Notifier(object):
 
     UNUSED_STREAM_EXPIRY_MS = 10 * 60 * 1000
 
+    # How long to hold back waking up listeners after a user stream has been
+    # poked, so that a burst of events in busy rooms wakes each listener once
+    # rather than once per event. Zero wakes listeners synchronously.
+    NOTIFY_COALESCE_WINDOW_MS = 5
+
     def __init__(self, hs):
         self.user_to_user_stream = {}
         self.room_to_user_streams = {}
@@ -162,6 +201,11 @@ class Notifier(object):
         self.store = hs.get_datastore()
         self.pending_new_room_events = []
 
+        # User streams which have been advanced but whose listeners have not
+        # yet been woken, and the delayed call which will wake them.
+        self._pending_wakeups = set()
+        self._wakeup_call = None
+
         self.replication_callbacks = []
 
         self.clock = hs.get_clock()
@@ -290,15 +334,88 @@ class Notifier(object):
                 for room in rooms:
                     user_streams |= self.room_to_user_streams.get(room, set())
 
+                wakeups_per_event_histogram.observe(len(user_streams))
+
                 time_now_ms = self.clock.time_msec()
                 for user_stream in user_streams:
                     try:
-                        user_stream.notify(stream_key, new_token, time_now_ms)
+                        user_stream.advance(stream_key, new_token, time_now_ms)
                     except Exception:
                         logger.exception("Failed to notify listener")
 
+                self._schedule_wakeups(user_streams)
+
                 self.notify_replication()
 
+    def _schedule_wakeups(self, user_streams):
+        """Arrange for the listeners on the given user streams to be woken up.
+
+        Streams are collected over `NOTIFY_COALESCE_WINDOW_MS` and then woken
+        in a single batch, so a user in several of the rooms that saw new
+        events in that window is only woken once.
+
+        Args:
+            user_streams (iterable[_NotifierUserStream])
+        """
+        if not self.NOTIFY_COALESCE_WINDOW_MS:
+            self._wake_user_streams(user_streams)
+            return
+
+        for user_stream in user_streams:
+            if user_stream in self._pending_wakeups:
+                coalesced_wakeups_counter.inc()
+            else:
+                self._pending_wakeups.add(user_stream)
+
+        if self._pending_wakeups and self._wakeup_call is None:
+            self._wakeup_call = self.clock.call_later(
+                self.NOTIFY_COALESCE_WINDOW_MS / 1000.,
+                self._flush_pending_wakeups,
+            )
+
+    def _flush_pending_wakeups(self):
+        """Wake up all the user streams queued by `_schedule_wakeups`."""
+        self._wakeup_call = None
+
+        pending = self._pending_wakeups
+        self._pending_wakeups = set()
+
+        with Measure(self.clock, "notifier_flush_wakeups"):
+            self._wake_user_streams(pending)
+
+    def _wake_user_streams(self, user_streams):
+        count = 0
+        for user_stream in user_streams:
+            try:
+                user_stream.wake()
+                count += 1
+            except Exception:
+                logger.exception("Failed to notify listener")
+
+        if count:
+            wakeup_batch_size_histogram.observe(count)
+
+    def has_changed_for_user_since(self, user_id, token):
+        """Check whether anything that would wake up the given user's event
+        streams has happened since the given token.
+
+        This only looks at the stream the notifier keeps for the user, so is
+        cheap, but if we don't have one (e.g. because the user hasn't been
+        waiting for events recently) we have to assume that something has
+        changed.
+
+        Args:
+            user_id (str)
+            token (StreamToken)
+
+        Returns:
+            bool: False if we know nothing has changed for the user.
+        """
+        user_stream = self.user_to_user_stream.get(user_id)
+        if user_stream is None:
+            return True
+        return user_stream.last_notified_token.is_after(token)
+
     def on_new_replication_data(self):
         """Used to inform replication listeners that something has happend
         without waking up any of the normal user event streams"""
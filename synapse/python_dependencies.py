@@ -87,6 +87,9 @@ CONDITIONAL_REQUIREMENTS = {
     "url_preview": ["lxml>=3.5.0"],
     "test": ["mock>=2.0", "parameterized"],
     "sentry": ["sentry-sdk>=0.7.2"],
+
+    # lets us parse large federation responses as they arrive.
+    "streaming_json": ["ijson>=3.1"],
 }
 
 
@@ -25,6 +25,7 @@ class SlavedKeyStore(BaseSlavedStore):
     ]
 
     get_server_verify_keys = __func__(DataStore.get_server_verify_keys)
+    get_server_signature_keys = __func__(DataStore.get_server_signature_keys)
     store_server_verify_key = __func__(DataStore.store_server_verify_key)
 
     get_server_certificate = __func__(DataStore.get_server_certificate)
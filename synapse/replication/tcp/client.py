@@ -159,11 +159,16 @@ class ReplicationClientHandler(object):
             logger.warn("Queuing command as not connected: %r", cmd.NAME)
             self.pending_commands.append(cmd)
 
-    def send_federation_ack(self, token):
+    def send_federation_ack(self, token, instance_name=None):
         """Ack data for the federation stream. This allows the master to drop
         data stored purely in memory.
+
+        Args:
+            token (int)
+            instance_name (str|None): the name of the federation sender shard
+                sending the ack.
         """
-        self.send_command(FederationAckCommand(token))
+        self.send_command(FederationAckCommand(token, instance_name))
 
     def send_user_sync(self, user_id, is_syncing, last_sync_ms):
         """Poke the master that a user has started/stopped syncing.
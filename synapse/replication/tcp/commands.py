@@ -242,22 +242,27 @@ class FederationAckCommand(Command):
     federation stream. This allows the master to drop in-memory caches of the
     federation stream.
 
-    This must only be sent from one worker (i.e. the one sending federation)
+    This must only be sent from the workers sending federation, which name
+    themselves if outbound federation is sharded across several of them.
 
     Format::
 
-        FEDERATION_ACK <token>
+        FEDERATION_ACK <token> [<instance_name>]
     """
     NAME = "FEDERATION_ACK"
 
-    def __init__(self, token):
+    def __init__(self, token, instance_name=None):
         self.token = token
+        self.instance_name = instance_name
 
     @classmethod
     def from_line(cls, line):
-        return cls(int(line))
+        token, _, instance_name = line.partition(" ")
+        return cls(int(token), instance_name or None)
 
     def to_line(self):
+        if self.instance_name:
+            return "%d %s" % (self.token, self.instance_name)
         return str(self.token)
 
 
@@ -433,7 +433,7 @@ class ServerReplicationStreamProtocol(BaseReplicationStreamProtocol):
             return self.subscribe_to_stream(stream_name, token)
 
     def on_FEDERATION_ACK(self, cmd):
-        return self.streamer.federation_ack(cmd.token)
+        return self.streamer.federation_ack(cmd.token, cmd.instance_name)
 
     def on_REMOVE_PUSHER(self, cmd):
         return self.streamer.on_remove_pusher(
@@ -213,12 +213,12 @@ class ReplicationStreamer(object):
         return stream.get_updates_since(token)
 
     @measure_func("repl.federation_ack")
-    def federation_ack(self, token):
+    def federation_ack(self, token, instance_name=None):
         """We've received an ack for federation stream from a client.
         """
         federation_ack_counter.inc()
         if self.federation_sender:
-            self.federation_sender.federation_ack(token)
+            self.federation_sender.federation_ack(token, instance_name)
 
     @measure_func("repl.on_user_sync")
     @defer.inlineCallbacks
@@ -16,10 +16,11 @@
 import itertools
 import logging
 
-from canonicaljson import json
+from canonicaljson import encode_canonical_json, json
 
 from twisted.internet import defer
 
+import synapse.events
 from synapse.api.constants import PresenceState
 from synapse.api.errors import SynapseError
 from synapse.api.filtering import DEFAULT_FILTER_COLLECTION, FilterCollection
@@ -30,6 +31,7 @@ from synapse.events.utils import (
 )
 from synapse.handlers.presence import format_user_presence_state
 from synapse.handlers.sync import SyncConfig
+from synapse.http.server import request_user_agent_is_curl, respond_with_json_chunks
 from synapse.http.servlet import RestServlet, parse_boolean, parse_integer, parse_string
 from synapse.types import StreamToken
 
@@ -168,6 +170,27 @@ class SyncRestServlet(RestServlet):
             )
 
         time_now = self.clock.time_msec()
+
+        if (since_token is None or full_state) and not request_user_agent_is_curl(
+            request,
+        ):
+            # Initial syncs can be huge, so rather than encoding the whole
+            # response in one go we send it with chunked encoding, encoding a
+            # room at a time as the client reads it. This only bounds the
+            # encoded copy of the response: the SyncResult itself is still
+            # built in full first.
+            #
+            # Pretty-printed responses for curl can't be built up a room at a
+            # time, so they take the normal path below.
+            respond_with_json_chunks(
+                request, 200,
+                self.encode_response_chunks(
+                    time_now, sync_result, requester.access_token_id, filter
+                ),
+                send_cors=True,
+            )
+            return
+
         response_content = self.encode_response(
             time_now, sync_result, requester.access_token_id, filter
         )
@@ -176,12 +199,7 @@ class SyncRestServlet(RestServlet):
 
     @staticmethod
     def encode_response(time_now, sync_result, access_token_id, filter):
-        if filter.event_format == 'client':
-            event_formatter = format_event_for_client_v2_without_room_id
-        elif filter.event_format == 'federation':
-            event_formatter = format_event_raw
-        else:
-            raise Exception("Unknown event format %s" % (filter.event_format, ))
+        event_formatter = SyncRestServlet._get_event_formatter(filter)
 
         joined = SyncRestServlet.encode_joined(
             sync_result.joined, time_now, access_token_id,
@@ -200,6 +218,82 @@ class SyncRestServlet(RestServlet):
             event_formatter,
         )
 
+        response = SyncRestServlet._encode_non_room_data(time_now, sync_result)
+        response["rooms"] = {
+            "join": joined,
+            "invite": invited,
+            "leave": archived,
+        }
+        return response
+
+    @staticmethod
+    def encode_response_chunks(time_now, sync_result, access_token_id, filter):
+        """Encodes the response to JSON a room at a time.
+
+        Equivalent to JSON-encoding the result of `encode_response` the way
+        the client API's JsonResource does, but only one room is held in its
+        encoded form at once. The SyncResult itself must already be in memory.
+
+        Returns:
+            Iterator[bytes]: fragments of the encoded response
+        """
+        event_formatter = SyncRestServlet._get_event_formatter(filter)
+
+        def encode_joined(room):
+            return SyncRestServlet.encode_joined(
+                [room], time_now, access_token_id, filter.event_fields,
+                event_formatter,
+            )
+
+        def encode_invited(room):
+            return SyncRestServlet.encode_invited(
+                [room], time_now, access_token_id, event_formatter,
+            )
+
+        def encode_archived(room):
+            return SyncRestServlet.encode_archived(
+                [room], time_now, access_token_id, filter.event_fields,
+                event_formatter,
+            )
+
+        response = SyncRestServlet._encode_non_room_data(time_now, sync_result)
+        item_separator, key_separator = _json_separators()
+
+        # Everything other than the rooms is small, so we encode it in one go,
+        # and splice the rooms in at the end.
+        yield _encode_json(response)[:-1]
+        yield item_separator + b'"rooms"' + key_separator + b"{"
+
+        sections = (
+            ("join", sync_result.joined, encode_joined),
+            ("invite", sync_result.invited, encode_invited),
+            ("leave", sync_result.archived, encode_archived),
+        )
+        for i, (name, rooms, encode_room) in enumerate(sections):
+            if i:
+                yield item_separator
+            yield _encode_json(name) + key_separator + b"{"
+            for j, room in enumerate(rooms):
+                if j:
+                    yield item_separator
+                # Each of these is a single entry dict, so stripping the braces
+                # leaves `"room_id":{...}`.
+                yield _encode_json(encode_room(room))[1:-1]
+            yield b"}"
+
+        yield b"}}"
+
+    @staticmethod
+    def _get_event_formatter(filter):
+        if filter.event_format == 'client':
+            return format_event_for_client_v2_without_room_id
+        elif filter.event_format == 'federation':
+            return format_event_raw
+        else:
+            raise Exception("Unknown event format %s" % (filter.event_format, ))
+
+    @staticmethod
+    def _encode_non_room_data(time_now, sync_result):
         return {
             "account_data": {"events": sync_result.account_data},
             "to_device": {"events": sync_result.to_device},
@@ -210,11 +304,6 @@ class SyncRestServlet(RestServlet):
             "presence": SyncRestServlet.encode_presence(
                 sync_result.presence, time_now
             ),
-            "rooms": {
-                "join": joined,
-                "invite": invited,
-                "leave": archived,
-            },
             "groups": {
                 "join": sync_result.groups.join,
                 "invite": sync_result.groups.invite,
@@ -400,5 +489,23 @@ class SyncRestServlet(RestServlet):
         return result
 
 
+def _encode_json(json_object):
+    # Matches respond_with_json for the client API, which is served without
+    # canonical JSON.
+    if synapse.events.USE_FROZEN_DICTS:
+        # canonicaljson knows how to encode frozendicts
+        return encode_canonical_json(json_object)
+    return json.dumps(json_object).encode("utf-8")
+
+
+def _json_separators():
+    """The item and key separators used by `_encode_json`, for splicing its
+    output together.
+    """
+    if synapse.events.USE_FROZEN_DICTS:
+        return b",", b":"
+    return b", ", b": "
+
+
 def register_servlets(hs, http_server):
     SyncRestServlet(hs).register(http_server)
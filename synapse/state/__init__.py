@@ -136,7 +136,8 @@ class StateHandler(object):
         defer.returnValue(state)
 
     @defer.inlineCallbacks
-    def get_current_state_ids(self, room_id, latest_event_ids=None):
+    def get_current_state_ids(self, room_id, latest_event_ids=None,
+                              state_filter=None):
         """Get the current state, or the state at a set of events, for a room
 
         Args:
@@ -146,6 +147,10 @@ class StateHandler(object):
                 extremities to resolve. If None, we look them up from the
                 database (via a cache)
 
+            state_filter (StateFilter|None): the state to return, or None
+                for all of it. If all the extremities share a state group,
+                only the matching state is loaded from the database.
+
         Returns:
             Deferred[dict[(str, str), str)]]: the state dict, mapping from
                 (event_type, state_key) -> event_id
@@ -153,10 +158,24 @@ class StateHandler(object):
         if not latest_event_ids:
             latest_event_ids = yield self.store.get_latest_event_ids_in_room(room_id)
 
+        if state_filter is not None and not state_filter.is_full():
+            event_to_groups = yield self.store.get_state_groups_for_events(
+                latest_event_ids,
+            )
+            state_groups = set(itervalues(event_to_groups))
+            if len(state_groups) == 1:
+                state = yield self.store.get_state_ids_for_group(
+                    state_groups.pop(), state_filter,
+                )
+                defer.returnValue(state)
+
         logger.debug("calling resolve_state_groups from get_current_state_ids")
         ret = yield self.resolve_state_groups_for_events(room_id, latest_event_ids)
         state = ret.state
 
+        if state_filter is not None and not state_filter.is_full():
+            state = state_filter.filter_state(state)
+
         defer.returnValue(state)
 
     @defer.inlineCallbacks
@@ -258,6 +277,29 @@ class StateHandler(object):
 
             defer.returnValue(context)
 
+        if not event.is_state():
+            # Fast path for non-state events: if all the prev events share a
+            # state group then the state at this event is the state in that
+            # group, and we can avoid loading the (potentially huge) state map
+            # until someone actually needs it.
+            event_to_groups = yield self.store.get_state_groups_for_events(
+                event.prev_event_ids(),
+            )
+            state_groups = set(itervalues(event_to_groups))
+            if len(state_groups) == 1:
+                state_group = state_groups.pop()
+                prev_group, delta_ids = yield self.store.get_state_group_delta(
+                    state_group,
+                )
+
+                context = EventContext.for_state_group(
+                    state_group=state_group,
+                    prev_group=prev_group,
+                    delta_ids=delta_ids,
+                )
+
+                defer.returnValue(context)
+
         logger.debug("calling resolve_state_groups from compute_event_context")
 
         entry = yield self.resolve_state_groups_for_events(
@@ -494,28 +536,89 @@ class StateResolutionHandler(object):
                     break
 
             if conflicted_state:
-                logger.info("Resolving conflicted state for %r", room_id)
-                with Measure(self.clock, "state._resolve_events"):
-                    new_state = yield resolve_events_with_store(
-                        room_version,
-                        list(itervalues(state_groups_ids)),
-                        event_map=event_map,
-                        state_res_store=state_res_store,
+                # check whether we (or another worker) have already resolved
+                # this set of state groups.
+                cache = yield self._get_stored_resolution(
+                    state_groups_ids, state_res_store,
+                )
+                if cache is None:
+                    logger.info("Resolving conflicted state for %r", room_id)
+                    with Measure(self.clock, "state._resolve_events"):
+                        new_state = yield resolve_events_with_store(
+                            room_version,
+                            list(itervalues(state_groups_ids)),
+                            event_map=event_map,
+                            state_res_store=state_res_store,
+                        )
+
+                    with Measure(self.clock, "state.create_group_ids"):
+                        cache = _make_state_cache_entry(new_state, state_groups_ids)
+
+                    yield state_res_store.store_state_group_resolution(
+                        room_id, group_names, cache,
                     )
-
-            # if the new state matches any of the input state groups, we can
-            # use that state group again. Otherwise we will generate a state_id
-            # which will be used as a cache key for future resolutions, but
-            # not get persisted.
-
-            with Measure(self.clock, "state.create_group_ids"):
-                cache = _make_state_cache_entry(new_state, state_groups_ids)
+            else:
+                # if the new state matches any of the input state groups, we
+                # can use that state group again. Otherwise we will generate a
+                # state_id which will be used as a cache key for future
+                # resolutions, but not get persisted.
+                with Measure(self.clock, "state.create_group_ids"):
+                    cache = _make_state_cache_entry(new_state, state_groups_ids)
 
             if self._state_cache is not None:
                 self._state_cache[group_names] = cache
 
             defer.returnValue(cache)
 
+    @defer.inlineCallbacks
+    def _get_stored_resolution(self, state_groups_ids, state_res_store):
+        """Build a _StateCacheEntry from a previously stored resolution of the
+        given state groups, if there is one.
+
+        Args:
+            state_groups_ids (dict[int, dict[(str, str), str]]):
+                 map from state group id to the state in that state group
+                (where 'state' is a map from state key to event id)
+
+            state_res_store (StateResolutionStore)
+
+        Returns:
+            Deferred[_StateCacheEntry|None]
+        """
+        resolution = yield state_res_store.get_state_group_resolution(
+            state_groups_ids.keys(),
+        )
+        if resolution is None:
+            defer.returnValue(None)
+
+        if resolution.state_group in state_groups_ids:
+            defer.returnValue(_StateCacheEntry(
+                state=state_groups_ids[resolution.state_group],
+                state_group=resolution.state_group,
+            ))
+
+        if (
+            resolution.prev_group not in state_groups_ids
+            or resolution.delta_ids is None
+        ):
+            # this shouldn't happen, as the stored groups are always taken from
+            # the inputs; treat it as a cache miss.
+            logger.warn(
+                "Ignoring stored state resolution with unexpected groups %r",
+                resolution,
+            )
+            defer.returnValue(None)
+
+        new_state = dict(state_groups_ids[resolution.prev_group])
+        new_state.update(resolution.delta_ids)
+
+        defer.returnValue(_StateCacheEntry(
+            state=new_state,
+            state_group=None,
+            prev_group=resolution.prev_group,
+            delta_ids=resolution.delta_ids,
+        ))
+
 
 def _make_state_cache_entry(
     new_state,
@@ -670,3 +773,37 @@ class StateResolutionStore(object):
         """
 
         return self.store.get_auth_chain_ids(event_ids, include_given=True)
+
+    def get_state_group_resolution(self, state_groups):
+        """Look up a previously stored result of resolving the given state
+        groups.
+
+        Args:
+            state_groups (iterable[int])
+
+        Returns:
+            Deferred[_StateGroupResolution|None]: the stored resolution, or None
+            if these state groups have not been resolved before.
+        """
+
+        return self.store.get_state_group_resolution(state_groups)
+
+    def store_state_group_resolution(self, room_id, state_groups, entry):
+        """Persist the result of resolving the given state groups, so that it
+        can be reused across workers and restarts.
+
+        Args:
+            room_id (str)
+            state_groups (iterable[int])
+            entry (_StateCacheEntry): the resolved state
+
+        Returns:
+            Deferred
+        """
+
+        return self.store.store_state_group_resolution(
+            room_id, state_groups,
+            state_group=entry.state_group,
+            prev_group=entry.prev_group,
+            delta_ids=entry.delta_ids,
+        )
@@ -341,7 +341,6 @@ def _reverse_topological_power_sort(event_ids, event_map, state_res_store, auth_
 
         return -pl, ev.origin_server_ts, event_id
 
-    # Note: graph is modified during the sort
     it = lexicographical_topological_sort(
         graph,
         key=_get_power_order,
@@ -369,12 +368,32 @@ def _iterative_auth_checks(room_version, event_ids, base_state, event_map,
     """
     resolved_state = base_state.copy()
 
+    # the power levels only change when a power levels event passes, so most
+    # events can be checked against levels which have already been looked up.
+    auth_checker = event_auth.BatchAuthChecker(room_version)
+
+    # Fetch any auth events we don't already have in one go, rather than one
+    # at a time as we walk the list.
+    missing_auth_ids = set(
+        aid
+        for event_id in event_ids
+        for aid in event_map[event_id].auth_event_ids()
+        if aid not in event_map
+    )
+    if missing_auth_ids:
+        events = yield state_res_store.get_events(
+            list(missing_auth_ids), allow_rejected=True,
+        )
+        event_map.update(events)
+
     for event_id in event_ids:
         event = event_map[event_id]
 
         auth_events = {}
         for aid in event.auth_event_ids():
-            ev = yield _get_event(aid, event_map, state_res_store)
+            ev = event_map.get(aid)
+            if ev is None:
+                ev = yield _get_event(aid, event_map, state_res_store)
 
             if ev.rejected_reason is None:
                 auth_events[(ev.type, ev.state_key)] = ev
@@ -388,8 +407,8 @@ def _iterative_auth_checks(room_version, event_ids, base_state, event_map,
                     auth_events[key] = event_map[ev_id]
 
         try:
-            event_auth.check(
-                room_version, event, auth_events,
+            auth_checker.check(
+                event, auth_events,
                 do_sig_check=False,
                 do_size_check=False
             )
@@ -431,12 +450,18 @@ def _mainline_sort(event_ids, resolved_power_event_id, event_map,
 
     mainline_map = {ev_id: i + 1 for i, ev_id in enumerate(reversed(mainline))}
 
+    # Map from event ID to mainline depth for any power level event we've
+    # looked at. This is seeded with the mainline itself, and filled out as we
+    # walk up the power level chains of the events to sort, so that events
+    # sharing the same power level ancestry don't walk the same chain again.
+    depth_cache = dict(mainline_map)
+
     event_ids = list(event_ids)
 
     order_map = {}
     for ev_id in event_ids:
         depth = yield _get_mainline_depth_for_event(
-            event_map[ev_id], mainline_map,
+            event_map[ev_id], depth_cache,
             event_map, state_res_store,
         )
         order_map[ev_id] = (depth, event_map[ev_id].origin_server_ts, ev_id)
@@ -453,7 +478,9 @@ def _get_mainline_depth_for_event(event, mainline_map, event_map, state_res_stor
     Args:
         event (FrozenEvent)
         mainline_map (dict[str, int]): Map from event_id to mainline depth for
-            events in the mainline.
+            events in the mainline. The depths of any power level events we
+            walk through are added to the map, so that later calls can stop
+            as soon as they reach them.
         event_map (dict[str,FrozenEvent])
         state_res_store (StateResolutionStore)
 
@@ -461,24 +488,38 @@ def _get_mainline_depth_for_event(event, mainline_map, event_map, state_res_stor
         Deferred[int]
     """
 
+    # The power level events we've walked through to get to `event`, which
+    # all have the same mainline depth as whatever we find.
+    visited_power_events = []
+
     # We do an iterative search, replacing `event with the power level in its
     # auth events (if any)
+    depth = 0
     while event:
-        depth = mainline_map.get(event.event_id)
-        if depth is not None:
-            defer.returnValue(depth)
+        found_depth = mainline_map.get(event.event_id)
+        if found_depth is not None:
+            depth = found_depth
+            break
 
         auth_events = event.auth_event_ids()
         event = None
 
         for aid in auth_events:
-            aev = yield _get_event(aid, event_map, state_res_store)
+            # the auth events are usually already in the map, so avoid the
+            # overhead of going via _get_event where we can.
+            aev = event_map.get(aid)
+            if aev is None:
+                aev = yield _get_event(aid, event_map, state_res_store)
             if (aev.type, aev.state_key) == (EventTypes.PowerLevels, ""):
                 event = aev
+                visited_power_events.append(aid)
                 break
 
-    # Didn't find a power level auth event, so we just return 0
-    defer.returnValue(0)
+    # If we didn't find a power level auth event then the depth is 0
+    for pl_event_id in visited_power_events:
+        mainline_map[pl_event_id] = depth
+
+    defer.returnValue(depth)
 
 
 @defer.inlineCallbacks
@@ -507,8 +548,6 @@ def lexicographical_topological_sort(graph, key):
     appears before A in the sort), with ties broken lexicographically based on
     return value of the `key` function.
 
-    NOTE: `graph` is modified during the sort.
-
     Args:
         graph (dict[str, set[str]]): A representation of the graph where each
             node is a key in the dict and its value are the nodes edges.
@@ -522,31 +561,44 @@ def lexicographical_topological_sort(graph, key):
     # Note, this is basically Kahn's algorithm except we look at nodes with no
     # outgoing edges, c.f.
     # https://en.wikipedia.org/wiki/Topological_sorting#Kahn's_algorithm
-    outdegree_map = graph
-    reverse_graph = {}
-
-    # Lists of nodes with zero out degree. Is actually a tuple of
-    # `(key(node), node)` so that sorting does the right thing
-    zero_outdegree = []
-
-    for node, edges in iteritems(graph):
-        if len(edges) == 0:
-            zero_outdegree.append((key(node), node))
-
-        reverse_graph.setdefault(node, set())
-        for edge in edges:
-            reverse_graph.setdefault(edge, set()).add(node)
+    #
+    # To keep this cheap for large graphs we give each node a compact integer
+    # ID and track the out degrees as counts in a list, rather than building a
+    # reverse graph of sets and mutating the edge sets as we go.
+    nodes = list(graph)
+    node_to_id = {node: node_id for node_id, node in enumerate(nodes)}
+
+    # The number of edges from each node to nodes that haven't been emitted yet
+    outdegree = [len(graph[node]) for node in nodes]
+
+    # Map from node ID to the IDs of the nodes that have an edge to it
+    reverse_edges = [[] for _ in nodes]
+
+    for node_id, node in enumerate(nodes):
+        for edge in graph[node]:
+            edge_id = node_to_id.get(edge)
+            if edge_id is not None:
+                reverse_edges[edge_id].append(node_id)
+
+    # Heap of nodes with zero out degree. Entries are tuples of
+    # `(key(node), node, node_id)` so that sorting does the right thing; `key`
+    # is only called once per node.
+    zero_outdegree = [
+        (key(nodes[node_id]), nodes[node_id], node_id)
+        for node_id, degree in enumerate(outdegree)
+        if degree == 0
+    ]
 
     # heapq is a built in implementation of a sorted queue.
     heapq.heapify(zero_outdegree)
 
     while zero_outdegree:
-        _, node = heapq.heappop(zero_outdegree)
+        _, node, node_id = heapq.heappop(zero_outdegree)
 
-        for parent in reverse_graph[node]:
-            out = outdegree_map[parent]
-            out.discard(node)
-            if len(out) == 0:
-                heapq.heappush(zero_outdegree, (key(parent), parent))
+        for parent_id in reverse_edges[node_id]:
+            outdegree[parent_id] -= 1
+            if outdegree[parent_id] == 0:
+                parent = nodes[parent_id]
+                heapq.heappush(zero_outdegree, (key(parent), parent, parent_id))
 
         yield node
@@ -37,6 +37,7 @@ from .events import EventsStore
 from .filtering import FilteringStore
 from .group_server import GroupServerStore
 from .keys import KeyStore
+from .lazy_loaded_members import LazyLoadedMembersStore
 from .media_repository import MediaRepositoryStore
 from .monthly_active_users import MonthlyActiveUsersStore
 from .openid import OpenIdStore
@@ -89,6 +90,7 @@ class DataStore(RoomMemberStore, RoomStore,
                 GroupServerStore,
                 UserErasureStore,
                 MonthlyActiveUsersStore,
+                LazyLoadedMembersStore,
                 ):
 
     def __init__(self, db_conn, hs):
@@ -1364,6 +1364,9 @@ class SQLBaseStore(object):
         self._attempt_to_invalidate_cache(
             "get_users_in_room", (room_id,),
         )
+        self._attempt_to_invalidate_cache(
+            "get_hosts_in_room", (room_id,),
+        )
         self._attempt_to_invalidate_cache(
             "get_room_summary", (room_id,),
         )
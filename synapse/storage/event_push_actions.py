@@ -21,10 +21,14 @@ from six import iteritems
 from canonicaljson import json
 
 from twisted.internet import defer
+from twisted.python.failure import Failure
 
 from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.storage._base import LoggingTransaction, SQLBaseStore
+from synapse.util import batch_iter
+from synapse.util.async_helpers import ObservableDeferred
 from synapse.util.caches.descriptors import cachedInlineCallbacks
+from synapse.util.logcontext import make_deferred_yieldable
 
 logger = logging.getLogger(__name__)
 
@@ -100,6 +104,137 @@ class EventPushActionsWorkerStore(SQLBaseStore):
         )
         defer.returnValue(ret)
 
+    @defer.inlineCallbacks
+    def get_unread_event_push_actions_by_rooms_for_user(
+            self, user_id, last_read_event_ids
+    ):
+        """Get the unread notification counts for several of a user's rooms.
+
+        Equivalent to calling `get_unread_event_push_actions_by_room_for_user`
+        for each room. Counts which are in that function's cache are used from
+        there; the rest are fetched with a single query per batch of rooms and
+        added to the cache.
+
+        Args:
+            user_id (str)
+            last_read_event_ids (dict[str, str]): map from room_id to the
+                event_id of the user's read receipt in that room.
+
+        Returns:
+            Deferred[dict[str, dict]]: map from room_id to a dict with
+            "notify_count" and "highlight_count" keys.
+        """
+        cache = self.get_unread_event_push_actions_by_room_for_user.cache
+
+        results = {}
+        pending = {}
+        missing = {}
+        for room_id, last_read_event_id in iteritems(last_read_event_ids):
+            res = cache.get((room_id, user_id, last_read_event_id), None)
+            if res is None:
+                missing[room_id] = last_read_event_id
+            elif not isinstance(res, ObservableDeferred):
+                results[room_id] = res
+            elif res.has_succeeded():
+                results[room_id] = res.get_result()
+            else:
+                pending[room_id] = res.observe()
+
+        if missing:
+            # As for `cachedList`, we put a deferred in the cache for each room
+            # we are looking up, so that if the entry is invalidated while the
+            # query is running the (possibly stale) result is discarded.
+            deferreds = {}
+            for room_id, last_read_event_id in iteritems(missing):
+                deferreds[room_id] = defer.Deferred()
+                cache.set(
+                    (room_id, user_id, last_read_event_id),
+                    ObservableDeferred(deferreds[room_id], consumeErrors=True),
+                )
+
+            try:
+                counts = yield self.runInteraction(
+                    "get_unread_event_push_actions_by_rooms",
+                    self._get_unread_counts_by_receipts_txn,
+                    user_id, missing,
+                )
+            except Exception:
+                f = Failure()
+                for room_id, last_read_event_id in iteritems(missing):
+                    cache.invalidate((room_id, user_id, last_read_event_id))
+                    deferreds[room_id].errback(f)
+                raise
+
+            for room_id, d in iteritems(deferreds):
+                d.callback(counts[room_id])
+            results.update(counts)
+
+        for room_id, d in iteritems(pending):
+            results[room_id] = yield make_deferred_yieldable(d)
+
+        defer.returnValue(results)
+
+    def _get_unread_counts_by_receipts_txn(self, txn, user_id, last_read_event_ids):
+        """Batched version of `_get_unread_counts_by_receipt_txn`, which also
+        includes the counts archived in event_push_summary.
+
+        Args:
+            txn (cursor)
+            user_id (str)
+            last_read_event_ids (dict[str, str]): map from room_id to the
+                event_id of the user's read receipt in that room.
+
+        Returns:
+            dict[str, dict]: map from room_id to a dict with "notify_count"
+            and "highlight_count" keys.
+        """
+        # If we don't have the event the receipt points at, the counts are 0,
+        # as for `_get_unread_counts_by_receipt_txn`.
+        results = {
+            room_id: {"notify_count": 0, "highlight_count": 0}
+            for room_id in last_read_event_ids
+        }
+
+        for batch in batch_iter(iteritems(last_read_event_ids), 100):
+            sql = """
+                SELECT e.room_id, e.event_id,
+                    (
+                        SELECT count(*) FROM event_push_actions AS ea
+                        WHERE ea.user_id = ?
+                            AND ea.room_id = e.room_id
+                            AND ea.stream_ordering > e.stream_ordering
+                    ),
+                    (
+                        SELECT count(*) FROM event_push_actions AS ea
+                        WHERE ea.user_id = ?
+                            AND ea.room_id = e.room_id
+                            AND ea.stream_ordering > e.stream_ordering
+                            AND ea.highlight = 1
+                    ),
+                    (
+                        SELECT notif_count FROM event_push_summary AS s
+                        WHERE s.user_id = ?
+                            AND s.room_id = e.room_id
+                            AND s.stream_ordering > e.stream_ordering
+                    )
+                FROM events AS e
+                WHERE e.event_id IN (%s)
+            """ % (",".join("?" for _ in batch),)
+            txn.execute(
+                sql,
+                [user_id, user_id, user_id] + [event_id for _, event_id in batch],
+            )
+
+            for room_id, event_id, notif_count, highlight_count, summary_count in txn:
+                if last_read_event_ids.get(room_id) != event_id:
+                    continue
+                results[room_id] = {
+                    "notify_count": notif_count + (summary_count or 0),
+                    "highlight_count": highlight_count,
+                }
+
+        return results
+
     def _get_unread_counts_by_receipt_txn(self, txn, room_id, user_id,
                                           last_read_event_id):
         sql = (
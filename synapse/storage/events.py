@@ -817,7 +817,9 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
 
         max_stream_order = events_and_contexts[-1][0].internal_metadata.stream_ordering
 
-        self._update_current_state_txn(txn, state_delta_for_room, max_stream_order)
+        member_changes_by_room = self._update_current_state_txn(
+            txn, state_delta_for_room, max_stream_order,
+        )
 
         self._update_forward_extremities_txn(
             txn,
@@ -902,10 +904,31 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
             backfilled=backfilled,
         )
 
+        # Now that the new membership events are in room_memberships, we can
+        # bring the room summaries and joined hosts up to date.
+        self._update_room_summaries_txn(txn, member_changes_by_room)
+        self._update_room_joined_hosts_txn(txn, member_changes_by_room)
+
     def _update_current_state_txn(self, txn, state_delta_by_room, max_stream_order):
+        """Update the current state of rooms.
+
+        Returns:
+            dict[str, list[tuple[str, str|None, str|None]]]: map from room_id
+            to the changes to the membership of the room, as (user_id, previous
+            event_id, new event_id), for `_update_room_summaries_txn` and
+            `_update_room_joined_hosts_txn`.
+        """
+        member_changes_by_room = {}
+
         for room_id, current_state_tuple in iteritems(state_delta_by_room):
             to_delete, to_insert = current_state_tuple
 
+            member_changes = self._get_member_changes_txn(
+                txn, room_id, to_delete, to_insert,
+            )
+            if member_changes:
+                member_changes_by_room[room_id] = member_changes
+
             # First we add entries to the current_state_delta_stream. We
             # do this before updating the current_state_events table so
             # that we can use it to calculate the `prev_event_id`. (This
@@ -981,6 +1004,53 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
 
             self._invalidate_state_caches_and_stream(txn, room_id, members_changed)
 
+        return member_changes_by_room
+
+    def _get_member_changes_txn(self, txn, room_id, to_delete, to_insert):
+        """Work out how a current state delta changes the membership of a room.
+        Must be called before current_state_events is updated.
+
+        Args:
+            txn
+            room_id (str)
+            to_delete (list[tuple[str, str]]): type/state keys being removed from
+                the current state.
+            to_insert (dict[tuple[str, str], str]): the updates to the current
+                state.
+
+        Returns:
+            list[tuple[str, str|None, str|None]]: (user_id, previous event_id,
+            new event_id) for each member whose membership event changes.
+        """
+        user_ids = set(
+            state_key
+            for ev_type, state_key in itertools.chain(to_delete, to_insert)
+            if ev_type == EventTypes.Member
+        )
+        if not user_ids:
+            return []
+
+        prev_event_ids = {}
+        for batch in batch_iter(user_ids, 100):
+            rows = self._simple_select_many_txn(
+                txn,
+                table="current_state_events",
+                column="state_key",
+                iterable=batch,
+                keyvalues={"room_id": room_id, "type": EventTypes.Member},
+                retcols=("state_key", "event_id"),
+            )
+            prev_event_ids.update((r["state_key"], r["event_id"]) for r in rows)
+
+        return [
+            (
+                user_id,
+                prev_event_ids.get(user_id),
+                to_insert.get((EventTypes.Member, user_id)),
+            )
+            for user_id in user_ids
+        ]
+
     def _update_forward_extremities_txn(self, txn, new_forward_extremities,
                                         max_stream_order):
         for room_id, new_extrem in iteritems(new_forward_extremities):
@@ -2107,6 +2177,13 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
             ((sg,) for sg in state_groups_to_delete),
         )
 
+        logger.info("[purge] removing stale state resolutions")
+        txn.executemany(
+            "DELETE FROM resolved_state_groups"
+            " WHERE room_id = ? AND (state_group = ? OR prev_group = ?)",
+            ((room_id, sg, sg) for sg in state_groups_to_delete),
+        )
+
         logger.info("[purge] removing events from event_to_state_groups")
         txn.execute(
             "DELETE FROM event_to_state_groups "
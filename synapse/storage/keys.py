@@ -123,14 +123,60 @@ class KeyStore(SQLBaseStore):
                 keys[key_id] = key
         defer.returnValue(keys)
 
+    def get_server_signature_keys(self, server_name_and_key_ids):
+        """Retrieve the NACL verification keys for the given servers and
+        key_ids, in a single transaction.
+
+        Args:
+            server_name_and_key_ids (iterable[(str, iterable[str])]):
+                list of (server_name, iterable[key_id]) tuples to fetch keys for
+
+        Returns:
+            Deferred[dict[str, dict[str, VerifyKey]]]: map from server_name ->
+                key_id -> VerifyKey. Each VerifyKey has a `valid_until_ts`
+                attribute, which is None if we don't know when it expires.
+        """
+        server_name_and_key_ids = [
+            (server_name, list(key_ids))
+            for server_name, key_ids in server_name_and_key_ids
+        ]
+
+        def _get_server_signature_keys_txn(txn):
+            results = {}
+            for server_name, key_ids in server_name_and_key_ids:
+                keys = results.setdefault(server_name, {})
+                if not key_ids:
+                    continue
+
+                sql = (
+                    "SELECT key_id, verify_key, ts_valid_until_ms"
+                    " FROM server_signature_keys"
+                    " WHERE server_name = ? AND key_id IN (%s)"
+                ) % (",".join("?" for _ in key_ids),)
+                txn.execute(sql, [server_name] + key_ids)
+
+                for key_id, verify_key_bytes, ts_valid_until_ms in txn:
+                    verify_key = decode_verify_key_bytes(
+                        key_id, bytes(verify_key_bytes),
+                    )
+                    verify_key.valid_until_ts = ts_valid_until_ms
+                    keys[key_id] = verify_key
+            return results
+
+        return self.runInteraction(
+            "get_server_signature_keys", _get_server_signature_keys_txn,
+        )
+
     def store_server_verify_key(self, server_name, from_server, time_now_ms,
-                                verify_key):
+                                verify_key, ts_valid_until_ms=None):
         """Stores a NACL verification key for the given server.
         Args:
             server_name (str): The name of the server.
             from_server (str): Where the verification key was looked up
             time_now_ms (int): The time now in milliseconds
             verify_key (nacl.signing.VerifyKey): The NACL verify key.
+            ts_valid_until_ms (int|None): When the key stops being valid, if
+                known.
         """
         key_id = "%s:%s" % (verify_key.alg, verify_key.version)
 
@@ -147,6 +193,7 @@ class KeyStore(SQLBaseStore):
                     "from_server": from_server,
                     "ts_added_ms": time_now_ms,
                     "verify_key": db_binary_type(verify_key.encode()),
+                    "ts_valid_until_ms": ts_valid_until_ms,
                 },
             )
             txn.call_after(
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+
+from twisted.internet import defer
+
+from synapse.metrics.background_process_metrics import run_as_background_process
+from synapse.storage._base import SQLBaseStore
+from synapse.util import batch_iter
+
+logger = logging.getLogger(__name__)
+
+# How long we remember that a member was sent to a device for. If the device
+# is still syncing after this, it may be sent the member again.
+LAZY_LOADED_MEMBERS_MAX_AGE = 7 * 24 * 60 * 60 * 1000
+
+# The most members we remember sending to any one device. Beyond this, the
+# ones which were sent longest ago are forgotten.
+LAZY_LOADED_MEMBERS_MAX_PER_DEVICE = 10000
+
+
+class LazyLoadedMembersStore(SQLBaseStore):
+    """Tracks which membership events have been sent to each device by syncs
+    which lazy-load members, so that they aren't sent again.
+
+    This lives in the database rather than in memory so that it is shared
+    between synchrotrons and survives restarts.
+    """
+
+    def __init__(self, db_conn, hs):
+        super(LazyLoadedMembersStore, self).__init__(db_conn, hs)
+
+        self._clock.looping_call(
+            self._start_prune_sent_lazy_loaded_members, 60 * 60 * 1000,
+        )
+
+    def get_sent_lazy_loaded_members(self, user_id, device_id, event_ids):
+        """Find which of the given membership events have already been sent
+        to a device.
+
+        Args:
+            user_id (str)
+            device_id (str)
+            event_ids (Iterable[str])
+
+        Returns:
+            Deferred[set[str]]: the subset of `event_ids` that were sent.
+        """
+        event_ids = list(event_ids)
+        if not event_ids:
+            return defer.succeed(set())
+
+        def _get_sent_lazy_loaded_members_txn(txn):
+            sent = set()
+            for batch in batch_iter(event_ids, 100):
+                sql = (
+                    "SELECT event_id FROM lazy_loaded_members_sent"
+                    " WHERE user_id = ? AND device_id = ? AND event_id IN (%s)"
+                ) % (",".join("?" for _ in batch),)
+                txn.execute(sql, [user_id, device_id] + list(batch))
+                sent.update(event_id for event_id, in txn)
+            return sent
+
+        return self.runInteraction(
+            "get_sent_lazy_loaded_members", _get_sent_lazy_loaded_members_txn,
+        )
+
+    def add_sent_lazy_loaded_members(self, user_id, device_id, event_ids):
+        """Record that some membership events have been sent to a device.
+
+        Args:
+            user_id (str)
+            device_id (str)
+            event_ids (Iterable[str])
+
+        Returns:
+            Deferred
+        """
+        event_ids = list(event_ids)
+        now = self._clock.time_msec()
+
+        def _add_sent_lazy_loaded_members_txn(txn):
+            self._simple_upsert_many_txn(
+                txn,
+                table="lazy_loaded_members_sent",
+                key_names=("user_id", "device_id", "event_id"),
+                key_values=[
+                    (user_id, device_id, event_id) for event_id in event_ids
+                ],
+                value_names=("last_sent_ts",),
+                value_values=[(now,) for _ in event_ids],
+            )
+
+            txn.execute(
+                "SELECT COUNT(*) FROM lazy_loaded_members_sent"
+                " WHERE user_id = ? AND device_id = ?",
+                (user_id, device_id),
+            )
+            count, = txn.fetchone()
+            if count <= LAZY_LOADED_MEMBERS_MAX_PER_DEVICE:
+                return
+
+            txn.execute(
+                "DELETE FROM lazy_loaded_members_sent"
+                " WHERE user_id = ? AND device_id = ? AND event_id IN ("
+                "     SELECT event_id FROM lazy_loaded_members_sent"
+                "     WHERE user_id = ? AND device_id = ?"
+                "     ORDER BY last_sent_ts ASC LIMIT ?"
+                " )",
+                (
+                    user_id, device_id, user_id, device_id,
+                    count - LAZY_LOADED_MEMBERS_MAX_PER_DEVICE,
+                ),
+            )
+
+        return self.runInteraction(
+            "add_sent_lazy_loaded_members", _add_sent_lazy_loaded_members_txn,
+        )
+
+    def delete_sent_lazy_loaded_members(self, user_id, device_id):
+        """Forget which membership events have been sent to a device, e.g.
+        because it is starting a new sync sequence or has been deleted.
+
+        Args:
+            user_id (str)
+            device_id (str)
+
+        Returns:
+            Deferred
+        """
+        return self._simple_delete(
+            table="lazy_loaded_members_sent",
+            keyvalues={"user_id": user_id, "device_id": device_id},
+            desc="delete_sent_lazy_loaded_members",
+        )
+
+    def _start_prune_sent_lazy_loaded_members(self):
+        return run_as_background_process(
+            "prune_sent_lazy_loaded_members", self._prune_sent_lazy_loaded_members,
+        )
+
+    def _prune_sent_lazy_loaded_members(self):
+        """Forget about members which haven't been sent to a device for a
+        while, so that the table doesn't grow without bound for devices which
+        never do another initial sync.
+        """
+        cutoff = self._clock.time_msec() - LAZY_LOADED_MEMBERS_MAX_AGE
+
+        def _prune_sent_lazy_loaded_members_txn(txn):
+            txn.execute(
+                "DELETE FROM lazy_loaded_members_sent WHERE last_sent_ts < ?",
+                (cutoff,),
+            )
+
+        return self.runInteraction(
+            "prune_sent_lazy_loaded_members", _prune_sent_lazy_loaded_members_txn,
+        )
@@ -26,6 +26,7 @@ from twisted.internet import defer
 from synapse.api.constants import EventTypes, Membership
 from synapse.storage.events_worker import EventsWorkerStore
 from synapse.types import get_domain_from_id
+from synapse.util import batch_iter
 from synapse.util.async_helpers import Linearizer
 from synapse.util.caches import intern_string
 from synapse.util.caches.descriptors import cached, cachedInlineCallbacks
@@ -58,19 +59,63 @@ MemberSummary = namedtuple(
     "MemberSummary", ("members", "count")
 )
 
+# The number of members we keep in a room summary for calculating heroes: 5
+# (the number of heroes) plus 1, in case one of them is the calling user.
+ROOM_SUMMARY_MEMBERS_LIMIT = 6
+
 _MEMBERSHIP_PROFILE_UPDATE_NAME = "room_membership_profile_update"
 
 
 class RoomMemberWorkerStore(EventsWorkerStore):
-    @cachedInlineCallbacks(max_entries=100000, iterable=True, cache_context=True)
-    def get_hosts_in_room(self, room_id, cache_context):
+    @cached(max_entries=100000, iterable=True)
+    def get_hosts_in_room(self, room_id):
         """Returns the set of all hosts currently in the room
+
+        This is read from room_joined_hosts, which is kept up to date as the
+        room's current state changes, rather than from the room's members.
+
+        Returns:
+            Deferred[frozenset[str]]
         """
-        user_ids = yield self.get_users_in_room(
-            room_id, on_invalidate=cache_context.invalidate,
+        def _get_hosts_in_room_txn(txn):
+            hosts = self._simple_select_onecol_txn(
+                txn,
+                table="room_joined_hosts",
+                keyvalues={"room_id": room_id},
+                retcol="host",
+            )
+            if not hosts:
+                # The room's joined hosts haven't been recorded yet.
+                hosts = self._calculate_joined_hosts_txn(txn, room_id)
+            return frozenset(intern_string(host) for host in hosts)
+
+        return self.runInteraction("get_hosts_in_room", _get_hosts_in_room_txn)
+
+    def _calculate_joined_hosts_txn(self, txn, room_id):
+        """Work out the hosts in a room from its current state.
+
+        Args:
+            txn
+            room_id (str)
+
+        Returns:
+            dict[str, int]: the number of joined members on each host.
+        """
+        sql = (
+            "SELECT m.user_id FROM room_memberships as m"
+            " INNER JOIN current_state_events as c"
+            " ON m.event_id = c.event_id "
+            " AND m.room_id = c.room_id "
+            " AND m.user_id = c.state_key"
+            " WHERE c.type = 'm.room.member' AND c.room_id = ? AND m.membership = ?"
         )
-        hosts = frozenset(get_domain_from_id(user_id) for user_id in user_ids)
-        defer.returnValue(hosts)
+        txn.execute(sql, (room_id, Membership.JOIN,))
+
+        joined_members_by_host = {}
+        for user_id, in txn:
+            host = get_domain_from_id(user_id)
+            joined_members_by_host[host] = joined_members_by_host.get(host, 0) + 1
+        return joined_members_by_host
 
     @cached(max_entries=100000, iterable=True)
     def get_users_in_room(self, room_id):
@@ -100,53 +145,88 @@ class RoomMemberWorkerStore(EventsWorkerStore):
         """
 
         def _get_room_summary_txn(txn):
-            # first get counts.
-            # We do this all in one transaction to keep the cache small.
-            # FIXME: get rid of this when we have room_stats
-            sql = """
-                SELECT count(*), m.membership FROM room_memberships as m
-                 INNER JOIN current_state_events as c
-                 ON m.event_id = c.event_id
-                 AND m.room_id = c.room_id
-                 AND m.user_id = c.state_key
-                 WHERE c.type = 'm.room.member' AND c.room_id = ?
-                 GROUP BY m.membership
-            """
-
-            txn.execute(sql, (room_id,))
+            row = self._simple_select_one_txn(
+                txn,
+                table="room_summaries",
+                keyvalues={"room_id": room_id},
+                retcols=("membership_counts", "members"),
+                allow_none=True,
+            )
+            if row:
+                counts = json.loads(row["membership_counts"])
+                members = json.loads(row["members"])
+            else:
+                # We only store a summary once the room's membership changes, so
+                # work it out from scratch.
+                counts, members = self._calculate_room_summary_txn(txn, room_id)
+
             res = {}
-            for count, membership in txn:
-                summary = res.setdefault(to_ascii(membership), MemberSummary([], count))
-
-            # we order by membership and then fairly arbitrarily by event_id so
-            # heroes are consistent
-            sql = """
-                SELECT m.user_id, m.membership, m.event_id
-                FROM room_memberships as m
-                 INNER JOIN current_state_events as c
-                 ON m.event_id = c.event_id
-                 AND m.room_id = c.room_id
-                 AND m.user_id = c.state_key
-                 WHERE c.type = 'm.room.member' AND c.room_id = ?
-                 ORDER BY
-                    CASE m.membership WHEN ? THEN 1 WHEN ? THEN 2 ELSE 3 END ASC,
-                    m.event_id ASC
-                 LIMIT ?
-            """
-
-            # 6 is 5 (number of heroes) plus 1, in case one of them is the calling user.
-            txn.execute(sql, (room_id, Membership.JOIN, Membership.INVITE, 6))
-            for user_id, membership, event_id in txn:
-                summary = res[to_ascii(membership)]
+            for membership, count in iteritems(counts):
+                res[to_ascii(membership)] = MemberSummary([], count)
+
+            for user_id, membership, event_id in members:
                 # we will always have a summary for this membership type at this
                 # point given the summary currently contains the counts.
-                members = summary.members
-                members.append((to_ascii(user_id), to_ascii(event_id)))
+                res[to_ascii(membership)].members.append(
+                    (to_ascii(user_id), to_ascii(event_id)),
+                )
 
             return res
 
         return self.runInteraction("get_room_summary", _get_room_summary_txn)
 
+    def _calculate_room_summary_txn(self, txn, room_id):
+        """Work out the summary of a room's membership from its current state.
+
+        Args:
+            txn
+            room_id (str)
+
+        Returns:
+            tuple[dict[str, int], list[list[str]]]: the number of members with
+            each membership, and the first `ROOM_SUMMARY_MEMBERS_LIMIT` members
+            as [user_id, membership, event_id], ordered as by
+            `_room_summary_member_order`.
+        """
+        # We do this all in one transaction to keep the cache small.
+        # FIXME: get rid of this when we have room_stats
+        sql = """
+            SELECT count(*), m.membership FROM room_memberships as m
+             INNER JOIN current_state_events as c
+             ON m.event_id = c.event_id
+             AND m.room_id = c.room_id
+             AND m.user_id = c.state_key
+             WHERE c.type = 'm.room.member' AND c.room_id = ?
+             GROUP BY m.membership
+        """
+
+        txn.execute(sql, (room_id,))
+        counts = {membership: count for count, membership in txn}
+
+        # we order by membership and then fairly arbitrarily by event_id so
+        # heroes are consistent
+        sql = """
+            SELECT m.user_id, m.membership, m.event_id
+            FROM room_memberships as m
+             INNER JOIN current_state_events as c
+             ON m.event_id = c.event_id
+             AND m.room_id = c.room_id
+             AND m.user_id = c.state_key
+             WHERE c.type = 'm.room.member' AND c.room_id = ?
+             ORDER BY
+                CASE m.membership WHEN ? THEN 1 WHEN ? THEN 2 ELSE 3 END ASC,
+                m.event_id ASC
+             LIMIT ?
+        """
+
+        txn.execute(sql, (
+            room_id, Membership.JOIN, Membership.INVITE,
+            ROOM_SUMMARY_MEMBERS_LIMIT,
+        ))
+        members = [list(row) for row in txn]
+
+        return counts, members
+
     @cached()
     def get_invited_rooms_for_user(self, user_id):
         """ Get all the rooms the user is invited to
@@ -307,9 +387,11 @@ class RoomMemberWorkerStore(EventsWorkerStore):
             # To do this we set the state_group to a new object as object() != object()
             state_group = object()
 
-        current_state_ids = yield context.get_current_state_ids(self)
+        # We don't load the current state here, since we only need it if the
+        # result isn't already cached: `_get_joined_users_from_context` will
+        # pull it out of the context if necessary.
         result = yield self._get_joined_users_from_context(
-            event.room_id, state_group, current_state_ids,
+            event.room_id, state_group, None,
             event=event,
             context=context,
         )
@@ -339,11 +421,7 @@ class RoomMemberWorkerStore(EventsWorkerStore):
         assert state_group is not None
 
         users_in_room = {}
-        member_event_ids = [
-            e_id
-            for key, e_id in iteritems(current_state_ids)
-            if key[0] == EventTypes.Member
-        ]
+        member_event_ids = None
 
         if context is not None:
             # If we have a context with a delta from a previous state group,
@@ -364,6 +442,19 @@ class RoomMemberWorkerStore(EventsWorkerStore):
                     for etype, state_key in context.delta_ids:
                         users_in_room.pop(state_key, None)
 
+        if member_event_ids is None:
+            # `current_state_ids` may be None if the caller didn't want to load
+            # the full state unless we actually needed it, in which case we
+            # get it from the context.
+            if current_state_ids is None:
+                current_state_ids = yield context.get_current_state_ids(self)
+
+            member_event_ids = [
+                e_id
+                for key, e_id in iteritems(current_state_ids)
+                if key[0] == EventTypes.Member
+            ]
+
         # We check if we have any of the member event ids in the event cache
         # before we ask the DB
 
@@ -623,6 +714,211 @@ class RoomMemberStore(RoomMemberWorkerStore):
                         event.state_key,
                     ))
 
+    def _update_room_summaries_txn(self, txn, member_changes_by_room):
+        """Update the stored summaries of the membership of rooms, after their
+        current state has changed.
+
+        Must be called after the new membership events have been stored with
+        `_store_room_members_txn`.
+
+        Args:
+            txn
+            member_changes_by_room (dict[str, list[tuple[str, str|None, str|None]]]):
+                map from room_id to the membership changes in the current state
+                of that room, as (user_id, previous event_id, new event_id).
+                The event IDs are None if the user wasn't/isn't in the
+                current state.
+        """
+        for room_id, changes in iteritems(member_changes_by_room):
+            row = self._simple_select_one_txn(
+                txn,
+                table="room_summaries",
+                keyvalues={"room_id": room_id},
+                retcols=("membership_counts", "members"),
+                allow_none=True,
+            )
+            if not row:
+                counts, members = self._calculate_room_summary_txn(txn, room_id)
+                self._simple_insert_txn(
+                    txn,
+                    table="room_summaries",
+                    values={
+                        "room_id": room_id,
+                        "membership_counts": json.dumps(counts),
+                        "members": json.dumps(members),
+                    },
+                )
+                continue
+
+            counts = json.loads(row["membership_counts"])
+            members = json.loads(row["members"])
+            previous_total = sum(itervalues(counts))
+
+            membership_by_event_id = self._get_member_change_memberships_txn(
+                txn, changes,
+            )
+
+            changed_user_ids = set()
+            new_members = []
+            for user_id, prev_event_id, new_event_id in changes:
+                changed_user_ids.add(user_id)
+
+                membership = membership_by_event_id.get(prev_event_id)
+                if membership:
+                    counts[membership] = counts.get(membership, 0) - 1
+                    if counts[membership] <= 0:
+                        del counts[membership]
+
+                membership = membership_by_event_id.get(new_event_id)
+                if membership:
+                    counts[membership] = counts.get(membership, 0) + 1
+                    new_members.append([user_id, membership, new_event_id])
+
+            remaining_members = [
+                m for m in members if m[0] not in changed_user_ids
+            ]
+            if (
+                len(remaining_members) < len(members)
+                and previous_total > len(members)
+            ):
+                # One of the members we'd kept has changed, and we don't know
+                # which of the members we hadn't kept should replace them.
+                _, members = self._calculate_room_summary_txn(txn, room_id)
+            else:
+                members = sorted(
+                    remaining_members + new_members,
+                    key=_room_summary_member_order,
+                )[:ROOM_SUMMARY_MEMBERS_LIMIT]
+
+            self._simple_update_one_txn(
+                txn,
+                table="room_summaries",
+                keyvalues={"room_id": room_id},
+                updatevalues={
+                    "membership_counts": json.dumps(counts),
+                    "members": json.dumps(members),
+                },
+            )
+
+    def _update_room_joined_hosts_txn(self, txn, member_changes_by_room):
+        """Update the stored joined hosts of rooms, after their current state
+        has changed.
+
+        Must be called after the new membership events have been stored with
+        `_store_room_members_txn`.
+
+        Args:
+            txn
+            member_changes_by_room (dict[str, list[tuple[str, str|None, str|None]]]):
+                the membership changes in the current state of each room, as
+                for `_update_room_summaries_txn`.
+        """
+        for room_id, changes in iteritems(member_changes_by_room):
+            rows = self._simple_select_list_txn(
+                txn,
+                table="room_joined_hosts",
+                keyvalues={"room_id": room_id},
+                retcols=("host", "joined_members"),
+            )
+            if not rows:
+                joined_members_by_host = self._calculate_joined_hosts_txn(
+                    txn, room_id,
+                )
+                self._simple_insert_many_txn(
+                    txn,
+                    table="room_joined_hosts",
+                    values=[
+                        {
+                            "room_id": room_id,
+                            "host": host,
+                            "joined_members": joined_members,
+                        }
+                        for host, joined_members in iteritems(joined_members_by_host)
+                    ],
+                )
+                continue
+
+            prev_joined_members_by_host = {
+                r["host"]: r["joined_members"] for r in rows
+            }
+            joined_members_by_host = dict(prev_joined_members_by_host)
+
+            membership_by_event_id = self._get_member_change_memberships_txn(
+                txn, changes,
+            )
+            for user_id, prev_event_id, new_event_id in changes:
+                host = get_domain_from_id(user_id)
+                delta = 0
+                if membership_by_event_id.get(prev_event_id) == Membership.JOIN:
+                    delta -= 1
+                if membership_by_event_id.get(new_event_id) == Membership.JOIN:
+                    delta += 1
+                if delta:
+                    joined_members_by_host[host] = (
+                        joined_members_by_host.get(host, 0) + delta
+                    )
+
+            for host, joined_members in iteritems(joined_members_by_host):
+                prev_joined_members = prev_joined_members_by_host.get(host)
+                if joined_members == prev_joined_members:
+                    continue
+
+                if joined_members <= 0:
+                    self._simple_delete_txn(
+                        txn,
+                        table="room_joined_hosts",
+                        keyvalues={"room_id": room_id, "host": host},
+                    )
+                elif prev_joined_members is None:
+                    self._simple_insert_txn(
+                        txn,
+                        table="room_joined_hosts",
+                        values={
+                            "room_id": room_id,
+                            "host": host,
+                            "joined_members": joined_members,
+                        },
+                    )
+                else:
+                    self._simple_update_one_txn(
+                        txn,
+                        table="room_joined_hosts",
+                        keyvalues={"room_id": room_id, "host": host},
+                        updatevalues={"joined_members": joined_members},
+                    )
+
+    def _get_member_change_memberships_txn(self, txn, changes):
+        """Look up the memberships of the events in some membership changes.
+
+        Args:
+            txn
+            changes (list[tuple[str, str|None, str|None]]): (user_id, previous
+                event_id, new event_id)
+
+        Returns:
+            dict[str, str]: map from event_id to membership.
+        """
+        event_ids = [
+            event_id
+            for _, prev_event_id, new_event_id in changes
+            for event_id in (prev_event_id, new_event_id)
+            if event_id
+        ]
+        membership_by_event_id = {}
+        for batch in batch_iter(event_ids, 100):
+            rows = self._simple_select_many_txn(
+                txn,
+                table="room_memberships",
+                column="event_id",
+                iterable=batch,
+                keyvalues={},
+                retcols=("event_id", "membership"),
+            )
+            membership_by_event_id.update(
+                (r["event_id"], r["membership"]) for r in rows
+            )
+        return membership_by_event_id
+
     @defer.inlineCallbacks
     def locally_reject_invite(self, user_id, room_id):
         sql = (
@@ -740,6 +1036,18 @@ class RoomMemberStore(RoomMemberWorkerStore):
         defer.returnValue(result)
 
 
+def _room_summary_member_order(member):
+    """Sort key for the [user_id, membership, event_id] members kept in a room
+    summary, matching the order used by `_calculate_room_summary_txn`.
+    """
+    _, membership, event_id = member
+    if membership == Membership.JOIN:
+        return (1, event_id)
+    if membership == Membership.INVITE:
+        return (2, event_id)
+    return (3, event_id)
+
+
 class _JoinedHostsCache(object):
     """Cache for joined hosts in a room that is optimised to handle updates
     via state deltas.
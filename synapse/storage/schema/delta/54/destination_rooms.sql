@@ -0,0 +1,39 @@
+/* Copyright 2019 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+/* The stream ordering of the most recent event in each room which has been
+ * queued for sending to each destination.
+ *
+ * Along with `destinations.last_successful_stream_ordering` this lets the
+ * federation sender work out which rooms a destination has missed events in
+ * while it was unreachable, so that it can be sent just the latest event in
+ * each of them when it comes back.
+ */
+CREATE TABLE destination_rooms (
+    destination TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    stream_ordering BIGINT NOT NULL
+);
+
+CREATE UNIQUE INDEX destination_rooms_destination_room_id
+    ON destination_rooms(destination, room_id);
+
+/* For finding the rooms a destination has missed events in. */
+CREATE INDEX destination_rooms_destination_stream_ordering
+    ON destination_rooms(destination, stream_ordering);
+
+/* The stream ordering of the most recent event which we have finished sending
+ * to the destination. */
+ALTER TABLE destinations ADD COLUMN last_successful_stream_ordering BIGINT;
@@ -0,0 +1,36 @@
+/* Copyright 2019 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+/* PDUs received in federation transactions whose signatures and hashes have
+ * been checked, but which have not yet been processed by their room.
+ *
+ * We respond to a transaction once its PDUs are in here, so they are kept
+ * until they have been processed. Any left over when an instance restarts are
+ * processed again by that instance, which is named by instance_name.
+ */
+CREATE TABLE federation_inbound_events_staging (
+    instance_name TEXT NOT NULL,
+    origin TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    event_id TEXT NOT NULL,
+    received_ts BIGINT NOT NULL,
+    event_json TEXT NOT NULL
+);
+
+CREATE UNIQUE INDEX federation_inbound_events_staging_origin_event_id
+    ON federation_inbound_events_staging(origin, event_id);
+
+CREATE INDEX federation_inbound_events_staging_instance_name_received_ts
+    ON federation_inbound_events_staging(instance_name, received_ts);
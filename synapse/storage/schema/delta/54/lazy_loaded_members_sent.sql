@@ -0,0 +1,34 @@
+/* Copyright 2019 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+/* Records the membership events which have been sent to each device by syncs
+ * which lazy-load members, so that any synchrotron can avoid sending them
+ * again. Membership event IDs are unique across rooms, so we don't need to
+ * key on the room. The rows for a device are cleared when it does an initial
+ * sync or is deleted, and rows which haven't been sent for a while are
+ * pruned.
+ */
+CREATE TABLE lazy_loaded_members_sent (
+    user_id TEXT NOT NULL,
+    device_id TEXT NOT NULL,
+    event_id TEXT NOT NULL,
+    last_sent_ts BIGINT NOT NULL
+);
+
+CREATE UNIQUE INDEX lazy_loaded_members_sent_key
+    ON lazy_loaded_members_sent(user_id, device_id, event_id);
+
+CREATE INDEX lazy_loaded_members_sent_ts
+    ON lazy_loaded_members_sent(last_sent_ts);
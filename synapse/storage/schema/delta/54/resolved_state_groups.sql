@@ -0,0 +1,34 @@
+/* Copyright 2019 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+/* Records the result of resolving state between a set of state groups, so
+ * that other workers (and this one after a restart) don't have to redo the
+ * resolution.
+ *
+ * `groups_digest` is a hash of the sorted state group IDs that were resolved.
+ * If the result was identical to one of the inputs then `state_group` is set;
+ * otherwise the result is stored as `delta_json` on top of the input
+ * `prev_group`.
+ */
+CREATE TABLE resolved_state_groups (
+    groups_digest TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    state_group BIGINT,
+    prev_group BIGINT,
+    delta_json TEXT
+);
+
+CREATE UNIQUE INDEX resolved_state_groups_digest ON resolved_state_groups(groups_digest);
+CREATE INDEX resolved_state_groups_room_id ON resolved_state_groups(room_id);
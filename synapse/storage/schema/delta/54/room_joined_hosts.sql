@@ -0,0 +1,29 @@
+/* Copyright 2019 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+/* The number of joined members each host has in each room's current state,
+ * as returned by `get_hosts_in_room`, which is kept up to date as the current
+ * state changes.
+ *
+ * Rooms only get rows the first time their membership changes; until then
+ * their hosts are calculated from current_state_events.
+ */
+CREATE TABLE room_joined_hosts (
+    room_id TEXT NOT NULL,
+    host TEXT NOT NULL,
+    joined_members INTEGER NOT NULL
+);
+
+CREATE UNIQUE INDEX room_joined_hosts_room_id_host ON room_joined_hosts(room_id, host);
@@ -0,0 +1,32 @@
+/* Copyright 2019 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+/* A summary of the membership of each room's current state, as returned by
+ * `get_room_summary`, which is kept up to date as the current state changes.
+ *
+ * `membership_counts` is a JSON object mapping each membership to the number
+ * of members with it. `members` is a JSON list of the first few members, as
+ * [user_id, membership, event_id], for calculating the room's heroes.
+ *
+ * Rooms only get a row the first time their membership changes; until then
+ * the summary is calculated from current_state_events.
+ */
+CREATE TABLE room_summaries (
+    room_id TEXT NOT NULL,
+    membership_counts TEXT NOT NULL,
+    members TEXT NOT NULL
+);
+
+CREATE UNIQUE INDEX room_summaries_room_id ON room_summaries(room_id);
@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import logging
 from collections import namedtuple
 
@@ -20,6 +21,8 @@ from six import iteritems, itervalues
 from six.moves import range
 
 import attr
+from canonicaljson import json
+from prometheus_client import Counter
 
 from twisted.internet import defer
 
@@ -39,6 +42,38 @@ logger = logging.getLogger(__name__)
 
 MAX_STATE_DELTA_HOPS = 100
 
+# The strategies that `StateFilter.plan_sql_filter_clause` can pick between.
+# See that function for details.
+STATE_FILTER_STRATEGY_FULL = "full"
+STATE_FILTER_STRATEGY_NONE = "none"
+STATE_FILTER_STRATEGY_OR_CHAIN = "or_chain"
+STATE_FILTER_STRATEGY_KEY_LIST = "key_list"
+STATE_FILTER_STRATEGY_TYPE_SCAN = "type_scan"
+
+# The maximum number of concrete (type, state_key) pairs for which we generate
+# a plain chain of `(type = ? AND state_key = ?)` clauses.
+STATE_FILTER_MAX_OR_CHAIN = 10
+
+# If we're asked for more than this many state_keys of a single type then we
+# fetch every event of that type and filter the results in python, rather than
+# sending a huge list of state keys to the database.
+STATE_FILTER_TYPE_SCAN_THRESHOLD = 2000
+
+# SQLite limits the number of bound parameters in a query (to 999 by default),
+# so we keep the number of arguments we generate below this.
+STATE_FILTER_SQLITE_MAX_ARGS = 900
+
+state_filter_query_counter = Counter(
+    "synapse_storage_state_filter_queries",
+    "Number of state queries by the strategy used to filter the state",
+    ["strategy"],
+)
+state_filter_discarded_rows_counter = Counter(
+    "synapse_storage_state_filter_discarded_rows",
+    "Number of rows fetched from the database that didn't match the state filter",
+    ["strategy"],
+)
+
 
 class _GetStateGroupDelta(namedtuple("_GetStateGroupDelta", ("prev_group", "delta_ids"))):
     """Return type of get_state_group_delta that implements __len__, which lets
@@ -50,6 +85,50 @@ class _GetStateGroupDelta(namedtuple("_GetStateGroupDelta", ("prev_group", "delt
         return len(self.delta_ids) if self.delta_ids else 0
 
 
+class _StateGroupResolution(namedtuple(
+    "_StateGroupResolution", ("state_group", "prev_group", "delta_ids"),
+)):
+    """Return type of get_state_group_resolution.
+
+    Either `state_group` is set, in which case the resolved state is identical
+    to the state of that group, or the resolved state is given by `delta_ids`
+    on top of the state at `prev_group`.
+    """
+    __slots__ = []
+
+
+def _get_state_groups_digest(state_groups):
+    """Generate a stable key for a set of state groups, which is independent
+    of the order they were given in.
+
+    Args:
+        state_groups (iterable[int])
+
+    Returns:
+        str
+    """
+    key = ",".join(str(sg) for sg in sorted(state_groups))
+    return hashlib.sha256(key.encode("ascii")).hexdigest()
+
+
+class StateFilterQueryPlan(namedtuple("StateFilterQueryPlan", (
+    "strategy", "where_clause", "where_args", "needs_filtering",
+))):
+    """Return type of `StateFilter.plan_sql_filter_clause`.
+
+    Attributes:
+        strategy (str): the name of the strategy picked, one of the
+            STATE_FILTER_STRATEGY_* constants.
+        where_clause (str): the SQL clause (may be empty, if the filter
+            matches everything)
+        where_args (list): the arguments for `where_clause`
+        needs_filtering (bool): whether `where_clause` may match more state
+            than the filter, in which case the results need to be filtered
+            with `StateFilter.filter_state`.
+    """
+    __slots__ = []
+
+
 @attr.s(slots=True)
 class StateFilter(object):
     """A filter used when querying for state.
@@ -250,6 +329,114 @@ class StateFilter(object):
 
         return where_clause, where_args
 
+    def plan_sql_filter_clause(self, database_engine):
+        """Converts the filter to an SQL clause, picking a strategy based on the
+        shape and size of the filter:
+
+        * `full` and `none`: the filter matches everything or nothing.
+        * `or_chain`: for small filters, a chain of
+          `(type = ? AND state_key = ?)` clauses, as `make_sql_filter_clause`.
+        * `key_list`: one clause per type, matching the state keys with
+          `state_key = ANY(?)` on postgres or `state_key IN (...)` on sqlite.
+          This keeps the query (and the time postgres spends planning it)
+          small when lazy loading the members of many senders.
+        * `type_scan`: for types with too many state keys to send to the
+          database, we fetch every event of that type and the rows need to be
+          filtered with `filter_state` afterwards.
+
+        Args:
+            database_engine: the engine the query will be run against
+
+        Returns:
+            StateFilterQueryPlan
+        """
+        if self.is_full():
+            return StateFilterQueryPlan(
+                STATE_FILTER_STRATEGY_FULL, "", [], False,
+            )
+
+        if not self.include_others and not self.types:
+            return StateFilterQueryPlan(
+                STATE_FILTER_STRATEGY_NONE, "1 = 2", [], False,
+            )
+
+        concrete_count = sum(
+            len(state_keys)
+            for state_keys in itervalues(self.types)
+            if state_keys is not None
+        )
+        if concrete_count <= STATE_FILTER_MAX_OR_CHAIN:
+            where_clause, where_args = self.make_sql_filter_clause()
+            return StateFilterQueryPlan(
+                STATE_FILTER_STRATEGY_OR_CHAIN, where_clause, where_args, False,
+            )
+
+        is_postgres = isinstance(database_engine, PostgresEngine)
+
+        strategy = STATE_FILTER_STRATEGY_KEY_LIST
+        clauses = []
+        where_args = []
+
+        # Handle the types with the most state keys last, so that on sqlite
+        # it's the big ones that get turned into type scans if we run out of
+        # arguments.
+        sorted_types = sorted(
+            iteritems(self.types),
+            key=lambda item: len(item[1]) if item[1] is not None else 0,
+        )
+        for etype, state_keys in sorted_types:
+            if state_keys is None:
+                clauses.append("(type = ?)")
+                where_args.append(etype)
+                continue
+
+            if not state_keys:
+                continue
+
+            use_type_scan = len(state_keys) > STATE_FILTER_TYPE_SCAN_THRESHOLD
+            if not is_postgres:
+                # account for the arguments needed by the `NOT IN` clause below
+                args_needed = len(where_args) + len(state_keys) + 1
+                if self.include_others:
+                    args_needed += len(self.types)
+                use_type_scan |= args_needed > STATE_FILTER_SQLITE_MAX_ARGS
+
+            if use_type_scan:
+                strategy = STATE_FILTER_STRATEGY_TYPE_SCAN
+                clauses.append("(type = ?)")
+                where_args.append(etype)
+            elif len(state_keys) == 1:
+                clauses.append("(type = ? AND state_key = ?)")
+                where_args.extend((etype, next(iter(state_keys))))
+            elif is_postgres:
+                clauses.append("(type = ? AND state_key = ANY(?))")
+                where_args.extend((etype, list(state_keys)))
+            else:
+                clauses.append("(type = ? AND state_key IN (%s))" % (
+                    ",".join(["?"] * len(state_keys)),
+                ))
+                where_args.append(etype)
+                where_args.extend(state_keys)
+
+        if self.include_others:
+            clauses.append("type NOT IN (%s)" % (
+                ",".join(["?"] * len(self.types)),
+            ))
+            where_args.extend(self.types)
+
+        if not clauses:
+            # all the types had empty sets of state keys
+            return StateFilterQueryPlan(
+                STATE_FILTER_STRATEGY_NONE, "1 = 2", [], False,
+            )
+
+        return StateFilterQueryPlan(
+            strategy,
+            " OR ".join(clauses),
+            where_args,
+            strategy == STATE_FILTER_STRATEGY_TYPE_SCAN,
+        )
+
     def max_entries_returned(self):
         """Returns the maximum number of entries this filter will return if
         known, otherwise returns None.
@@ -362,6 +549,25 @@ class StateFilter(object):
         return member_filter, non_member_filter
 
 
+def _filter_planned_results(plan, state_filter, state_dict):
+    """Filter the rows returned by a query using a StateFilterQueryPlan that
+    needs filtering, and record how many rows we threw away.
+
+    Args:
+        plan (StateFilterQueryPlan)
+        state_filter (StateFilter)
+        state_dict (dict[tuple[str, str], str])
+
+    Returns:
+        dict[tuple[str, str], str]
+    """
+    filtered = state_filter.filter_state(state_dict)
+    state_filter_discarded_rows_counter.labels(plan.strategy).inc(
+        len(state_dict) - len(filtered),
+    )
+    return filtered
+
+
 # this inherits from EventsWorkerStore because it calls self.get_events
 class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
     """The parts of StateGroupStore that can be called from workers.
@@ -528,19 +734,23 @@ class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
                 WHERE room_id = ?
             """
 
-            where_clause, where_args = state_filter.make_sql_filter_clause()
+            plan = state_filter.plan_sql_filter_clause(self.database_engine)
+            state_filter_query_counter.labels(plan.strategy).inc()
 
-            if where_clause:
-                sql += " AND (%s)" % (where_clause,)
+            if plan.where_clause:
+                sql += " AND (%s)" % (plan.where_clause,)
 
             args = [room_id]
-            args.extend(where_args)
+            args.extend(plan.where_args)
             txn.execute(sql, args)
             for row in txn:
                 typ, state_key, event_id = row
                 key = (intern_string(typ), intern_string(state_key))
                 results[key] = event_id
 
+            if plan.needs_filtering:
+                results = _filter_planned_results(plan, state_filter, results)
+
             return results
 
         return self.runInteraction(
@@ -613,6 +823,84 @@ class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
             _get_state_group_delta_txn,
         )
 
+    @defer.inlineCallbacks
+    def get_state_group_resolution(self, state_groups):
+        """Look up a previously stored result of resolving state between the
+        given state groups.
+
+        Args:
+            state_groups (iterable[int]): the state groups that were resolved
+
+        Returns:
+            Deferred[_StateGroupResolution|None]: None if we have not stored a
+                resolution for this set of state groups.
+        """
+        row = yield self._simple_select_one(
+            table="resolved_state_groups",
+            keyvalues={
+                "groups_digest": _get_state_groups_digest(state_groups),
+            },
+            retcols=("state_group", "prev_group", "delta_json"),
+            allow_none=True,
+            desc="get_state_group_resolution",
+        )
+
+        if not row:
+            defer.returnValue(None)
+
+        delta_ids = None
+        if row["delta_json"] is not None:
+            delta_ids = {
+                (typ, state_key): event_id
+                for typ, state_key, event_id in json.loads(row["delta_json"])
+            }
+
+        defer.returnValue(_StateGroupResolution(
+            state_group=row["state_group"],
+            prev_group=row["prev_group"],
+            delta_ids=delta_ids,
+        ))
+
+    def store_state_group_resolution(self, room_id, state_groups, state_group,
+                                     prev_group, delta_ids):
+        """Record the result of resolving state between the given state groups,
+        so that it can be reused by other workers and across restarts.
+
+        Args:
+            room_id (str)
+            state_groups (iterable[int]): the state groups that were resolved
+            state_group (int|None): set if the resolved state is identical to
+                that of one of the input state groups.
+            prev_group (int|None): otherwise, the input state group that the
+                resolved state is based on.
+            delta_ids (dict|None): the delta between the state at `prev_group`
+                and the resolved state. Map of (type, state_key) to event_id.
+
+        Returns:
+            Deferred
+        """
+        delta_json = None
+        if delta_ids is not None:
+            delta_json = json.dumps([
+                [typ, state_key, event_id]
+                for (typ, state_key), event_id in iteritems(delta_ids)
+            ])
+
+        return self._simple_upsert(
+            table="resolved_state_groups",
+            keyvalues={
+                "groups_digest": _get_state_groups_digest(state_groups),
+            },
+            values={
+                "room_id": room_id,
+                "state_group": state_group,
+                "prev_group": prev_group,
+                "delta_json": delta_json,
+            },
+            desc="store_state_group_resolution",
+            lock=False,
+        )
+
     @defer.inlineCallbacks
     def get_state_groups_ids(self, _room_id, event_ids):
         """Get the event IDs of all the state for the state groups for the given events
@@ -637,17 +925,34 @@ class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
 
         defer.returnValue(group_to_state)
 
+    def get_state_groups_for_events(self, event_ids):
+        """Get the state groups for the given events, without loading the state
+        in those groups.
+
+        Args:
+            event_ids (iterable[str])
+
+        Returns:
+            Deferred[dict[str, int]]: map from event_id to state group. Events
+                which we don't have a state group for are omitted.
+        """
+        return self._get_state_group_for_events(event_ids)
+
     @defer.inlineCallbacks
-    def get_state_ids_for_group(self, state_group):
+    def get_state_ids_for_group(self, state_group, state_filter=StateFilter.all()):
         """Get the event IDs of all the state in the given state group
 
         Args:
             state_group (int)
+            state_filter (StateFilter): The state filter used to fetch state
+                from the database.
 
         Returns:
             Deferred[dict]: Resolves to a map of (type, state_key) -> event_id
         """
-        group_to_state = yield self._get_state_for_groups((state_group,))
+        group_to_state = yield self._get_state_for_groups(
+            (state_group,), state_filter,
+        )
 
         defer.returnValue(group_to_state[state_group])
 
@@ -710,7 +1015,10 @@ class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
     ):
         results = {group: {} for group in groups}
 
-        where_clause, where_args = state_filter.make_sql_filter_clause()
+        plan = state_filter.plan_sql_filter_clause(self.database_engine)
+        state_filter_query_counter.labels(plan.strategy).inc()
+
+        where_clause, where_args = plan.where_clause, plan.where_args
 
         # Unless the filter clause is empty, we're going to append it after an
         # existing where clause
@@ -756,6 +1064,11 @@ class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
                     typ, state_key, event_id = row
                     key = (typ, state_key)
                     results[group][key] = event_id
+
+                if plan.needs_filtering:
+                    results[group] = _filter_planned_results(
+                        plan, state_filter, results[group],
+                    )
         else:
             max_entries_returned = state_filter.max_entries_returned()
 
@@ -778,11 +1091,19 @@ class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
                         " WHERE state_group = ? " + where_clause,
                         args
                     )
-                    results[group].update(
-                        ((typ, state_key), event_id)
+                    rows = {
+                        (typ, state_key): event_id
                         for typ, state_key, event_id in txn
                         if (typ, state_key) not in results[group]
-                    )
+                    }
+
+                    # We have to filter each batch (rather than the final
+                    # result), as otherwise the extra rows would throw off the
+                    # `max_entries_returned` check below.
+                    if plan.needs_filtering:
+                        rows = _filter_planned_results(plan, state_filter, rows)
+
+                    results[group].update(rows)
 
                     # If the number of entries in the (type,state_key)->event_id dict
                     # matches the number of (type,state_keys) types we were searching
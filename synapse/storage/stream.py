@@ -34,10 +34,11 @@ what sort order was used:
 """
 
 import abc
+import itertools
 import logging
 from collections import namedtuple
 
-from six.moves import range
+from six import iteritems, itervalues
 
 from twisted.internet import defer
 
@@ -45,8 +46,8 @@ from synapse.storage._base import SQLBaseStore
 from synapse.storage.engines import PostgresEngine
 from synapse.storage.events_worker import EventsWorkerStore
 from synapse.types import RoomStreamToken
+from synapse.util import batch_iter
 from synapse.util.caches.stream_change_cache import StreamChangeCache
-from synapse.util.logcontext import make_deferred_yieldable, run_in_background
 
 logger = logging.getLogger(__name__)
 
@@ -191,7 +192,29 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
     @defer.inlineCallbacks
     def get_room_events_stream_for_rooms(self, room_ids, from_key, to_key, limit=0,
                                          order='DESC'):
+        """Get new room events in stream ordering since `from_key`, for each of
+        the given rooms.
+
+        The rooms are handled in chunks, each of which is looked up in a single
+        transaction followed by a single fetch of all the events.
+
+        Args:
+            room_ids (Iterable[str])
+            from_key (str): Token from which no events are returned before
+            to_key (str): Token from which no events are returned after. (This
+                is typically the current stream token)
+            limit (int): Maximum number of events to return per room
+            order (str): Either "DESC" or "ASC". See
+                `get_room_events_stream_for_room`.
+
+        Returns:
+            Deferred[dict[str, tuple[list[FrozenEvent], str]]]: A map from
+            room_id to the events and token for that room, as returned by
+            `get_room_events_stream_for_room`. Rooms which have not changed
+            since `from_key` are omitted.
+        """
         from_id = RoomStreamToken.parse_stream_token(from_key).stream
+        to_id = RoomStreamToken.parse_stream_token(to_key).stream
 
         room_ids = yield self._events_stream_cache.get_entities_changed(
             room_ids, from_id
@@ -200,17 +223,31 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
         if not room_ids:
             defer.returnValue({})
 
-        results = {}
-        room_ids = list(room_ids)
-        for rm_ids in (room_ids[i:i + 20] for i in range(0, len(room_ids), 20)):
-            res = yield make_deferred_yieldable(defer.gatherResults([
-                run_in_background(
-                    self.get_room_events_stream_for_room,
-                    room_id, from_key, to_key, limit, order=order,
+        if from_key == to_key:
+            defer.returnValue({room_id: ([], from_key) for room_id in room_ids})
+
+        def f(txn, rm_ids):
+            return {
+                room_id: self._get_room_events_stream_for_room_txn(
+                    txn, room_id, from_id, to_id, limit, order,
                 )
                 for room_id in rm_ids
-            ], consumeErrors=True))
-            results.update(dict(zip(rm_ids, res)))
+            }
+
+        results = {}
+        for rm_ids in batch_iter(room_ids, 100):
+            rows_by_room = yield self.runInteraction(
+                "get_room_events_stream_for_rooms", f, rm_ids,
+            )
+
+            event_map = yield self._get_events_for_rows(
+                itertools.chain.from_iterable(itervalues(rows_by_room)),
+            )
+
+            for room_id, rows in iteritems(rows_by_room):
+                results[room_id] = self._finish_room_events_stream(
+                    rows, event_map, from_id, from_key, order,
+                )
 
         defer.returnValue(results)
 
@@ -263,25 +300,37 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
         if not has_changed:
             defer.returnValue(([], from_key))
 
-        def f(txn):
-            sql = (
-                "SELECT event_id, stream_ordering FROM events WHERE"
-                " room_id = ?"
-                " AND not outlier"
-                " AND stream_ordering > ? AND stream_ordering <= ?"
-                " ORDER BY stream_ordering %s LIMIT ?"
-            ) % (order,)
-            txn.execute(sql, (room_id, from_id, to_id, limit))
+        rows = yield self.runInteraction(
+            "get_room_events_stream_for_room",
+            self._get_room_events_stream_for_room_txn,
+            room_id, from_id, to_id, limit, order,
+        )
 
-            rows = [_EventDictReturn(row[0], None, row[1]) for row in txn]
-            return rows
+        event_map = yield self._get_events_for_rows(rows)
 
-        rows = yield self.runInteraction("get_room_events_stream_for_room", f)
+        defer.returnValue(self._finish_room_events_stream(
+            rows, event_map, from_id, from_key, order,
+        ))
 
-        ret = yield self._get_events(
-            [r.event_id for r in rows],
-            get_prev_content=True
-        )
+    def _get_room_events_stream_for_room_txn(self, txn, room_id, from_id, to_id,
+                                             limit, order):
+        sql = (
+            "SELECT event_id, stream_ordering FROM events WHERE"
+            " room_id = ?"
+            " AND not outlier"
+            " AND stream_ordering > ? AND stream_ordering <= ?"
+            " ORDER BY stream_ordering %s LIMIT ?"
+        ) % (order,)
+        txn.execute(sql, (room_id, from_id, to_id, limit))
+
+        return [_EventDictReturn(row[0], None, row[1]) for row in txn]
+
+    def _finish_room_events_stream(self, rows, event_map, from_id, from_key, order):
+        """Turns the rows returned by `_get_room_events_stream_for_room_txn`
+        into the return value of `get_room_events_stream_for_room`.
+        """
+        rows = [r for r in rows if r.event_id in event_map]
+        ret = [event_map[r.event_id] for r in rows]
 
         self._set_before_and_after(ret, rows, topo_order=from_id is None)
 
@@ -295,7 +344,24 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
             # get.
             key = from_key
 
-        defer.returnValue((ret, key))
+        return ret, key
+
+    @defer.inlineCallbacks
+    def _get_events_for_rows(self, rows):
+        """Fetches the events for the given rows.
+
+        Args:
+            rows (Iterable[_EventDictReturn])
+
+        Returns:
+            Deferred[dict[str, FrozenEvent]]: map from event_id to event, for
+            those events that could be found.
+        """
+        events = yield self._get_events(
+            [r.event_id for r in rows],
+            get_prev_content=True
+        )
+        defer.returnValue({e.event_id: e for e in events})
 
     @defer.inlineCallbacks
     def get_membership_changes_for_user(self, user_id, from_key, to_key):
@@ -369,6 +435,62 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
 
         defer.returnValue((events, token))
 
+    @defer.inlineCallbacks
+    def get_recent_events_for_rooms(self, room_ids, limit, end_token):
+        """Get the most recent events in each of the given rooms in topological
+        ordering.
+
+        The rooms are handled in chunks, each of which is looked up in a single
+        transaction followed by a single fetch of all the events.
+
+        Args:
+            room_ids (Iterable[str])
+            limit (int): Maximum number of events to return per room
+            end_token (str): The stream token representing now.
+
+        Returns:
+            Deferred[dict[str, tuple[list[FrozenEvent], str]]]: A map from
+            room_id to the events and token for that room, as returned by
+            `get_recent_events_for_room`.
+        """
+        if limit == 0:
+            defer.returnValue({
+                room_id: ([], end_token) for room_id in room_ids
+            })
+
+        from_token = RoomStreamToken.parse(end_token)
+
+        def f(txn, rm_ids):
+            return {
+                room_id: self._paginate_room_events_txn(
+                    txn, room_id, from_token=from_token, limit=limit,
+                )
+                for room_id in rm_ids
+            }
+
+        results = {}
+        for rm_ids in batch_iter(room_ids, 100):
+            rows_by_room = yield self.runInteraction(
+                "get_recent_events_for_rooms", f, rm_ids,
+            )
+
+            event_map = yield self._get_events_for_rows(
+                itertools.chain.from_iterable(
+                    rows for rows, _ in itervalues(rows_by_room)
+                ),
+            )
+
+            for room_id, (rows, token) in iteritems(rows_by_room):
+                # We want to return the results in ascending order.
+                rows = [r for r in reversed(rows) if r.event_id in event_map]
+                events = [event_map[r.event_id] for r in rows]
+
+                self._set_before_and_after(events, rows)
+
+                results[room_id] = (events, token)
+
+        defer.returnValue(results)
+
     @defer.inlineCallbacks
     def get_recent_event_ids_for_room(self, room_id, limit, end_token):
         """Get the most recent events in the room in topological ordering.
@@ -427,6 +549,35 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
             "get_room_event_after_stream_ordering", _f,
         )
 
+    def get_last_event_in_room_before_stream_ordering(self, room_id, end_token):
+        """Gets the ID of the last event in a room at or before a stream token
+
+        Args:
+            room_id (str):
+            end_token (str): The token used to stream from
+
+        Returns:
+            Deferred[str|None]: the event ID, or None if the room has no
+                events before the token
+        """
+        stream_ordering = RoomStreamToken.parse(end_token).stream
+
+        def _f(txn):
+            sql = (
+                "SELECT event_id FROM events"
+                " WHERE room_id = ? AND stream_ordering <= ?"
+                " AND NOT outlier"
+                " ORDER BY stream_ordering DESC"
+                " LIMIT 1"
+            )
+            txn.execute(sql, (room_id, stream_ordering, ))
+            row = txn.fetchone()
+            return row[0] if row else None
+
+        return self.runInteraction(
+            "get_last_event_in_room_before_stream_ordering", _f,
+        )
+
     @defer.inlineCallbacks
     def get_room_events_max_id(self, room_id=None):
         """Returns the current token for rooms stream.
@@ -643,7 +794,8 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
              Deferred[Tuple[int, list[FrozenEvent]]]: A tuple of (next_id, events), where
              `next_id` is the next value to pass as `from_id` (it will either be the
              stream_ordering of the last returned event, or, if fewer than `limit` events
-             were found, `current_id`.
+             were found, `current_id`. The events have their
+             `internal_metadata.stream_ordering` set.
          """
 
         def get_all_new_events_stream_txn(txn):
@@ -663,29 +815,76 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
             if len(rows) == limit:
                 upper_bound = rows[-1][0]
 
-            return upper_bound, [row[1] for row in rows]
+            return upper_bound, rows
 
-        upper_bound, event_ids = yield self.runInteraction(
+        upper_bound, rows = yield self.runInteraction(
             "get_all_new_events_stream", get_all_new_events_stream_txn,
         )
 
-        events = yield self._get_events(event_ids)
+        events = yield self._get_events([event_id for _, event_id in rows])
+
+        stream_orderings = {
+            event_id: stream_ordering for stream_ordering, event_id in rows
+        }
+        for event in events:
+            event.internal_metadata.stream_ordering = stream_orderings[event.event_id]
 
         defer.returnValue((upper_bound, events))
 
     def get_federation_out_pos(self, typ):
-        return self._simple_select_one_onecol(
+        """Gets this federation sender's position in a stream.
+
+        Args:
+            typ (str): the stream, either "events" or "federation".
+
+        Returns:
+            Deferred[int]
+        """
+        return self.runInteraction(
+            "get_federation_out_pos", self._get_federation_out_pos_txn,
+            typ, self.hs.config.federation_sender_instance_name,
+        )
+
+    def _get_federation_out_pos_txn(self, txn, typ, instance_name):
+        stream_id = self._simple_select_one_onecol_txn(
+            txn,
             table="federation_stream_position",
+            keyvalues={"type": typ, "instance_name": instance_name},
             retcol="stream_id",
-            keyvalues={"type": typ},
-            desc="get_federation_out_pos"
+            allow_none=True,
         )
+        if stream_id is not None:
+            return stream_id
+
+        # This is a new federation sender shard, so start from the earliest
+        # position of the existing ones to be sure nothing is missed.
+        txn.execute(
+            "SELECT MIN(stream_id) FROM federation_stream_position WHERE type = ?",
+            (typ,),
+        )
+        stream_id, = txn.fetchone()
+        if stream_id is None:
+            stream_id = -1
+
+        self._simple_insert_txn(
+            txn,
+            table="federation_stream_position",
+            values={
+                "type": typ,
+                "instance_name": instance_name,
+                "stream_id": stream_id,
+            },
+        )
+        return stream_id
 
     def update_federation_out_pos(self, typ, stream_id):
-        return self._simple_update_one(
+        return self._simple_upsert(
             table="federation_stream_position",
-            keyvalues={"type": typ},
-            updatevalues={"stream_id": stream_id},
+            keyvalues={
+                "type": typ,
+                "instance_name": self.hs.config.federation_sender_instance_name,
+            },
+            values={"stream_id": stream_id},
             desc="update_federation_out_pos",
         )
 
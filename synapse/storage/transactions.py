@@ -286,6 +286,232 @@ class TransactionStore(SQLBaseStore):
         txn.execute(query, (self._clock.time_msec(),))
         return self.cursor_to_dict(txn)
 
+    def store_destination_rooms_entries(self, entries):
+        """Record the latest event in each room which has been queued for
+        sending to each destination.
+
+        Args:
+            entries (Iterable[tuple[str, int, Iterable[str]]]): a list of
+                (room_id, stream_ordering, destinations) for each event, in
+                stream order.
+
+        Returns:
+            Deferred
+        """
+        # Only the latest event in each room is kept per destination.
+        latest = {}
+        for room_id, stream_ordering, destinations in entries:
+            for destination in destinations:
+                latest[(destination, room_id)] = stream_ordering
+
+        if not latest:
+            return defer.succeed(None)
+
+        def _store_destination_rooms_entries_txn(txn):
+            self._simple_upsert_many_txn(
+                txn,
+                table="destination_rooms",
+                key_names=("destination", "room_id"),
+                key_values=list(latest.keys()),
+                value_names=("stream_ordering",),
+                value_values=[(stream_ordering,) for stream_ordering in latest.values()],
+            )
+
+        return self.runInteraction(
+            "store_destination_rooms_entries", _store_destination_rooms_entries_txn,
+        )
+
+    def get_destination_last_successful_stream_ordering(self, destination):
+        """Gets the stream ordering of the most recent event which we have
+        finished sending to the destination.
+
+        Args:
+            destination (str)
+
+        Returns:
+            Deferred[int|None]: None if we have never successfully sent the
+            destination an event.
+        """
+        return self._simple_select_one_onecol(
+            table="destinations",
+            keyvalues={"destination": destination},
+            retcol="last_successful_stream_ordering",
+            allow_none=True,
+            desc="get_destination_last_successful_stream_ordering",
+        )
+
+    def set_destination_last_successful_stream_ordering(
+        self, destination, last_successful_stream_ordering,
+    ):
+        """Sets the stream ordering of the most recent event which we have
+        finished sending to the destination.
+
+        Args:
+            destination (str)
+            last_successful_stream_ordering (int)
+
+        Returns:
+            Deferred
+        """
+        return self._simple_upsert(
+            table="destinations",
+            keyvalues={"destination": destination},
+            values={
+                "last_successful_stream_ordering": last_successful_stream_ordering,
+            },
+            desc="set_destination_last_successful_stream_ordering",
+        )
+
+    def get_catch_up_room_event_ids(self, destination, last_successful_stream_ordering,
+                                    limit=50):
+        """Gets the latest event in each room which the destination has missed
+        events in, oldest first.
+
+        Args:
+            destination (str)
+            last_successful_stream_ordering (int): the stream ordering of the
+                most recent event which we have finished sending to the
+                destination.
+            limit (int): the maximum number of rooms to return.
+
+        Returns:
+            Deferred[list[tuple[str|None, int]]]: a list of (event_id,
+            stream_ordering). The event_id is None if the event has since been
+            purged.
+        """
+        def _get_catch_up_room_event_ids_txn(txn):
+            sql = (
+                "SELECT e.event_id, dr.stream_ordering"
+                " FROM destination_rooms AS dr"
+                " LEFT JOIN events AS e USING (stream_ordering)"
+                " WHERE dr.destination = ? AND dr.stream_ordering > ?"
+                " ORDER BY dr.stream_ordering ASC"
+                " LIMIT ?"
+            )
+            txn.execute(sql, (destination, last_successful_stream_ordering, limit))
+            return txn.fetchall()
+
+        return self.runInteraction(
+            "get_catch_up_room_event_ids", _get_catch_up_room_event_ids_txn,
+        )
+
+    def get_catch_up_outstanding_destinations(self, after_destination, limit=25):
+        """Gets destinations which have missed events and are not currently
+        backing off, in order of destination.
+
+        Args:
+            after_destination (str|None): only return destinations after this
+                one, for pagination.
+            limit (int): the maximum number of destinations to return.
+
+        Returns:
+            Deferred[list[str]]
+        """
+        def _get_catch_up_outstanding_destinations_txn(txn):
+            # We check each destination for missed events separately, rather
+            # than joining, so that each check is a lookup on the
+            # destination_rooms_destination_stream_ordering index.
+            sql = (
+                "SELECT destination FROM destinations AS d"
+                " WHERE destination > ?"
+                " AND last_successful_stream_ordering IS NOT NULL"
+                " AND (retry_last_ts IS NULL OR retry_last_ts = 0"
+                " OR retry_last_ts + retry_interval <= ?)"
+                " AND EXISTS ("
+                "     SELECT 1 FROM destination_rooms AS dr"
+                "     WHERE dr.destination = d.destination"
+                "     AND dr.stream_ordering > d.last_successful_stream_ordering"
+                " )"
+                " ORDER BY destination"
+                " LIMIT ?"
+            )
+            txn.execute(sql, (
+                after_destination or "", self._clock.time_msec(), limit,
+            ))
+            return [destination for destination, in txn]
+
+        return self.runInteraction(
+            "get_catch_up_outstanding_destinations",
+            _get_catch_up_outstanding_destinations_txn,
+        )
+
+    def insert_received_event_to_staging(self, instance_name, origin, event):
+        """Records a PDU received over federation whose signatures and hashes
+        have been checked, until it has been processed.
+
+        Args:
+            instance_name (str): the name of the instance which is going to
+                process the PDU
+            origin (str): the server which sent the PDU
+            event (FrozenEvent)
+
+        Returns:
+            Deferred
+        """
+        return self._simple_insert(
+            table="federation_inbound_events_staging",
+            values={
+                "instance_name": instance_name,
+                "origin": origin,
+                "room_id": event.room_id,
+                "event_id": event.event_id,
+                "received_ts": self._clock.time_msec(),
+                "event_json": encode_canonical_json(
+                    event.get_pdu_json()
+                ).decode("utf-8"),
+            },
+            or_ignore=True,
+            desc="insert_received_event_to_staging",
+        )
+
+    def remove_received_event_from_staging(self, origin, event_id):
+        """Removes a PDU from the staging area once it has been processed.
+
+        Args:
+            origin (str): the server which sent the PDU
+            event_id (str)
+
+        Returns:
+            Deferred
+        """
+        return self._simple_delete(
+            table="federation_inbound_events_staging",
+            keyvalues={
+                "origin": origin,
+                "event_id": event_id,
+            },
+            desc="remove_received_event_from_staging",
+        )
+
+    def get_received_events_in_staging(self, instance_name, received_before_ts):
+        """Gets the PDUs in the staging area which were received by the given
+        instance before the given time, in the order they were received.
+
+        Args:
+            instance_name (str)
+            received_before_ts (int)
+
+        Returns:
+            Deferred[list[tuple[str, str, dict]]]: a list of
+                (origin, room_id, pdu_json)
+        """
+        def _get_received_events_in_staging_txn(txn):
+            txn.execute(
+                "SELECT origin, room_id, event_json"
+                " FROM federation_inbound_events_staging"
+                " WHERE instance_name = ? AND received_ts < ?"
+                " ORDER BY received_ts",
+                (instance_name, received_before_ts),
+            )
+            return [
+                (origin, room_id, db_to_json(event_json))
+                for origin, room_id, event_json in txn
+            ]
+
+        return self.runInteraction(
+            "get_received_events_in_staging", _get_received_events_in_staging_txn,
+        )
+
     def _start_cleanup_transactions(self):
         return run_as_background_process(
             "cleanup_transactions", self._cleanup_transactions,
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import hashlib
+
+from six.moves import range
+
+
+class ConsistentHashRing(object):
+    """Assigns keys to one of a set of nodes, such that adding or removing a
+    node only moves the keys which that node gains or loses.
+
+    Each node is placed at a number of points on a ring of hashes, and a key
+    belongs to the first node at or after the key's hash.
+
+    Args:
+        nodes (Iterable[str]): the names of the nodes.
+        replicas (int): how many points to place each node at. More points
+            spread the keys more evenly.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        points = sorted(
+            (_hash("%s-%d" % (node, i)), node)
+            for node in set(nodes)
+            for i in range(replicas)
+        )
+        if not points:
+            raise ValueError("ConsistentHashRing needs at least one node")
+
+        self._hashes = [h for h, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def get_node(self, key):
+        """Gets the node which a key belongs to.
+
+        Args:
+            key (str)
+
+        Returns:
+            str: the name of the node.
+        """
+        i = bisect.bisect_left(self._hashes, _hash(key))
+        return self._nodes[i % len(self._nodes)]
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from synapse.config import ConfigError
+from synapse.config.workers import WorkerConfig
+
+from tests import unittest
+
+
+class WorkerConfigTestCase(unittest.TestCase):
+    def test_sharded_federation_requires_send_federation_disabled(self):
+        config = {
+            "federation_sender_instances": ["sender1", "sender2"],
+        }
+        with self.assertRaises(ConfigError):
+            WorkerConfig().read_config(config)
+
+        config["send_federation"] = False
+        worker_config = WorkerConfig()
+        worker_config.read_config(config)
+        self.assertEqual(
+            worker_config.federation_sender_instances, ["sender1", "sender2"],
+        )
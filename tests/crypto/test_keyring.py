@@ -223,3 +223,162 @@ class KeyringTestCase(unittest.TestCase):
             yield defer
 
             self.assertIs(LoggingContext.current_context(), context_one)
+
+    @defer.inlineCallbacks
+    def test_verify_json_objects_for_server_in_batches(self):
+        kr = keyring.Keyring(self.hs)
+
+        key1 = signedjson.key.generate_signing_key(1)
+        yield self.hs.datastore.store_server_verify_key(
+            "server9", "", time.time() * 1000, signedjson.key.get_verify_key(key1)
+        )
+
+        count = keyring.SIGNATURE_CHECK_BATCH_SIZE + 10
+        json_objects = []
+        for i in range(count):
+            json_object = {"i": i}
+            signedjson.sign.sign_json(json_object, "server9", key1)
+            json_objects.append(json_object)
+
+        # tamper with one of the objects after signing it
+        json_objects[5]["i"] = -1
+
+        with LoggingContext("one") as context_one:
+            context_one.request = "one"
+
+            res_deferreds = kr.verify_json_objects_for_server(
+                [("server9", json_object) for json_object in json_objects]
+            )
+            results = yield logcontext.make_deferred_yieldable(
+                defer.DeferredList(res_deferreds, consumeErrors=True)
+            )
+            self.assertIs(LoggingContext.current_context(), context_one)
+
+        failed = [i for i, (success, _) in enumerate(results) if not success]
+        self.assertEqual(failed, [5])
+        self.assertIsInstance(results[5][1].value, SynapseError)
+
+    @defer.inlineCallbacks
+    def test_get_keys_from_cache(self):
+        kr = keyring.Keyring(self.hs)
+
+        key1 = signedjson.key.generate_signing_key(1)
+        yield self.hs.datastore.store_server_verify_key(
+            "server9", "", time.time() * 1000, signedjson.key.get_verify_key(key1)
+        )
+        json1 = {}
+        signedjson.sign.sign_json(json1, "server9", key1)
+
+        yield kr.verify_json_for_server("server9", json1)
+        self.assertIn(("server9", "ed25519:1"), kr._key_cache)
+
+        # the second lookup should be served from the cache
+        self.hs.datastore.get_server_signature_keys = Mock(
+            side_effect=Exception("should not hit the store"),
+        )
+        yield kr.verify_json_for_server("server9", json1)
+
+    def _cache_key(self, kr, server_name, valid_until_ts, expired=None):
+        verify_key = signedjson.key.get_verify_key(
+            signedjson.key.generate_signing_key(1),
+        )
+        verify_key.valid_until_ts = valid_until_ts
+        if expired is not None:
+            verify_key.expired = expired
+        kr._cache_keys({server_name: {"ed25519:1": verify_key}})
+        return verify_key
+
+    @defer.inlineCallbacks
+    def test_refresh_skips_expired_keys(self):
+        kr = keyring.Keyring(self.hs)
+        now = self.hs.get_clock().time_msec()
+        self._cache_key(kr, "server1", now - 1000, expired=now - 1000)
+
+        kr.get_keys_from_perspectives = Mock()
+        kr.get_server_verify_key_v2_direct = Mock()
+
+        yield kr._refresh_expiring_keys()
+
+        kr.get_keys_from_perspectives.assert_not_called()
+        kr.get_server_verify_key_v2_direct.assert_not_called()
+
+    @defer.inlineCallbacks
+    def test_refresh_keeps_keys_from_servers_which_respond(self):
+        kr = keyring.Keyring(self.hs)
+        now = self.hs.get_clock().time_msec()
+        self._cache_key(kr, "server1", now + 1000)
+        self._cache_key(kr, "server2", now + 1000)
+
+        new_key = signedjson.key.get_verify_key(
+            signedjson.key.generate_signing_key(1),
+        )
+        new_key.valid_until_ts = now + 24 * 60 * 60 * 1000
+
+        def get_server_verify_key_v2_direct(server_name, key_ids):
+            if server_name == "server1":
+                return defer.fail(keyring.KeyLookupError("Boom"))
+            return defer.succeed({server_name: {"ed25519:1": new_key}})
+
+        kr.get_keys_from_perspectives = Mock(
+            side_effect=lambda server_name_and_key_ids: defer.succeed({}),
+        )
+        kr.get_server_verify_key_v2_direct = Mock(
+            side_effect=get_server_verify_key_v2_direct,
+        )
+
+        yield kr._refresh_expiring_keys()
+
+        self.assertIs(kr._key_cache[("server2", "ed25519:1")].verify_key, new_key)
+        self.assertIsNot(
+            kr._key_cache[("server1", "ed25519:1")].verify_key, new_key,
+        )
+
+    @defer.inlineCallbacks
+    def test_perspectives_lookups_are_batched(self):
+        kr = keyring.Keyring(self.hs)
+
+        key1 = signedjson.key.generate_signing_key(1)
+        verify_key1 = signedjson.key.get_verify_key(key1)
+
+        requests = []
+
+        def post_json(destination, path, data, long_retries):
+            d = defer.Deferred()
+            requests.append((data["server_keys"], d))
+            return logcontext.make_deferred_yieldable(d)
+
+        self.http_client.post_json.side_effect = post_json
+
+        def respond(i):
+            server_keys = requests[i][0]
+            resp = {
+                "server_keys": [
+                    self.mock_perspective_server.get_signed_key(
+                        server_name, verify_key1,
+                    )
+                    for server_name in server_keys
+                ]
+            }
+            requests[i][1].callback(resp)
+
+        d1 = kr.get_keys_from_perspectives([("server1", ["ed25519:1"])])
+        self.assertEqual(len(requests), 1)
+
+        # lookups made while the first request is in flight wait for it, and
+        # are then sent together
+        d2 = kr.get_keys_from_perspectives([("server2", ["ed25519:1"])])
+        d3 = kr.get_keys_from_perspectives([("server3", ["ed25519:1"])])
+        self.assertEqual(len(requests), 1)
+
+        respond(0)
+        res1 = yield d1
+        self.assertEqual(list(res1), ["server1"])
+
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(set(requests[1][0]), {"server2", "server3"})
+
+        respond(1)
+        res2 = yield d2
+        res3 = yield d3
+        self.assertEqual(set(res2), {"server2", "server3"})
+        self.assertEqual(res2, res3)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import Mock, patch
+
+from canonicaljson import json
+
+from twisted.internet import defer
+
+from synapse.federation import federation_client
+from synapse.http import json_parser
+
+from tests import unittest
+
+
+def _make_pdu_json(event_id):
+    return {
+        "room_id": "!room:other",
+        "event_id": event_id,
+        "type": "m.room.message",
+        "sender": "@user:other",
+        "origin": "other",
+        "content": {},
+        "depth": 1,
+        "prev_events": [],
+        "auth_events": [],
+    }
+
+
+class BackfillTestCase(unittest.HomeserverTestCase):
+    def make_homeserver(self, reactor, clock):
+        self.transport_layer = Mock(spec=["backfill"])
+        hs = self.setup_test_homeserver(
+            "server", http_client=None,
+            federation_transport_client=self.transport_layer,
+        )
+        return hs
+
+    def prepare(self, reactor, clock, hs):
+        self.client = hs.get_federation_client()
+
+        hs.get_datastore().get_room_version = Mock(
+            side_effect=lambda room_id: defer.succeed("1"),
+        )
+
+        self.client._check_sigs_and_hashes = Mock(
+            side_effect=lambda room_version, pdus: [defer.succeed(p) for p in pdus],
+        )
+
+    def test_checks_start_while_downloading(self):
+        body = json.dumps({
+            "pdus": [_make_pdu_json("$1:other"), _make_pdu_json("$2:other")],
+        }).encode("utf-8")
+        split = body.index(b'"$2:other"')
+
+        checked_before_finish = []
+
+        def backfill(dest, room_id, extremities, limit, parser):
+            parser.feed(body[:split])
+            checked_before_finish.extend(
+                p.event_id
+                for (_, pdus), _ in self.client._check_sigs_and_hashes.call_args_list
+                for p in pdus
+            )
+            parser.feed(body[split:])
+            return defer.succeed(parser.finish())
+
+        self.transport_layer.backfill.side_effect = backfill
+
+        with patch.object(federation_client, "CONTENT_HASH_CHECK_BATCH_SIZE", 1):
+            pdus = self.get_success(
+                self.client.backfill("other", "!room:other", 10, ["$3:other"])
+            )
+
+        self.assertEqual(checked_before_finish, ["$1:other"])
+        self.assertEqual([p.event_id for p in pdus], ["$1:other", "$2:other"])
+
+    if json_parser.ijson is None:
+        test_checks_start_while_downloading.skip = "ijson is not installed"
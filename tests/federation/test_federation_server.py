@@ -14,8 +14,17 @@
 # limitations under the License.
 import logging
 
+from mock import Mock
+
+from twisted.internet import defer
+
 from synapse.events import FrozenEvent
-from synapse.federation.federation_server import server_matches_acl_event
+from synapse.federation.federation_server import (
+    FederationServer,
+    server_matches_acl_event,
+)
+from synapse.util.async_helpers import Linearizer
+from synapse.util.logcontext import make_deferred_yieldable
 
 from tests import unittest
 
@@ -42,6 +51,154 @@ class ServerACLsTestCase(unittest.TestCase):
         self.assertTrue(server_matches_acl_event("1:2:3:4", e))
 
 
+class ReceivedPduQueueTestCase(unittest.HomeserverTestCase):
+    def prepare(self, reactor, clock, hs):
+        self.server = FederationServer(hs)
+        self.server.handler = Mock(spec=["on_receive_pdu"])
+
+        # PDUs in "!slow:b" are processed once their deferred is resolved.
+        self.slow_deferreds = {}
+        self.processed = []
+
+        def on_receive_pdu(origin, pdu, sent_to_us_directly):
+            if pdu.room_id == "!slow:b":
+                d = self.slow_deferreds[pdu.event_id] = defer.Deferred()
+                d.addCallback(lambda _: self.processed.append(pdu.event_id))
+                return make_deferred_yieldable(d)
+            self.processed.append(pdu.event_id)
+            return defer.succeed(None)
+
+        self.server.handler.on_receive_pdu.side_effect = on_receive_pdu
+
+    def _make_pdu(self, room_id, event_id):
+        return FrozenEvent({
+            "room_id": room_id,
+            "event_id": event_id,
+            "type": "m.room.message",
+            "sender": "@a:b",
+            "content": {},
+            "depth": 1,
+        })
+
+    def _queue(self, room_id, event_id):
+        pdu = self._make_pdu(room_id, event_id)
+        return self.server._queue_pdu_for_processing("b", pdu)
+
+    def _get_staged(self):
+        return self.get_success(
+            self.hs.get_datastore().get_received_events_in_staging(
+                "master", self.clock.time_msec() + 1,
+            )
+        )
+
+    def test_slow_room_does_not_block_other_rooms(self):
+        slow_1 = self._queue("!slow:b", "$slow1:b")
+        slow_2 = self._queue("!slow:b", "$slow2:b")
+        fast = self._queue("!fast:b", "$fast:b")
+
+        # The fast room is processed while the slow room is still busy with
+        # its first PDU.
+        self.assertEqual(self.processed, ["$fast:b"])
+        self.assertEqual(self.successResultOf(fast), {})
+        self.assertNoResult(slow_1)
+        self.assertEqual(self.server._queued_pdu_count, 2)
+
+        # PDUs in the same room are processed in order.
+        self.assertEqual(list(self.slow_deferreds), ["$slow1:b"])
+        self.slow_deferreds["$slow1:b"].callback(None)
+        self.pump()
+        self.assertEqual(self.successResultOf(slow_1), {})
+        self.assertNoResult(slow_2)
+
+        self.slow_deferreds["$slow2:b"].callback(None)
+        self.pump()
+        self.assertEqual(self.successResultOf(slow_2), {})
+
+        self.assertEqual(self.processed, ["$fast:b", "$slow1:b", "$slow2:b"])
+        self.assertEqual(self.server._queued_pdu_count, 0)
+        self.assertEqual(self.server._room_pdu_queues, {})
+
+    def test_busy_rooms_take_turns(self):
+        self.server._room_processing_limiter = Linearizer(
+            max_count=1, clock=self.clock,
+        )
+
+        slow_1 = self._queue("!slow:b", "$slow1:b")
+        slow_2 = self._queue("!slow:b", "$slow2:b")
+        fast = self._queue("!fast:b", "$fast:b")
+        self.assertNoResult(fast)
+
+        # Once the slow room has processed a PDU, the fast room gets a turn
+        # before the slow room carries on.
+        self.slow_deferreds["$slow1:b"].callback(None)
+        self.pump()
+        self.assertEqual(self.successResultOf(slow_1), {})
+        self.assertEqual(self.successResultOf(fast), {})
+        self.assertEqual(self.processed, ["$slow1:b", "$fast:b"])
+
+        self.slow_deferreds["$slow2:b"].callback(None)
+        self.pump()
+        self.assertEqual(self.successResultOf(slow_2), {})
+        self.assertEqual(self.server._room_pdu_queues, {})
+
+    def test_staged_pdus_removed_once_processed(self):
+        store = self.hs.get_datastore()
+        pdu = self._make_pdu("!slow:b", "$slow1:b")
+        self.get_success(
+            store.insert_received_event_to_staging("master", "b", pdu)
+        )
+        d = self.server._queue_pdu_for_processing("b", pdu)
+
+        self.assertEqual(
+            [(origin, room_id) for origin, room_id, _ in self._get_staged()],
+            [("b", "!slow:b")],
+        )
+
+        self.slow_deferreds["$slow1:b"].callback(None)
+        self.pump()
+        self.assertEqual(self.successResultOf(d), {})
+        self.assertEqual(self._get_staged(), [])
+
+    def test_old_staged_events_processed(self):
+        store = self.hs.get_datastore()
+        store.get_room_version = Mock(side_effect=lambda room_id: defer.succeed("1"))
+
+        # PDUs left in the staging table from before a restart.
+        for event_id in ("$fast1:b", "$fast2:b"):
+            pdu = self._make_pdu("!fast:b", event_id)
+            self.get_success(
+                store.insert_received_event_to_staging("master", "b", pdu)
+            )
+
+        # a PDU which another worker is looking after.
+        pdu = self._make_pdu("!fast:b", "$other:b")
+        self.get_success(store.insert_received_event_to_staging("other", "b", pdu))
+
+        self.get_success(
+            self.server._handle_old_staged_events(self.clock.time_msec() + 1)
+        )
+
+        self.assertEqual(self.processed, ["$fast1:b", "$fast2:b"])
+        self.assertEqual(self._get_staged(), [])
+
+        staged = self.get_success(
+            store.get_received_events_in_staging(
+                "other", self.clock.time_msec() + 1,
+            )
+        )
+        self.assertEqual(
+            [pdu_json["event_id"] for _, _, pdu_json in staged], ["$other:b"],
+        )
+
+    def test_processing_errors_are_returned(self):
+        self.server.handler.on_receive_pdu.side_effect = Exception("Boom")
+
+        d = self._queue("!fast:b", "$fast:b")
+        self.pump()
+        self.assertEqual(self.successResultOf(d), {"error": "Boom"})
+        self.assertEqual(self.server._room_pdu_queues, {})
+
+
 def _create_acl_event(content):
     return FrozenEvent(
         {
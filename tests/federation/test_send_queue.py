@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from synapse.federation.send_queue import FederationRemoteSendQueue
+
+from tests import unittest
+
+
+class FederationRemoteSendQueueShardingTestCase(unittest.HomeserverTestCase):
+    def make_homeserver(self, reactor, clock):
+        config = self.default_config()
+        config.federation_sender_instances = ["sender1", "sender2"]
+        return self.setup_test_homeserver(config=config)
+
+    def test_rows_dropped_once_every_shard_acks(self):
+        queue = FederationRemoteSendQueue(self.hs)
+        queue.send_edu("other.example.com", "m.test", {})
+        token = queue.get_current_token()
+
+        queue.federation_ack(token + 1, "sender1")
+        self.assertEqual(len(queue.edus), 1)
+
+        queue.federation_ack(token + 1, "sender2")
+        self.assertEqual(len(queue.edus), 0)
+
+    def test_rows_dropped_if_shard_missing(self):
+        queue = FederationRemoteSendQueue(self.hs)
+        queue.send_edu("other.example.com", "m.test", {})
+        token = queue.get_current_token()
+
+        # Only one shard ever acks, so the rows are kept for the other...
+        queue.federation_ack(token + 1, "sender1")
+        self.reactor.advance(60)
+        self.assertEqual(len(queue.edus), 1)
+
+        # ... but only for so long.
+        self.reactor.advance(5 * 60)
+        self.assertEqual(len(queue.edus), 0)
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import Mock
+
+from twisted.internet import defer
+
+from synapse.api.errors import RequestSendFailed
+from synapse.federation.transaction_queue import (
+    BATCHING_POLICY_EXPIRY_MS,
+    TransactionQueue,
+    _DestinationBatchingPolicy,
+)
+from synapse.rest.client.v1 import admin, login, room
+from synapse.util.hash_ring import ConsistentHashRing
+
+from tests import unittest
+
+
+class TransactionQueueCatchUpTestCase(unittest.HomeserverTestCase):
+
+    servlets = [
+        admin.register_servlets,
+        login.register_servlets,
+        room.register_servlets,
+    ]
+
+    def make_homeserver(self, reactor, clock):
+        self.transport_client = Mock(spec=["send_transaction"])
+        hs = self.setup_test_homeserver(
+            "server", http_client=None,
+            federation_transport_client=self.transport_client,
+        )
+        return hs
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+        self.queue = TransactionQueue(hs)
+
+        self.user_id = self.register_user("alice", "pass")
+        self.tok = self.login("alice", "pass")
+
+        self.sent_transactions = []
+        self.transport_client.send_transaction.side_effect = self._send_transaction
+
+    def _send_transaction(self, transaction, json_data_cb):
+        self.sent_transactions.append(transaction)
+        return defer.succeed({})
+
+    def _get_new_events(self):
+        current_token = self.store.get_room_max_stream_ordering()
+        _, events = self.get_success(
+            self.store.get_all_new_events_stream(0, current_token, limit=100)
+        )
+        return events
+
+    def _send_events(self, destination, events):
+        self.get_success(self.store.store_destination_rooms_entries(
+            (event.room_id, event.internal_metadata.stream_ordering, [destination])
+            for event in events
+        ))
+        for event in events:
+            self.queue._send_pdu(event, [destination])
+        self.pump()
+
+    def test_catch_up_sends_latest_event_per_room(self):
+        destination = "other.example.com"
+
+        room_1 = self.helper.create_room_as(self.user_id, tok=self.tok)
+        room_2 = self.helper.create_room_as(self.user_id, tok=self.tok)
+        self.helper.send(room_1, body="one", tok=self.tok)
+        self.helper.send(room_2, body="two", tok=self.tok)
+        self.helper.send(room_1, body="three", tok=self.tok)
+
+        events = self._get_new_events()
+
+        # Fail to send the first event, so that the destination starts
+        # catching up.
+        self.transport_client.send_transaction.side_effect = RequestSendFailed(
+            Exception("Unreachable"), can_retry=True,
+        )
+        self._send_events(destination, events[:1])
+        self.assertTrue(self.queue._catching_up_by_dest[destination])
+
+        # PDUs for destinations which are catching up aren't queued in memory.
+        self._send_events(destination, events[1:])
+        self.assertNotIn(destination, self.queue.pending_pdus_by_dest)
+
+        # Once the destination is reachable again it gets sent the latest event
+        # in each room.
+        self.transport_client.send_transaction.side_effect = self._send_transaction
+        self.get_success(self.store.set_destination_retry_timings(destination, 0, 0))
+        self.queue._attempt_new_transaction(destination)
+        self.pump()
+
+        self.assertEqual(len(self.sent_transactions), 1)
+        pdus = self.sent_transactions[0].pdus
+        latest_by_room = {}
+        for event in events:
+            latest_by_room[event.room_id] = event.event_id
+        self.assertEqual(
+            set(pdu["event_id"] for pdu in pdus), set(latest_by_room.values()),
+        )
+
+        self.assertFalse(self.queue._catching_up_by_dest[destination])
+        last_successful = self.get_success(
+            self.store.get_destination_last_successful_stream_ordering(destination)
+        )
+        self.assertEqual(last_successful, events[-1].internal_metadata.stream_ordering)
+
+    def test_catch_up_skips_purged_events(self):
+        destination = "other.example.com"
+
+        room_1 = self.helper.create_room_as(self.user_id, tok=self.tok)
+        self.helper.send(room_1, body="one", tok=self.tok)
+        events = self._get_new_events()
+        stream_ordering = events[-1].internal_metadata.stream_ordering
+
+        self.get_success(self.store.set_destination_last_successful_stream_ordering(
+            destination, stream_ordering,
+        ))
+        self.assertEqual(
+            self.get_success(self.store.get_catch_up_outstanding_destinations(None)),
+            [],
+        )
+
+        # The destination missed an event which has since been purged, and
+        # another one was skipped while it was catching up.
+        purged_stream_ordering = stream_ordering + 100
+        self.get_success(self.store.store_destination_rooms_entries([
+            ("!purged:server", purged_stream_ordering, [destination]),
+        ]))
+        self.assertEqual(
+            self.get_success(self.store.get_catch_up_outstanding_destinations(None)),
+            [destination],
+        )
+        self.queue._catch_up_last_skipped_by_dest[destination] = (
+            purged_stream_ordering + 1
+        )
+
+        self.get_success(self.queue._catch_up_destination(destination))
+
+        self.assertEqual(self.sent_transactions, [])
+        self.assertFalse(self.queue._catching_up_by_dest[destination])
+        last_successful = self.get_success(
+            self.store.get_destination_last_successful_stream_ordering(destination)
+        )
+        self.assertEqual(last_successful, purged_stream_ordering)
+        self.assertEqual(
+            self.get_success(self.store.get_catch_up_outstanding_destinations(None)),
+            [],
+        )
+
+
+class TransactionQueueDestinationsTestCase(unittest.HomeserverTestCase):
+
+    servlets = [
+        admin.register_servlets,
+        login.register_servlets,
+        room.register_servlets,
+    ]
+
+    def make_homeserver(self, reactor, clock):
+        return self.setup_test_homeserver(
+            "server", http_client=None,
+            federation_transport_client=Mock(spec=["send_transaction"]),
+        )
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+        self.queue = TransactionQueue(hs)
+
+        self.user_id = self.register_user("alice", "pass")
+        self.tok = self.login("alice", "pass")
+        self.room_id = self.helper.create_room_as(self.user_id, tok=self.tok)
+
+        self.queue.state.get_current_hosts_in_room = Mock(
+            side_effect=lambda *args, **kwargs: defer.succeed(
+                frozenset(["from.state"]),
+            ),
+        )
+        self.store.get_hosts_in_room = Mock(
+            side_effect=lambda room_id: defer.succeed(
+                frozenset(["from.current.state"]),
+            ),
+        )
+
+    def _get_event(self, event_id):
+        return self.get_success(self.store.get_event(event_id))
+
+    def test_latest_event_uses_current_hosts(self):
+        event_id = self.helper.send(self.room_id, body="hi", tok=self.tok)["event_id"]
+
+        destinations = self.get_success(
+            self.queue._get_destinations_for_event(self._get_event(event_id))
+        )
+        self.assertEqual(destinations, {"from.current.state"})
+        self.queue.state.get_current_hosts_in_room.assert_not_called()
+
+    def test_older_event_uses_state_before_it(self):
+        event_id = self.helper.send(self.room_id, body="hi", tok=self.tok)["event_id"]
+        self.helper.send(self.room_id, body="there", tok=self.tok)
+        event = self._get_event(event_id)
+
+        destinations = self.get_success(
+            self.queue._get_destinations_for_event(event)
+        )
+        self.assertEqual(destinations, {"from.state"})
+        self.queue.state.get_current_hosts_in_room.assert_called_once_with(
+            self.room_id, latest_event_ids=event.prev_event_ids(),
+        )
+
+
+class TransactionQueueShardingTestCase(unittest.HomeserverTestCase):
+    def make_homeserver(self, reactor, clock):
+        config = self.default_config()
+        config.federation_sender_instances = ["sender1", "sender2"]
+        config.federation_sender_instance_name = "sender1"
+
+        hs = self.setup_test_homeserver(
+            "server", http_client=None, config=config,
+            federation_transport_client=Mock(spec=["send_transaction"]),
+        )
+        return hs
+
+    def test_only_sends_to_own_destinations(self):
+        queue = TransactionQueue(self.hs)
+        queue._attempt_new_transaction = Mock()
+
+        ring = ConsistentHashRing(["sender1", "sender2"])
+        destinations = ["server%d.example.com" % (i,) for i in range(20)]
+        ours = [d for d in destinations if ring.get_node(d) == "sender1"]
+        self.assertTrue(ours)
+        self.assertNotEqual(len(ours), len(destinations))
+
+        for destination in destinations:
+            queue.send_edu(destination, "m.test", {})
+
+        self.assertEqual(set(queue.pending_edus_by_dest), set(ours))
+        self.assertEqual(
+            set(args[0] for args, _ in queue._attempt_new_transaction.call_args_list),
+            set(ours),
+        )
+
+
+class TransactionQueueBatchingTestCase(unittest.HomeserverTestCase):
+    def make_homeserver(self, reactor, clock):
+        self.transport_client = Mock(spec=["send_transaction"])
+        self.transport_client.send_transaction.side_effect = (
+            lambda transaction, json_data_cb: defer.succeed({})
+        )
+        hs = self.setup_test_homeserver(
+            "server", http_client=None,
+            federation_transport_client=self.transport_client,
+        )
+        return hs
+
+    def prepare(self, reactor, clock, hs):
+        self.queue = TransactionQueue(hs)
+
+    def test_edus_sent_without_lingering(self):
+        policy = self.queue._get_batching_policy("other.example.com")
+        for _ in range(20):
+            policy.on_response(60 * 1000, 1)
+        self.assertTrue(policy.get_linger_ms())
+
+        self.queue.send_edu("other.example.com", "m.test", {})
+        self.pump()
+
+        self.assertEqual(self.transport_client.send_transaction.call_count, 1)
+
+    def test_idle_batching_policies_evicted(self):
+        self.queue._get_batching_policy("other.example.com")
+        self.assertIn("other.example.com", self.queue._batching_policies)
+
+        self.reactor.advance(BATCHING_POLICY_EXPIRY_MS / 1000.)
+        self.assertIn("other.example.com", self.queue._batching_policies)
+
+        self.reactor.advance(BATCHING_POLICY_EXPIRY_MS / 1000.)
+        self.assertNotIn("other.example.com", self.queue._batching_policies)
+
+
+class DestinationBatchingPolicyTestCase(unittest.TestCase):
+    def test_linger_for_slow_destinations(self):
+        policy = _DestinationBatchingPolicy()
+        self.assertEqual(policy.get_linger_ms(), 0)
+
+        policy.on_response(100, 1)
+        self.assertEqual(policy.get_linger_ms(), 0)
+
+        # The linger window follows the average response time.
+        for _ in range(20):
+            policy.on_response(5000, 1)
+        self.assertGreater(policy.get_linger_ms(), 450)
+        self.assertLessEqual(policy.get_linger_ms(), 500)
+
+        for _ in range(20):
+            policy.on_response(60 * 1000, 1)
+        self.assertEqual(policy.get_linger_ms(), policy.MAX_LINGER_MS)
+
+    def test_max_pdus_adapts(self):
+        policy = _DestinationBatchingPolicy()
+        self.assertEqual(policy.max_pdus, 50)
+
+        policy.on_response(30 * 1000, 50)
+        self.assertEqual(policy.max_pdus, 25)
+
+        policy.on_failure()
+        self.assertEqual(policy.max_pdus, 12)
+
+        for _ in range(10):
+            policy.on_failure()
+        self.assertEqual(policy.max_pdus, policy.MIN_PDUS)
+
+        # It grows back while transactions are full and quick...
+        policy.on_response(100, policy.max_pdus)
+        self.assertEqual(policy.max_pdus, 2 * policy.MIN_PDUS)
+
+        # ... but not when they aren't full.
+        policy.on_response(100, 1)
+        self.assertEqual(policy.max_pdus, 2 * policy.MIN_PDUS)
+
+        for _ in range(20):
+            policy.on_response(100, policy.max_pdus)
+        self.assertEqual(policy.max_pdus, 50)
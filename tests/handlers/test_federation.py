@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import Mock
+
+from twisted.internet import defer
+
+from synapse.api.errors import HttpResponseException
+from synapse.handlers.federation import _BackfillPlanner
+from synapse.util.logcontext import make_deferred_yieldable
+
+from tests import unittest
+
+
+class BackfillPlannerTestCase(unittest.TestCase):
+    def test_rank(self):
+        planner = _BackfillPlanner()
+        destinations = ["a", "b", "c", "d"]
+
+        # with nothing to go on, the original order is kept
+        self.assertEqual(planner.rank(destinations, 0), destinations)
+
+        planner.on_response("c", 100)
+        planner.on_response("b", 5000)
+        planner.on_failure("a", 0)
+        self.assertEqual(planner.rank(destinations, 1000), ["c", "d", "b", "a"])
+
+        # failures are forgotten after a while...
+        now = _BackfillPlanner.FAILURE_BACKOFF_MS + 1
+        self.assertEqual(planner.rank(destinations, now), ["c", "a", "d", "b"])
+
+        # ... or once the server responds again
+        planner.on_failure("c", 1000)
+        planner.on_response("c", 100)
+        self.assertEqual(planner.rank(destinations, 1000)[0], "c")
+
+
+class BackfillFromAnyTestCase(unittest.HomeserverTestCase):
+    def make_homeserver(self, reactor, clock):
+        self.federation_client = Mock(spec=["backfill"])
+        return self.setup_test_homeserver(
+            "server", http_client=None, federation_client=self.federation_client,
+        )
+
+    def prepare(self, reactor, clock, hs):
+        self.handler = hs.get_handlers().federation_handler
+        self.requests = {}
+
+        def backfill(dest, room_id, limit, extremities):
+            d = defer.Deferred()
+            self.requests[dest] = d
+            return make_deferred_yieldable(d)
+
+        self.federation_client.backfill.side_effect = backfill
+
+    def _backfill(self, destinations):
+        return self.handler._backfill_from_any(
+            destinations, "!room:test", limit=10, extremities=["$event"],
+        )
+
+    def test_slow_server_is_hedged(self):
+        d = self._backfill(["slow", "fast"])
+        self.assertEqual(set(self.requests), {"slow"})
+
+        # we only ask the next server once the first is slower than usual
+        self.reactor.advance(_BackfillPlanner.DEFAULT_RESPONSE_TIME_MS / 1000.)
+        self.assertEqual(set(self.requests), {"slow"})
+        self.reactor.advance(_BackfillPlanner.DEFAULT_RESPONSE_TIME_MS / 1000.)
+        self.assertEqual(set(self.requests), {"slow", "fast"})
+
+        self.reactor.advance(1)
+        self.requests["fast"].callback([])
+        self.assertEqual(self.get_success(d), [])
+
+        self.assertEqual(
+            self.handler._backfill_planner.rank(["slow", "fast"], 0),
+            ["fast", "slow"],
+        )
+
+        # the slow server can still finish in the background
+        self.requests["slow"].callback([])
+
+    def test_quick_server_is_not_hedged(self):
+        d = self._backfill(["a", "b"])
+        self.reactor.advance(1)
+        self.requests["a"].callback([])
+        self.assertEqual(self.get_success(d), [])
+
+        self.reactor.advance(60)
+        self.assertEqual(set(self.requests), {"a"})
+
+    def test_immediate_response_is_not_hedged(self):
+        def backfill(dest, room_id, limit, extremities):
+            self.requests[dest] = defer.succeed([])
+            return self.requests[dest]
+
+        self.federation_client.backfill.side_effect = backfill
+
+        # we shouldn't wait out the hedge delay when the answer is already in
+        d = self._backfill(["a", "b"])
+        self.assertEqual(self.successResultOf(d), [])
+        self.assertEqual(set(self.requests), {"a"})
+
+    def test_all_fail(self):
+        d = self._backfill(["a", "b"])
+
+        # the next server is asked as soon as one fails
+        self.requests["a"].errback(HttpResponseException(502, "a failed", b""))
+        self.assertEqual(set(self.requests), {"a", "b"})
+        self.assertNoResult(d)
+
+        self.requests["b"].errback(HttpResponseException(500, "b failed", b""))
+        f = self.failureResultOf(d, HttpResponseException)
+        self.assertEqual(f.value.code, 502)
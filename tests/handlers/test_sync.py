@@ -16,7 +16,7 @@ from twisted.internet import defer
 
 from synapse.api.errors import Codes, ResourceLimitError
 from synapse.api.filtering import DEFAULT_FILTER_COLLECTION
-from synapse.handlers.sync import SyncConfig, SyncHandler
+from synapse.handlers.sync import SyncAdmissionScheduler, SyncConfig, SyncHandler
 from synapse.types import UserID
 
 import tests.unittest
@@ -69,3 +69,57 @@ class SyncTestCase(tests.unittest.TestCase):
             request_key="request_key",
             device_id="device_id",
         )
+
+
+class SyncAdmissionSchedulerTestCase(tests.unittest.TestCase):
+    def test_incremental_admitted_first(self):
+        scheduler = SyncAdmissionScheduler(max_concurrent=1)
+
+        d1 = scheduler.admit(is_initial=False)
+        cm1 = self.successResultOf(d1)
+        cm1.__enter__()
+
+        d2 = scheduler.admit(is_initial=True)
+        d3 = scheduler.admit(is_initial=False)
+        self.assertNoResult(d2)
+        self.assertNoResult(d3)
+        self.assertEqual(
+            scheduler._get_queue_depths(),
+            {("incremental",): 1, ("initial",): 1},
+        )
+
+        # The queued incremental sync goes ahead of the initial one.
+        cm1.__exit__(None, None, None)
+        self.assertNoResult(d2)
+        cm3 = self.successResultOf(d3)
+        cm3.__enter__()
+
+        cm3.__exit__(None, None, None)
+        cm2 = self.successResultOf(d2)
+        cm2.__enter__()
+        cm2.__exit__(None, None, None)
+
+        self.assertEqual(scheduler._running, 0)
+
+    def test_cancelled_waiters_are_skipped(self):
+        scheduler = SyncAdmissionScheduler(max_concurrent=1)
+
+        cm1 = self.successResultOf(scheduler.admit(is_initial=False))
+        cm1.__enter__()
+
+        d2 = scheduler.admit(is_initial=False)
+        d3 = scheduler.admit(is_initial=False)
+        d2.cancel()
+        self.failureResultOf(d2, defer.CancelledError)
+
+        cm1.__exit__(None, None, None)
+        cm3 = self.successResultOf(d3)
+        cm3.__enter__()
+        cm3.__exit__(None, None, None)
+
+        self.assertEqual(scheduler._running, 0)
+
+    def test_no_limit(self):
+        scheduler = SyncAdmissionScheduler(max_concurrent=0)
+        for _ in range(10):
+            self.successResultOf(scheduler.admit(is_initial=True))
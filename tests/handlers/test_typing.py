@@ -77,6 +77,7 @@ class TypingNotificationsTestCase(unittest.TestCase):
                     "get_received_txn_response",
                     "set_received_txn_response",
                     "get_destination_retry_timings",
+                    "get_destination_last_successful_stream_ordering",
                     "get_devices_by_remote",
                     # Bits that user_directory needs
                     "get_user_directory_stream_pos",
@@ -102,6 +103,10 @@ class TypingNotificationsTestCase(unittest.TestCase):
             retry_timings_res
         )
 
+        self.datastore.get_destination_last_successful_stream_ordering.return_value = (
+            defer.succeed(None)
+        )
+
         self.datastore.get_devices_by_remote.return_value = (0, [])
 
         def get_received_txn_response(*args):
@@ -117,15 +122,10 @@ class TypingNotificationsTestCase(unittest.TestCase):
             if user_id not in [u.to_string() for u in self.room_members]:
                 raise AuthError(401, "User is not in the room")
 
-        def get_joined_hosts_for_room(room_id):
+        def get_hosts_in_room(room_id):
             return set(member.domain for member in self.room_members)
 
-        self.datastore.get_joined_hosts_for_room = get_joined_hosts_for_room
-
-        def get_current_user_in_room(room_id):
-            return set(str(u) for u in self.room_members)
-
-        self.state_handler.get_current_user_in_room = get_current_user_in_room
+        self.datastore.get_hosts_in_room = get_hosts_in_room
 
         self.datastore.get_user_directory_stream_pos.return_value = (
             # we deliberately return a non-None stream pos to avoid doing an initial_spam
@@ -31,6 +31,7 @@ from synapse.crypto.context_factory import ClientTLSOptionsFactory
 from synapse.http.federation.matrix_federation_agent import (
     MatrixFederationAgent,
     _cache_period_from_headers,
+    _FederationConnectionPool,
 )
 from synapse.http.federation.srv_resolver import Server
 from synapse.util.caches.ttlcache import TTLCache
@@ -891,6 +892,44 @@ class MatrixFederationAgentTests(TestCase):
         self.assertEqual(r, b'other-server')
 
 
+class FederationConnectionPoolTests(TestCase):
+    def setUp(self):
+        self.reactor = ThreadedMemoryReactorClock()
+        self.pool = _FederationConnectionPool(self.reactor, max_idle_connections=2)
+        self.pool.retryAutomatically = False
+
+    def _make_connection(self):
+        connection = Mock()
+        connection.state = "QUIESCENT"
+        return connection
+
+    def test_max_idle_connections(self):
+        connections = [self._make_connection() for _ in range(3)]
+        self.pool._putConnection("host1", connections[0])
+        self.reactor.advance(1)
+        self.pool._putConnection("host2", connections[1])
+        self.pool._putConnection("host1", connections[2])
+
+        # the connection which has been idle the longest should be closed
+        connections[0].transport.loseConnection.assert_called_once_with()
+        self.assertEqual(self.pool._connections["host1"], [connections[2]])
+        self.assertEqual(self.pool._connections["host2"], [connections[1]])
+        self.assertEqual(len(self.reactor.getDelayedCalls()), 2)
+
+    def test_reuses_idle_connections(self):
+        connection = self._make_connection()
+        self.pool._putConnection("host1", connection)
+
+        endpoint = Mock()
+        d = self.pool.getConnection("host1", endpoint)
+        self.assertIs(self.successResultOf(d), connection)
+        endpoint.connect.assert_not_called()
+        self.assertEqual(len(self.reactor.getDelayedCalls()), 0)
+
+        self.pool.getConnection("host1", endpoint)
+        endpoint.connect.assert_called_once()
+
+
 class TestCachePeriodFromHeaders(TestCase):
     def test_cache_control(self):
         # uppercase
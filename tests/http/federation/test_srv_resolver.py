@@ -152,6 +152,46 @@ class SrvResolverTestCase(unittest.TestCase):
         self.assertEquals(len(servers), 0)
         self.assertEquals(len(cache), 0)
 
+    @defer.inlineCallbacks
+    def test_name_error_is_cached(self):
+        clock = MockClock()
+
+        # the negative-cache TTL is the smaller of the TTL of the SOA record
+        # and its MINIMUM field
+        message = dns.Message(rCode=dns.ENAME)
+        message.authority = [dns.RRHeader(
+            type=dns.SOA, ttl=600, payload=dns.Record_SOA(minimum=300),
+        )]
+
+        dns_client_mock = Mock()
+        dns_client_mock.lookupService.return_value = defer.fail(
+            error.DNSNameError(message),
+        )
+
+        service_name = b"test_service.example.com"
+
+        cache = {}
+        resolver = SrvResolver(
+            dns_client=dns_client_mock, cache=cache, get_time=clock.time,
+        )
+
+        servers = yield resolver.resolve_service(service_name)
+        self.assertEquals(servers, [])
+        self.assertEquals(dns_client_mock.lookupService.call_count, 1)
+
+        clock.advance_time(299)
+        servers = yield resolver.resolve_service(service_name)
+        self.assertEquals(servers, [])
+        self.assertEquals(dns_client_mock.lookupService.call_count, 1)
+
+        clock.advance_time(2)
+        dns_client_mock.lookupService.return_value = defer.fail(
+            error.DNSNameError(message),
+        )
+        servers = yield resolver.resolve_service(service_name)
+        self.assertEquals(servers, [])
+        self.assertEquals(dns_client_mock.lookupService.call_count, 2)
+
     def test_disabled_service(self):
         """
         test the behaviour when there is a single record which is ".".
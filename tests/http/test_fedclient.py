@@ -23,6 +23,7 @@ from twisted.web.client import ResponseNeverReceived
 from twisted.web.http import HTTPChannel
 
 from synapse.api.errors import RequestSendFailed
+from synapse.http.json_parser import JsonStreamParser
 from synapse.http.matrixfederationclient import (
     MatrixFederationHttpClient,
     MatrixFederationRequest,
@@ -115,6 +116,41 @@ class FederationClientTests(HomeserverTestCase):
         # check the response is as expected
         self.assertEqual(res, {"a": 1})
 
+    def test_client_get_with_parser(self):
+        """
+        A GET request whose response is parsed as it arrives
+        """
+        parser = JsonStreamParser({"pdus": lambda pdu: pdu["event_id"]})
+        test_d = self.cl.get_json("testserv:8008", "foo/bar", parser=parser)
+
+        self.pump()
+
+        clients = self.reactor.tcpClients
+        self.assertEqual(len(clients), 1)
+        (host, port, factory, _timeout, _bindAddress) = clients[0]
+
+        protocol = factory.buildProtocol(None)
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+
+        res_json = b'{"pdus": [{"event_id": "$a"}, {"event_id": "$b"}], "c": 1}'
+        protocol.dataReceived(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Server: Fake\r\n"
+            b"Content-Type: application/json\r\n"
+            b"Content-Length: %i\r\n"
+            b"\r\n" % (len(res_json),)
+        )
+        protocol.dataReceived(res_json[:20])
+        self.pump()
+        self.assertNoResult(test_d)
+
+        protocol.dataReceived(res_json[20:])
+        self.pump()
+
+        res = self.successResultOf(test_d)
+        self.assertEqual(res, {"pdus": ["$a", "$b"], "c": 1})
+
     def test_dns_error(self):
         """
         If the DNS lookup returns an error, it will bubble up.
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import patch
+
+from synapse.http import json_parser
+from synapse.http.json_parser import JsonStreamParser
+
+from tests import unittest
+
+BODY = (
+    b'[200, {"origin": "a", "state": [{"event_id": "$1", "content": {"b": [1, 2]}},'
+    b' {"event_id": "$2", "depth": 1.5}], "auth_chain": [], "empty": {}}]'
+)
+
+
+class JsonStreamParserTestCase(unittest.TestCase):
+    def setUp(self):
+        self.seen = []
+
+    def _make_parser(self):
+        def transform(item):
+            self.seen.append(item)
+            return item["event_id"]
+
+        return JsonStreamParser({
+            "item.state": transform,
+            "item.auth_chain": transform,
+        })
+
+    def _parse(self, chunk_size):
+        parser = self._make_parser()
+        for i in range(0, len(BODY), chunk_size):
+            parser.feed(BODY[i:i + chunk_size])
+        return parser
+
+    def test_items_are_transformed(self):
+        parser = self._parse(7)
+        self.assertEqual(parser.finish(), [200, {
+            "origin": "a",
+            "state": ["$1", "$2"],
+            "auth_chain": [],
+            "empty": {},
+        }])
+        self.assertEqual(self.seen, [
+            {"event_id": "$1", "content": {"b": [1, 2]}},
+            {"event_id": "$2", "depth": 1.5},
+        ])
+
+    def test_items_are_transformed_as_they_arrive(self):
+        parser = self._make_parser()
+
+        # the first event is transformed once it has been received
+        split = BODY.index(b'{"event_id": "$2"')
+        parser.feed(BODY[:split])
+        self.assertEqual(len(self.seen), 1)
+
+        parser.feed(BODY[split:])
+        self.assertEqual(len(self.seen), 2)
+        self.assertEqual(parser.finish()[1]["state"], ["$1", "$2"])
+
+    if json_parser.ijson is None:
+        test_items_are_transformed_as_they_arrive.skip = "ijson is not installed"
+
+    def test_without_ijson(self):
+        with patch.object(json_parser, "ijson", None):
+            parser = self._parse(7)
+            self.assertEqual(self.seen, [])
+            self.assertEqual(parser.finish()[1]["state"], ["$1", "$2"])
+        self.assertEqual(len(self.seen), 2)
+
+    def test_invalid_json(self):
+        parser = JsonStreamParser({})
+        with self.assertRaises(ValueError):
+            parser.feed(b'{"a": ]')
+            parser.finish()
@@ -13,10 +13,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+
 from mock import Mock
+from six.moves.urllib import parse as urlparse
+
+from twisted.internet import defer
 
+from synapse.api.filtering import DEFAULT_FILTER_COLLECTION, FilterCollection
+from synapse.handlers.sync import SyncConfig
 from synapse.rest.client.v1 import admin, login, room
-from synapse.rest.client.v2_alpha import sync
+from synapse.rest.client.v2_alpha import receipts, sync
+from synapse.types import UserID
 
 from tests import unittest
 from tests.server import TimedOutException
@@ -188,3 +196,545 @@ class SyncTypingTests(unittest.HomeserverTestCase):
             "GET", sync_url % (access_token, next_batch)
         )
         self.assertRaises(TimedOutException, self.render, request)
+
+
+class SyncSnapshotTests(unittest.HomeserverTestCase):
+
+    servlets = [
+        admin.register_servlets,
+        room.register_servlets,
+        login.register_servlets,
+        sync.register_servlets,
+    ]
+    user_id = True
+    hijack_auth = False
+
+    def test_gappy_sync_uses_snapshot(self):
+        """
+        A gappy incremental sync works out the state the client already has
+        from the previous response, rather than from the since token.
+        """
+        sync_filter = urlparse.quote(
+            json.dumps({"room": {"timeline": {"limit": 1}}}),
+        )
+
+        user_id = self.register_user("user", "pass")
+        access_token = self.login("user", "pass")
+
+        other_user_id = self.register_user("otheruser", "pass")
+        other_access_token = self.login("otheruser", "pass")
+
+        room = self.helper.create_room_as(user_id, tok=access_token)
+        self.helper.join(room=room, user=other_user_id, tok=other_access_token)
+
+        request, channel = self.make_request(
+            "GET", "/sync?access_token=%s&filter=%s" % (access_token, sync_filter),
+        )
+        self.render(request)
+        self.assertEquals(200, channel.code)
+        next_batch = channel.json_body["next_batch"]
+
+        # Change some state and then send enough messages for the next sync to
+        # be gappy.
+        request, channel = self.make_request(
+            "PUT",
+            "/rooms/%s/state/m.room.topic?access_token=%s" % (
+                room, access_token,
+            ),
+            b'{"topic": "snapshots"}',
+        )
+        self.render(request)
+        self.assertEquals(200, channel.code)
+        self.helper.send(room, body="Hi!", tok=other_access_token)
+        self.helper.send(room, body="There!", tok=other_access_token)
+
+        sync_handler = self.hs.get_sync_handler()
+        sync_handler.get_state_at = Mock(side_effect=AssertionError)
+
+        request, channel = self.make_request(
+            "GET", "/sync?access_token=%s&filter=%s&since=%s" % (
+                access_token, sync_filter, next_batch,
+            ),
+        )
+        self.render(request)
+        self.assertEquals(200, channel.code)
+
+        room_sync = channel.json_body["rooms"]["join"][room]
+        self.assertTrue(room_sync["timeline"]["limited"])
+        self.assertEqual(
+            [e["type"] for e in room_sync["state"]["events"]], ["m.room.topic"],
+        )
+        sync_handler.get_state_at.assert_not_called()
+
+    def test_initial_sync_records_stream_position(self):
+        """
+        An initial sync records the last event in each room by stream ordering.
+        """
+        user_id = self.register_user("user", "pass")
+        access_token = self.login("user", "pass")
+
+        room = self.helper.create_room_as(user_id, tok=access_token)
+        event_id = self.helper.send(room, body="Hi!", tok=access_token)["event_id"]
+
+        sync_handler = self.hs.get_sync_handler()
+        store = self.hs.get_datastore()
+        store.get_last_event_in_room_before_stream_ordering = Mock(
+            wraps=store.get_last_event_in_room_before_stream_ordering,
+        )
+        sync_handler.store_sync_snapshot = Mock(
+            wraps=sync_handler.store_sync_snapshot,
+        )
+
+        request, channel = self.make_request(
+            "GET", "/sync?access_token=%s" % (access_token,),
+        )
+        self.render(request)
+        self.assertEquals(200, channel.code)
+
+        store.get_last_event_in_room_before_stream_ordering.assert_called_once()
+        sync_result_builder = sync_handler.store_sync_snapshot.call_args[0][0]
+        self.assertEqual(sync_result_builder.room_positions, {room: event_id})
+
+    def test_snapshot_ignores_timeline_filter(self):
+        """
+        The snapshot records the last event in each room, not the last event
+        which got through the timeline filter.
+        """
+        sync_filter = urlparse.quote(json.dumps({
+            "room": {"timeline": {"limit": 1, "types": ["m.room.message"]}},
+        }))
+
+        user_id = self.register_user("user", "pass")
+        access_token = self.login("user", "pass")
+
+        room = self.helper.create_room_as(user_id, tok=access_token)
+        self.helper.send(room, body="Hi!", tok=access_token)
+        request, channel = self.make_request(
+            "PUT",
+            "/rooms/%s/state/m.room.topic?access_token=%s" % (
+                room, access_token,
+            ),
+            b'{"topic": "snapshots"}',
+        )
+        self.render(request)
+        self.assertEquals(200, channel.code)
+
+        request, channel = self.make_request(
+            "GET", "/sync?access_token=%s&filter=%s" % (access_token, sync_filter),
+        )
+        self.render(request)
+        self.assertEquals(200, channel.code)
+        next_batch = channel.json_body["next_batch"]
+
+        self.helper.send(room, body="There!", tok=access_token)
+        self.helper.send(room, body="Again!", tok=access_token)
+
+        sync_handler = self.hs.get_sync_handler()
+        sync_handler.get_state_at = Mock(side_effect=AssertionError)
+
+        request, channel = self.make_request(
+            "GET", "/sync?access_token=%s&filter=%s&since=%s" % (
+                access_token, sync_filter, next_batch,
+            ),
+        )
+        self.render(request)
+        self.assertEquals(200, channel.code)
+
+        # the client already has the topic, so it isn't sent again
+        room_sync = channel.json_body["rooms"]["join"][room]
+        self.assertTrue(room_sync["timeline"]["limited"])
+        self.assertEqual(room_sync["state"]["events"], [])
+        sync_handler.get_state_at.assert_not_called()
+
+
+class SyncBatchedRoomsTests(unittest.HomeserverTestCase):
+
+    servlets = [
+        admin.register_servlets,
+        room.register_servlets,
+        login.register_servlets,
+        receipts.register_servlets,
+        sync.register_servlets,
+    ]
+    user_id = True
+    hijack_auth = False
+
+    def test_initial_sync_fetches_rooms_in_bulk(self):
+        """
+        An initial sync loads the timelines and unread counts of all the rooms
+        at once, rather than room by room.
+        """
+        user_id = self.register_user("user", "pass")
+        access_token = self.login("user", "pass")
+
+        rooms = []
+        last_event_ids = []
+        for i in range(3):
+            room = self.helper.create_room_as(user_id, tok=access_token)
+            for j in range(i + 1):
+                event = self.helper.send(room, body="msg %d" % (j,), tok=access_token)
+            rooms.append(room)
+            last_event_ids.append(event["event_id"])
+
+        # Only the first room has a read receipt, and so unread counts.
+        request, channel = self.make_request(
+            "POST",
+            "/rooms/%s/receipt/m.read/%s?access_token=%s" % (
+                rooms[0], last_event_ids[0], access_token,
+            ),
+            b"{}",
+        )
+        self.render(request)
+        self.assertEquals(200, channel.code)
+
+        store = self.hs.get_datastore()
+        store.get_recent_events_for_room = Mock(side_effect=AssertionError)
+        store.get_last_receipt_event_id_for_user = Mock(side_effect=AssertionError)
+
+        sync_filter = urlparse.quote(
+            json.dumps({"room": {"timeline": {"limit": 2}}}),
+        )
+        request, channel = self.make_request(
+            "GET", "/sync?access_token=%s&filter=%s" % (access_token, sync_filter),
+        )
+        self.render(request)
+        self.assertEquals(200, channel.code)
+
+        joined = channel.json_body["rooms"]["join"]
+        self.assertEqual(set(joined), set(rooms))
+        for i, room in enumerate(rooms):
+            timeline = joined[room]["timeline"]
+            self.assertEqual(len(timeline["events"]), 2)
+            self.assertEqual(
+                timeline["events"][-1]["content"]["body"], "msg %d" % (i,),
+            )
+
+        self.assertEqual(
+            joined[rooms[0]]["unread_notifications"],
+            {"notification_count": 0, "highlight_count": 0},
+        )
+        self.assertEqual(joined[rooms[1]]["unread_notifications"], {})
+
+        store.get_recent_events_for_room.assert_not_called()
+        store.get_last_receipt_event_id_for_user.assert_not_called()
+
+    def test_encode_response_chunks(self):
+        """
+        Encoding a sync response a room at a time gives the same JSON as
+        encoding it all in one go.
+        """
+        user_id = self.register_user("user", "pass")
+        access_token = self.login("user", "pass")
+
+        for i in range(3):
+            room = self.helper.create_room_as(user_id, tok=access_token)
+            self.helper.send(room, body="msg %d" % (i,), tok=access_token)
+
+        sync_config = SyncConfig(
+            user=UserID.from_string(user_id),
+            filter_collection=DEFAULT_FILTER_COLLECTION,
+            is_guest=False,
+            request_key="request_key",
+            device_id="device_id",
+        )
+        sync_result = self.get_success(
+            self.hs.get_sync_handler().wait_for_sync_for_user(sync_config)
+        )
+        self.assertEqual(len(sync_result.joined), 3)
+
+        time_now = self.clock.time_msec()
+        chunks = sync.SyncRestServlet.encode_response_chunks(
+            time_now, sync_result, None, DEFAULT_FILTER_COLLECTION,
+        )
+        response = sync.SyncRestServlet.encode_response(
+            time_now, sync_result, None, DEFAULT_FILTER_COLLECTION,
+        )
+        # Byte for byte what JsonResource would have sent for the client API.
+        self.assertEqual(b"".join(chunks), json.dumps(response).encode("utf8"))
+
+
+class SyncInitialSyncCacheTests(unittest.HomeserverTestCase):
+
+    servlets = [
+        admin.register_servlets,
+        room.register_servlets,
+        login.register_servlets,
+        sync.register_servlets,
+    ]
+    user_id = True
+    hijack_auth = False
+
+    def make_homeserver(self, reactor, clock):
+        config = self.default_config()
+        config.initial_sync_cache_users = {"@user:test"}
+        config.initial_sync_cache_refresh_interval = 60 * 1000
+        return self.setup_test_homeserver(config=config)
+
+    def _sync(self, access_token, since=None, sync_filter=None):
+        url = "/sync?access_token=%s" % (access_token,)
+        if since:
+            url += "&since=" + since
+        if sync_filter:
+            url += "&filter=" + urlparse.quote(json.dumps(sync_filter))
+        request, channel = self.make_request("GET", url)
+        self.render(request)
+        self.assertEquals(200, channel.code)
+        return channel.json_body
+
+    def _bodies(self, sync_body, room):
+        return [
+            e["content"].get("body")
+            for e in sync_body["rooms"]["join"][room]["timeline"]["events"]
+            if e["type"] == "m.room.message"
+        ]
+
+    def test_initial_sync_served_from_cache(self):
+        user_id = self.register_user("user", "pass")
+        access_token = self.login("user", "pass")
+
+        room = self.helper.create_room_as(user_id, tok=access_token)
+        self.helper.send(room, body="first", tok=access_token)
+
+        body = self._sync(access_token)
+        self.assertEqual(self._bodies(body, room), ["first"])
+
+        # A second initial sync gets the same response, even though there is
+        # now another message...
+        self.helper.send(room, body="second", tok=access_token)
+        cached_body = self._sync(access_token)
+        self.assertEqual(self._bodies(cached_body, room), ["first"])
+        self.assertEqual(cached_body["next_batch"], body["next_batch"])
+
+        # ... which the client gets on its next incremental sync.
+        body = self._sync(access_token, since=cached_body["next_batch"])
+        self.assertEqual(self._bodies(body, room), ["second"])
+
+        # Once the cache has been refreshed, initial syncs are up to date.
+        self.reactor.advance(60)
+        body = self._sync(access_token)
+        self.assertEqual(self._bodies(body, room), ["first", "second"])
+
+    def test_cache_shared_between_devices(self):
+        user_id = self.register_user("user", "pass")
+        access_token = self.login("user", "pass")
+        other_access_token = self.login("user", "pass")
+
+        room = self.helper.create_room_as(user_id, tok=access_token)
+        body = self._sync(access_token)
+
+        self.helper.send(room, body="hello", tok=access_token)
+        other_body = self._sync(other_access_token)
+        self.assertEqual(other_body["next_batch"], body["next_batch"])
+
+    def test_refresh_applies_changes(self):
+        """
+        Refreshing a cached response gives the same timeline and state as
+        computing a new one.
+        """
+        user_id = self.register_user("user", "pass")
+        access_token = self.login("user", "pass")
+        other_user_id = self.register_user("otheruser", "pass")
+        other_access_token = self.login("otheruser", "pass")
+        sync_filter = {"room": {"timeline": {"limit": 3}}}
+
+        room = self.helper.create_room_as(user_id, tok=access_token)
+        self.helper.send(room, body="first", tok=access_token)
+        self._sync(access_token, sync_filter=sync_filter)
+
+        # The old timeline drops off the front of the new one, so the state
+        # events in it need to end up in the state.
+        self.helper.join(room=room, user=other_user_id, tok=other_access_token)
+        for body in ("second", "third"):
+            self.helper.send(room, body=body, tok=other_access_token)
+
+        sync_handler = self.hs.get_sync_handler()
+        sync_handler.generate_sync_result = Mock(
+            side_effect=sync_handler.generate_sync_result,
+        )
+        self.reactor.advance(60)
+
+        # The refresh only computed what had changed.
+        sync_handler.generate_sync_result.assert_called_once()
+        self.assertIsNotNone(
+            sync_handler.generate_sync_result.call_args[1]["since_token"],
+        )
+
+        body = self._sync(access_token, sync_filter=sync_filter)
+        room_body = body["rooms"]["join"][room]
+        self.assertEqual(self._bodies(body, room), ["second", "third"])
+        self.assertTrue(room_body["timeline"]["limited"])
+
+        sync_config = SyncConfig(
+            user=UserID.from_string(user_id),
+            filter_collection=FilterCollection(sync_filter),
+            is_guest=False,
+            request_key=None,
+            device_id=None,
+        )
+        expected = self.get_success(
+            sync_handler.generate_sync_result(
+                sync_config, track_lazy_loaded_members=False,
+            )
+        ).joined[0]
+        self.assertEqual(
+            [e["event_id"] for e in room_body["timeline"]["events"]],
+            [e.event_id for e in expected.timeline.events],
+        )
+        self.assertEqual(
+            set(e["event_id"] for e in room_body["state"]["events"]),
+            set(e.event_id for e in expected.state.values()),
+        )
+
+    def test_refreshes_do_not_overlap(self):
+        sync_handler = self.hs.get_sync_handler()
+        sync_handler._initial_sync_cache[("@user:test", b"{}")] = Mock(
+            last_used_ms=self.clock.time_msec(),
+        )
+        d = defer.Deferred()
+        sync_handler._update_initial_sync_cache_entry = Mock(return_value=d)
+
+        sync_handler._refresh_initial_sync_cache()
+        sync_handler._refresh_initial_sync_cache()
+        sync_handler._update_initial_sync_cache_entry.assert_called_once()
+
+        # Once the first refresh finishes, the next one goes ahead.
+        d.callback(None)
+        sync_handler._refresh_initial_sync_cache()
+        self.assertEqual(
+            sync_handler._update_initial_sync_cache_entry.call_count, 2,
+        )
+
+    def test_other_users_not_cached(self):
+        user_id = self.register_user("otheruser", "pass")
+        access_token = self.login("otheruser", "pass")
+
+        room = self.helper.create_room_as(user_id, tok=access_token)
+        self._sync(access_token)
+
+        self.helper.send(room, body="hello", tok=access_token)
+        body = self._sync(access_token)
+        self.assertEqual(self._bodies(body, room), ["hello"])
+
+
+class SyncLazyLoadedMembersTests(unittest.HomeserverTestCase):
+
+    servlets = [
+        admin.register_servlets,
+        room.register_servlets,
+        login.register_servlets,
+        sync.register_servlets,
+    ]
+    user_id = True
+    hijack_auth = False
+
+    def _sync(self, access_token, since=None):
+        sync_filter = urlparse.quote(json.dumps({
+            "room": {
+                "state": {"lazy_load_members": True},
+                "timeline": {"limit": 1},
+            },
+        }))
+        url = "/sync?access_token=%s&filter=%s" % (access_token, sync_filter)
+        if since:
+            url += "&since=" + since
+        request, channel = self.make_request("GET", url)
+        self.render(request)
+        self.assertEquals(200, channel.code)
+        return channel.json_body
+
+    def _members(self, sync_body, room):
+        return [
+            e["state_key"]
+            for e in sync_body["rooms"]["join"][room]["state"]["events"]
+            if e["type"] == "m.room.member"
+        ]
+
+    def test_sent_members_are_persisted(self):
+        user_id = self.register_user("user", "pass")
+        access_token = self.login("user", "pass")
+        device_id = self.get_success(
+            self.hs.get_datastore().get_user_by_access_token(access_token)
+        )["device_id"]
+
+        other_user_id = self.register_user("otheruser", "pass")
+        other_access_token = self.login("otheruser", "pass")
+
+        room = self.helper.create_room_as(user_id, tok=access_token)
+        self.helper.join(room=room, user=other_user_id, tok=other_access_token)
+        self.helper.send(room, body="Hi!", tok=other_access_token)
+
+        body = self._sync(access_token)
+        self.assertIn(other_user_id, self._members(body, room))
+
+        # The member we sent is recorded in the database, where any
+        # synchrotron can see it...
+        member_event_id = self.get_success(
+            self.hs.get_datastore().get_current_state_ids(room)
+        )[("m.room.member", other_user_id)]
+        sent = self.get_success(
+            self.hs.get_datastore().get_sent_lazy_loaded_members(
+                user_id, device_id, [member_event_id],
+            )
+        )
+        self.assertEqual(sent, {member_event_id})
+
+        # ... so it isn't sent again by the incremental sync.
+        self.helper.send(room, body="There!", tok=other_access_token)
+        body = self._sync(access_token, since=body["next_batch"])
+        self.assertNotIn(other_user_id, self._members(body, room))
+
+        # A new initial sync starts afresh.
+        body = self._sync(access_token)
+        self.assertIn(other_user_id, self._members(body, room))
+
+
+class SyncIdlePrecheckTests(unittest.HomeserverTestCase):
+
+    servlets = [
+        admin.register_servlets,
+        room.register_servlets,
+        login.register_servlets,
+        sync.register_servlets,
+    ]
+    user_id = True
+    hijack_auth = False
+
+    def _sync(self, access_token, since=None, timeout=0):
+        url = "/sync?access_token=%s&timeout=%d" % (access_token, timeout)
+        if since:
+            url += "&since=" + since
+        request, channel = self.make_request("GET", url)
+        self.render(request)
+        self.assertEquals(200, channel.code)
+        return channel.json_body
+
+    def test_idle_sync_not_computed(self):
+        user_id = self.register_user("user", "pass")
+        access_token = self.login("user", "pass")
+        room = self.helper.create_room_as(user_id, tok=access_token)
+
+        next_batch = self._sync(access_token)["next_batch"]
+
+        sync_handler = self.hs.get_sync_handler()
+        current_sync_for_user = sync_handler.current_sync_for_user
+        sync_handler.current_sync_for_user = Mock(side_effect=AssertionError)
+
+        # Nothing happens while the client waits, so the response at the end
+        # of the timeout is empty, and not computed...
+        body = self._sync(access_token, since=next_batch, timeout=1000)
+        self.assertEqual(body["next_batch"], next_batch)
+        self.assertEqual(body["rooms"]["join"], {})
+
+        # ... and now that the notifier is tracking the user, neither is one
+        # without a timeout.
+        body = self._sync(access_token, since=next_batch)
+        self.assertEqual(body["next_batch"], next_batch)
+
+        # But once something happens, we do the work.
+        sync_handler.current_sync_for_user = Mock(
+            side_effect=current_sync_for_user,
+        )
+        self.helper.send(room, body="Hi!", tok=access_token)
+        body = self._sync(access_token, since=next_batch)
+        self.assertIn(room, body["rooms"]["join"])
+        self.assertEqual(sync_handler.current_sync_for_user.call_count, 1)
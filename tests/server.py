@@ -253,6 +253,9 @@ class ThreadedMemoryReactorClock(MemoryReactorClock):
         self.callLater(0, d.callback, True)
         return d
 
+    def getThreadPool(self):
+        return self.threadpool
+
 
 def setup_test_homeserver(cleanup_func, *args, **kwargs):
     """
@@ -316,6 +319,7 @@ def setup_test_homeserver(cleanup_func, *args, **kwargs):
             return d
 
     clock.threadpool = ThreadPool()
+    clock._reactor.threadpool = ThreadPool()
     pool.threadpool = ThreadPool()
     pool.running = True
     return d
@@ -598,6 +598,22 @@ class LexicographicalTestCase(unittest.TestCase):
 
         self.assertEqual(["o", "l", "n", "m", "p"], res)
 
+    def test_key_ties_and_graph_unmodified(self):
+        graph = {
+            "a": {"d"},
+            "b": {"d"},
+            "c": {"d"},
+            "d": set(),
+        }
+        graph_copy = {k: set(v) for k, v in graph.items()}
+
+        # all the nodes other than "d" have the same key, so are ordered by
+        # node.
+        res = list(lexicographical_topological_sort(graph, key=lambda x: 0))
+
+        self.assertEqual(["d", "a", "b", "c"], res)
+        self.assertEqual(graph_copy, graph)
+
 
 class SimpleParamStateTestCase(unittest.TestCase):
     def setUp(self):
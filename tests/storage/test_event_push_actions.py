@@ -14,6 +14,7 @@
 # limitations under the License.
 
 from mock import Mock
+from six import iteritems
 
 from twisted.internet import defer
 
@@ -132,6 +133,118 @@ class EventPushActionsStoreTestCase(tests.unittest.TestCase):
         yield _rotate(10)
         yield _assert_counts(1, 1)
 
+    @defer.inlineCallbacks
+    def test_get_unread_event_push_actions_by_rooms_for_user(self):
+        user_id = "@user1235:example.com"
+
+        @defer.inlineCallbacks
+        def _inject_actions(room_id, stream, action):
+            event = Mock()
+            event.room_id = room_id
+            event.event_id = "$test%i:example.com" % (stream,)
+            event.internal_metadata.stream_ordering = stream
+            event.depth = stream
+
+            yield self.store.add_push_actions_to_staging(
+                event.event_id, {user_id: action}
+            )
+            yield self.store.runInteraction(
+                "",
+                self.store._set_push_actions_for_event_and_users_txn,
+                [(event, None)],
+                [(event, None)],
+            )
+
+        @defer.inlineCallbacks
+        def _add_receipt(room_id, stream, event_id):
+            yield self.store._simple_insert(
+                "events",
+                {
+                    "stream_ordering": stream,
+                    "received_ts": 0,
+                    "event_id": event_id,
+                    "type": "",
+                    "room_id": room_id,
+                    "content": "",
+                    "processed": True,
+                    "outlier": False,
+                    "topological_ordering": stream,
+                    "depth": stream,
+                },
+            )
+            yield self.store._simple_insert(
+                "receipts_linearized",
+                {
+                    "stream_id": stream,
+                    "room_id": room_id,
+                    "receipt_type": "m.read",
+                    "user_id": user_id,
+                    "event_id": event_id,
+                    "data": "{}",
+                },
+            )
+
+        yield _add_receipt("!a:example.com", 1, "$read_a:example.com")
+        yield _inject_actions("!a:example.com", 2, PlAIN_NOTIF)
+        yield _inject_actions("!a:example.com", 3, HIGHLIGHT)
+        yield self.store.runInteraction(
+            "", self.store._rotate_notifs_before_txn, 4,
+        )
+        yield _inject_actions("!a:example.com", 5, PlAIN_NOTIF)
+
+        # Notifications before the receipt don't count.
+        yield _inject_actions("!b:example.com", 6, HIGHLIGHT)
+        yield _add_receipt("!b:example.com", 7, "$read_b:example.com")
+        yield _inject_actions("!b:example.com", 8, PlAIN_NOTIF)
+
+        # A receipt for an event we don't have.
+        yield self.store._simple_insert(
+            "receipts_linearized",
+            {
+                "stream_id": 9,
+                "room_id": "!c:example.com",
+                "receipt_type": "m.read",
+                "user_id": user_id,
+                "event_id": "$unknown:example.com",
+                "data": "{}",
+            },
+        )
+
+        last_read_event_ids = {
+            "!a:example.com": "$read_a:example.com",
+            "!b:example.com": "$read_b:example.com",
+            "!c:example.com": "$unknown:example.com",
+        }
+        counts = yield self.store.get_unread_event_push_actions_by_rooms_for_user(
+            user_id, last_read_event_ids,
+        )
+        self.assertEqual(counts, {
+            "!a:example.com": {"notify_count": 3, "highlight_count": 1},
+            "!b:example.com": {"notify_count": 1, "highlight_count": 0},
+            "!c:example.com": {"notify_count": 0, "highlight_count": 0},
+        })
+
+        # Which should match the counts for each room looked up separately.
+        for room_id, event_id in iteritems(last_read_event_ids):
+            room_counts = yield self.store.runInteraction(
+                "", self.store._get_unread_counts_by_receipt_txn,
+                room_id, user_id, event_id,
+            )
+            self.assertEqual(room_counts, counts[room_id])
+
+        # The counts are now cached, and are used by the per-room lookup and
+        # by later batched lookups.
+        self.store.runInteraction = Mock(side_effect=AssertionError)
+        room_counts = yield self.store.get_unread_event_push_actions_by_room_for_user(
+            "!b:example.com", user_id, "$read_b:example.com",
+        )
+        self.assertEqual(room_counts, counts["!b:example.com"])
+
+        counts_again = yield self.store.get_unread_event_push_actions_by_rooms_for_user(
+            user_id, last_read_event_ids,
+        )
+        self.assertEqual(counts_again, counts)
+
     @defer.inlineCallbacks
     def test_find_first_stream_ordering_after_ts(self):
         def add_event(so, ts):
@@ -46,3 +46,29 @@ class KeyStoreTestCase(tests.unittest.TestCase):
         self.assertEqual(len(res.keys()), 2)
         self.assertEqual(res["ed25519:key1"].version, "key1")
         self.assertEqual(res["ed25519:key2"].version, "key2")
+
+    @defer.inlineCallbacks
+    def test_get_server_signature_keys(self):
+        key1 = signedjson.key.decode_verify_key_base64(
+            "ed25519", "key1", "fP5l4JzpZPq/zdbBg5xx6lQGAAOM9/3w94cqiJ5jPrw"
+        )
+        key2 = signedjson.key.decode_verify_key_base64(
+            "ed25519", "key2", "Noi6WqcDj0QmPxCNQqgezwTlBKrfqehY1u2FyWP9uYw"
+        )
+        yield self.store.store_server_verify_key(
+            "server1", "from_server", 0, key1, ts_valid_until_ms=1000,
+        )
+        yield self.store.store_server_verify_key("server2", "from_server", 0, key2)
+
+        res = yield self.store.get_server_signature_keys([
+            ("server1", ["ed25519:key1", "ed25519:key2"]),
+            ("server2", ["ed25519:key2"]),
+            ("server3", ["ed25519:key1"]),
+        ])
+
+        self.assertEqual(set(res), {"server1", "server2", "server3"})
+        self.assertEqual(list(res["server1"]), ["ed25519:key1"])
+        self.assertEqual(res["server1"]["ed25519:key1"].valid_until_ts, 1000)
+        self.assertEqual(res["server2"]["ed25519:key2"].version, "key2")
+        self.assertIsNone(res["server2"]["ed25519:key2"].valid_until_ts)
+        self.assertEqual(res["server3"], {})
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import patch
+
+from synapse.storage import lazy_loaded_members
+
+from tests.unittest import HomeserverTestCase
+
+
+class LazyLoadedMembersStoreTestCase(HomeserverTestCase):
+    def prepare(self, reactor, clock, homeserver):
+        self.store = homeserver.get_datastore()
+
+    def _get_sent(self, event_ids):
+        return self.get_success(
+            self.store.get_sent_lazy_loaded_members("@user:test", "DEVICE", event_ids)
+        )
+
+    def test_old_members_pruned(self):
+        self.get_success(
+            self.store.add_sent_lazy_loaded_members("@user:test", "DEVICE", ["$a"])
+        )
+        self.reactor.advance(5 * 24 * 60 * 60)
+        self.get_success(
+            self.store.add_sent_lazy_loaded_members("@user:test", "DEVICE", ["$b"])
+        )
+
+        # Once a week has passed, only the member sent more recently is
+        # remembered.
+        self.reactor.advance(3 * 24 * 60 * 60)
+        self.assertEqual(self._get_sent(["$a", "$b"]), {"$b"})
+
+    def test_members_per_device_bounded(self):
+        with patch.object(lazy_loaded_members, "LAZY_LOADED_MEMBERS_MAX_PER_DEVICE", 2):
+            for event_id in ("$a", "$b", "$c"):
+                self.get_success(
+                    self.store.add_sent_lazy_loaded_members(
+                        "@user:test", "DEVICE", [event_id],
+                    )
+                )
+                self.reactor.advance(1)
+
+        self.assertEqual(self._get_sent(["$a", "$b", "$c"]), {"$b", "$c"})
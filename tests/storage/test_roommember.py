@@ -14,6 +14,8 @@
 # limitations under the License.
 
 
+import json
+
 from mock import Mock
 
 from twisted.internet import defer
@@ -83,3 +85,83 @@ class RoomMemberStoreTestCase(unittest.TestCase):
                 )
             ],
         )
+
+    @defer.inlineCallbacks
+    def test_room_summary_kept_up_to_date(self):
+        room_id = self.room.to_string()
+
+        @defer.inlineCallbacks
+        def _assert_summary_matches_current_state():
+            row = yield self.store._simple_select_one(
+                table="room_summaries",
+                keyvalues={"room_id": room_id},
+                retcols=("membership_counts", "members"),
+            )
+            counts, members = yield self.store.runInteraction(
+                "", self.store._calculate_room_summary_txn, room_id,
+            )
+            self.assertEqual(json.loads(row["membership_counts"]), counts)
+            self.assertEqual(json.loads(row["members"]), members)
+
+            summary = yield self.store.get_room_summary(room_id)
+            self.assertEqual(
+                {m: s.count for m, s in summary.items()}, counts,
+            )
+
+        users = [UserID.from_string("@user%i:test" % (i,)) for i in range(8)]
+        for user in users:
+            yield self.inject_room_member(self.room, user, Membership.JOIN)
+            yield _assert_summary_matches_current_state()
+
+        # Members leaving, some of which will be among the members kept in the
+        # summary.
+        for user in users[:5]:
+            yield self.inject_room_member(self.room, user, Membership.LEAVE)
+            yield _assert_summary_matches_current_state()
+
+        yield self.inject_room_member(self.room, users[0], Membership.JOIN)
+        yield _assert_summary_matches_current_state()
+
+    @defer.inlineCallbacks
+    def test_hosts_in_room_kept_up_to_date(self):
+        room_id = self.room.to_string()
+
+        @defer.inlineCallbacks
+        def _assert_hosts_match_current_state():
+            rows = yield self.store._simple_select_list(
+                table="room_joined_hosts",
+                keyvalues={"room_id": room_id},
+                retcols=("host", "joined_members"),
+            )
+            joined_members_by_host = yield self.store.runInteraction(
+                "", self.store._calculate_joined_hosts_txn, room_id,
+            )
+            self.assertEqual(
+                {r["host"]: r["joined_members"] for r in rows},
+                joined_members_by_host,
+            )
+
+            hosts = yield self.store.get_hosts_in_room(room_id)
+            self.assertEqual(hosts, frozenset(joined_members_by_host))
+
+        remote_users = [
+            UserID.from_string("@user%i:elsewhere" % (i,)) for i in range(3)
+        ]
+
+        yield self.inject_room_member(self.room, self.u_alice, Membership.JOIN)
+        yield _assert_hosts_match_current_state()
+
+        for user in remote_users:
+            yield self.inject_room_member(self.room, user, Membership.JOIN)
+            yield _assert_hosts_match_current_state()
+
+        for user in remote_users[:2]:
+            yield self.inject_room_member(self.room, user, Membership.LEAVE)
+            yield _assert_hosts_match_current_state()
+        self.assertIn("elsewhere", (yield self.store.get_hosts_in_room(room_id)))
+
+        yield self.inject_room_member(self.room, remote_users[2], Membership.LEAVE)
+        yield _assert_hosts_match_current_state()
+        self.assertEqual(
+            (yield self.store.get_hosts_in_room(room_id)), frozenset(["test"]),
+        )
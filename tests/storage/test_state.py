@@ -15,9 +15,12 @@
 
 import logging
 
+from mock import patch
+
 from twisted.internet import defer
 
 from synapse.api.constants import EventTypes, Membership, RoomVersions
+from synapse.storage import state
 from synapse.storage.state import StateFilter
 from synapse.types import RoomID, UserID
 
@@ -73,6 +76,115 @@ class StateStoreTestCase(tests.unittest.TestCase):
             self.assertEqual(s1[t].event_id, s2[t].event_id)
         self.assertEqual(len(s1), len(s2))
 
+    @defer.inlineCallbacks
+    def test_state_group_resolution(self):
+        room_id = self.room.to_string()
+
+        res = yield self.store.get_state_group_resolution([2, 1])
+        self.assertIsNone(res)
+
+        yield self.store.store_state_group_resolution(
+            room_id, [2, 1],
+            state_group=None,
+            prev_group=1,
+            delta_ids={(EventTypes.Name, ''): "$name:test"},
+        )
+        yield self.store.store_state_group_resolution(
+            room_id, [3, 1], state_group=3, prev_group=None, delta_ids=None,
+        )
+
+        # the order of the state groups shouldn't matter
+        res = yield self.store.get_state_group_resolution([1, 2])
+        self.assertEqual(res.state_group, None)
+        self.assertEqual(res.prev_group, 1)
+        self.assertEqual(res.delta_ids, {(EventTypes.Name, ''): "$name:test"})
+
+        res = yield self.store.get_state_group_resolution([1, 3])
+        self.assertEqual(res.state_group, 3)
+        self.assertEqual(res.delta_ids, None)
+
+        res = yield self.store.get_state_group_resolution([1, 2, 3])
+        self.assertIsNone(res)
+
+    def test_plan_sql_filter_clause(self):
+        engine = self.store.database_engine
+
+        plan = StateFilter.all().plan_sql_filter_clause(engine)
+        self.assertEqual(plan.strategy, state.STATE_FILTER_STRATEGY_FULL)
+        self.assertEqual(plan.where_clause, "")
+
+        plan = StateFilter.none().plan_sql_filter_clause(engine)
+        self.assertEqual(plan.strategy, state.STATE_FILTER_STRATEGY_NONE)
+
+        # small filters get a plain OR chain
+        small_filter = StateFilter.from_types([(EventTypes.Name, '')])
+        plan = small_filter.plan_sql_filter_clause(engine)
+        self.assertEqual(plan.strategy, state.STATE_FILTER_STRATEGY_OR_CHAIN)
+        self.assertEqual(
+            (plan.where_clause, plan.where_args),
+            small_filter.make_sql_filter_clause(),
+        )
+
+        members = ["@user%i:test" % (i,) for i in range(20)]
+        lazy_filter = StateFilter(
+            types={EventTypes.Member: set(members)}, include_others=True,
+        )
+        plan = lazy_filter.plan_sql_filter_clause(engine)
+        self.assertEqual(plan.strategy, state.STATE_FILTER_STRATEGY_KEY_LIST)
+        self.assertFalse(plan.needs_filtering)
+        self.assertEqual(len(plan.where_args), len(members) + 2)
+
+        with patch.object(state, "STATE_FILTER_TYPE_SCAN_THRESHOLD", 10):
+            plan = lazy_filter.plan_sql_filter_clause(engine)
+        self.assertEqual(plan.strategy, state.STATE_FILTER_STRATEGY_TYPE_SCAN)
+        self.assertTrue(plan.needs_filtering)
+        self.assertEqual(
+            plan.where_clause, "(type = ?) OR type NOT IN (?)",
+        )
+
+    @defer.inlineCallbacks
+    def test_get_state_for_event_with_large_filter(self):
+        e1 = yield self.inject_state_event(
+            self.room, self.u_alice, EventTypes.Create, '', {}
+        )
+        e2 = yield self.inject_state_event(
+            self.room,
+            self.u_alice,
+            EventTypes.Member,
+            self.u_alice.to_string(),
+            {"membership": Membership.JOIN},
+        )
+        e3 = yield self.inject_state_event(
+            self.room,
+            self.u_bob,
+            EventTypes.Member,
+            self.u_bob.to_string(),
+            {"membership": Membership.JOIN},
+        )
+
+        members = ["@user%i:test" % (i,) for i in range(20)]
+        members.append(self.u_alice.to_string())
+        lazy_filter = StateFilter(
+            types={EventTypes.Member: set(members)}, include_others=True,
+        )
+
+        expected = {
+            (e1.type, e1.state_key): e1,
+            (e2.type, e2.state_key): e2,
+        }
+
+        for threshold in (state.STATE_FILTER_TYPE_SCAN_THRESHOLD, 10):
+            # make sure we don't hit the cache
+            self.store._state_group_cache.invalidate_all()
+            self.store._state_group_members_cache.invalidate_all()
+
+            with patch.object(state, "STATE_FILTER_TYPE_SCAN_THRESHOLD", threshold):
+                state_map = yield self.store.get_state_for_event(
+                    e3.event_id, lazy_filter,
+                )
+
+            self.assertStateMapEqual(expected, state_map)
+
     @defer.inlineCallbacks
     def test_get_state_groups_ids(self):
         e1 = yield self.inject_state_event(
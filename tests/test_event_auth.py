@@ -15,6 +15,8 @@
 
 import unittest
 
+from mock import patch
+
 from synapse import event_auth
 from synapse.api.constants import RoomVersions
 from synapse.api.errors import AuthError
@@ -86,6 +88,55 @@ class EventAuthTestCase(unittest.TestCase):
             do_sig_check=False,
         )
 
+    def test_batch_checker(self):
+        """
+        Check that the batch checker gives the same results as check, and only
+        works out each user's level once per power levels event
+        """
+        creator = "@creator:example.com"
+        pleb = "@joiner:example.com"
+
+        auth_events = {
+            ("m.room.create", ""): _create_event(creator),
+            ("m.room.member", creator): _join_event(creator),
+            ("m.room.power_levels", ""): _power_levels_event(
+                creator, {"state_default": "30", "users": {creator: "100"}}
+            ),
+            ("m.room.member", pleb): _join_event(pleb),
+        }
+
+        checker = event_auth.BatchAuthChecker(RoomVersions.V1)
+
+        with patch.object(
+            event_auth, "get_user_power_level",
+            wraps=event_auth.get_user_power_level,
+        ) as get_user_power_level:
+            for _ in range(3):
+                checker.check(
+                    _random_state_event(creator), auth_events,
+                    do_sig_check=False,
+                )
+                self.assertRaises(
+                    AuthError,
+                    checker.check,
+                    _random_state_event(pleb),
+                    auth_events,
+                    do_sig_check=False,
+                )
+
+            self.assertEqual(get_user_power_level.call_count, 2)
+
+            # a new power levels event gets its own levels
+            auth_events[("m.room.power_levels", "")] = _power_levels_event(
+                creator,
+                {"state_default": "30", "users": {creator: "100", pleb: "30"}},
+            )
+            checker.check(
+                _random_state_event(pleb), auth_events, do_sig_check=False,
+            )
+
+            self.assertEqual(get_user_power_level.call_count, 3)
+
 
 # helpers for making events
 
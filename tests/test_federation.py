@@ -88,7 +88,7 @@ class MessageAcceptTests(unittest.TestCase):
         prev_events that said event references.
         """
 
-        def post_json(destination, path, data, headers=None, timeout=0):
+        def post_json(destination, path, data, headers=None, timeout=0, parser=None):
             # If it asks us for new missing events, give them NOTHING
             if path.startswith("/_matrix/federation/v1/get_missing_events/"):
                 return {"events": []}
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from synapse.notifier import _NotifierUserStream
+from synapse.types import StreamToken
+
+from tests import unittest
+
+
+class NotifierTestCase(unittest.HomeserverTestCase):
+    def make_homeserver(self, reactor, clock):
+        hs = self.setup_test_homeserver("server", http_client=None)
+        self.notifier = hs.get_notifier()
+        return hs
+
+    def _make_user_stream(self, user_id, rooms):
+        user_stream = _NotifierUserStream(
+            user_id=user_id,
+            rooms=rooms,
+            current_token=StreamToken.START,
+            time_now_ms=self.clock.time_msec(),
+        )
+        self.notifier._register_with_keys(user_stream)
+
+        wakeups = []
+        wake = user_stream.wake
+
+        def counting_wake():
+            wakeups.append(user_stream.current_token)
+            wake()
+
+        user_stream.wake = counting_wake
+        return user_stream, wakeups
+
+    def test_wakeups_are_coalesced(self):
+        user_stream, wakeups = self._make_user_stream(
+            "@alice:test", ["!a:test", "!b:test"],
+        )
+        listener = user_stream.new_listener(StreamToken.START)
+
+        self.notifier.on_new_event("typing_key", 1, rooms=["!a:test"])
+        self.notifier.on_new_event("typing_key", 2, rooms=["!a:test", "!b:test"])
+
+        # The token is advanced straight away, but the listener is not woken
+        # until the end of the coalescing window.
+        self.assertEqual(user_stream.current_token.typing_key, 2)
+        self.assertNoResult(listener.deferred)
+
+        self.reactor.advance(self.notifier.NOTIFY_COALESCE_WINDOW_MS / 1000.)
+
+        token = self.successResultOf(listener.deferred)
+        self.assertEqual(token.typing_key, 2)
+        self.assertEqual(len(wakeups), 1)
+
+        # A listener which turns up after the event but before the wake-up
+        # should not have to wait.
+        self.notifier.on_new_event("typing_key", 3, rooms=["!b:test"])
+        listener = user_stream.new_listener(token)
+        token = self.successResultOf(listener.deferred)
+        self.assertEqual(token.typing_key, 3)
+
+        self.reactor.advance(self.notifier.NOTIFY_COALESCE_WINDOW_MS / 1000.)
+        self.assertEqual(len(wakeups), 2)
+
+    def test_wakeups_without_window(self):
+        self.notifier.NOTIFY_COALESCE_WINDOW_MS = 0
+
+        user_stream, wakeups = self._make_user_stream(
+            "@alice:test", ["!a:test"],
+        )
+        listener = user_stream.new_listener(StreamToken.START)
+
+        self.notifier.on_new_event("typing_key", 1, rooms=["!a:test"])
+
+        token = self.successResultOf(listener.deferred)
+        self.assertEqual(token.typing_key, 1)
+        self.assertEqual(len(wakeups), 1)
@@ -15,6 +15,7 @@
 import logging
 import re
 
+from mock import Mock
 from six import StringIO
 
 from twisted.internet.defer import Deferred
@@ -24,7 +25,7 @@ from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET
 
 from synapse.api.errors import Codes, SynapseError
-from synapse.http.server import JsonResource
+from synapse.http.server import JsonResource, respond_with_json_chunks
 from synapse.http.site import SynapseSite, logger
 from synapse.util import Clock
 from synapse.util.logcontext import make_deferred_yieldable
@@ -152,6 +153,54 @@ class JsonResourceTests(unittest.TestCase):
         self.assertEqual(channel.json_body["error"], "Unrecognized request")
         self.assertEqual(channel.json_body["errcode"], "M_UNRECOGNIZED")
 
+    def test_json_chunks(self):
+        """
+        A callback can stream its response out with respond_with_json_chunks,
+        which only pulls from the iterator as the response is consumed.
+        """
+        pulled = []
+
+        def _chunks():
+            for i in range(3):
+                pulled.append(i)
+                yield b'{"a":"' if i == 0 else b'%d' % (i,)
+            yield b'"}'
+
+        def _callback(request, **kwargs):
+            respond_with_json_chunks(request, 200, _chunks())
+            self.assertEqual(pulled, [])
+
+        res = JsonResource(self.homeserver)
+        res.register_paths("GET", [re.compile("^/_matrix/foo$")], _callback)
+
+        request, channel = make_request(self.reactor, b"GET", b"/_matrix/foo")
+        render(request, res, self.reactor)
+
+        self.assertEqual(channel.result["code"], b'200')
+        self.assertEqual(pulled, [0, 1, 2])
+        self.assertEqual(channel.json_body, {"a": "12"})
+
+    def test_json_chunks_exception(self):
+        """
+        If the iterator passed to respond_with_json_chunks fails, the
+        connection is dropped rather than sending a truncated body.
+        """
+
+        def _chunks():
+            yield b'{"a":'
+            raise Exception("boo")
+
+        request = Mock(_disconnected=False)
+        respond_with_json_chunks(request, 200, _chunks())
+
+        producer = request.registerProducer.call_args[0][0]
+        producer.resumeProducing()
+
+        request.write.assert_not_called()
+        request.finish.assert_not_called()
+        request.unregisterProducer.assert_called_once_with()
+        request.loseConnection.assert_called_once_with()
+
 
 class SiteTestCase(unittest.HomeserverTestCase):
     def test_lose_connection(self):
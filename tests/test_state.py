@@ -13,7 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from mock import Mock
+from mock import Mock, patch
 
 from twisted.internet import defer
 
@@ -21,6 +21,7 @@ from synapse.api.auth import Auth
 from synapse.api.constants import EventTypes, Membership, RoomVersions
 from synapse.events import FrozenEvent
 from synapse.state import StateHandler, StateResolutionHandler
+from synapse.storage.state import StateFilter, _StateGroupResolution
 
 from tests import unittest
 
@@ -76,6 +77,8 @@ class StateGroupStore(object):
 
         self._event_id_to_event = {}
 
+        self._resolutions = {}
+
         self._next_group = 1
 
     def get_state_groups_ids(self, room_id, event_ids):
@@ -87,6 +90,20 @@ class StateGroupStore(object):
 
         return defer.succeed(groups)
 
+    def get_state_groups_for_events(self, event_ids):
+        groups = {}
+        for event_id in event_ids:
+            group = self._event_to_state_group.get(event_id)
+            if group:
+                groups[event_id] = group
+
+        return defer.succeed(groups)
+
+    def get_state_ids_for_group(self, state_group, state_filter=StateFilter.all()):
+        return defer.succeed(
+            state_filter.filter_state(self._group_to_state[state_group])
+        )
+
     def store_state_group(
         self, event_id, room_id, prev_group, delta_ids, current_state_ids
     ):
@@ -107,6 +124,17 @@ class StateGroupStore(object):
     def get_state_group_delta(self, name):
         return (None, None)
 
+    def get_state_group_resolution(self, state_groups):
+        return defer.succeed(self._resolutions.get(frozenset(state_groups)))
+
+    def store_state_group_resolution(
+        self, room_id, state_groups, state_group, prev_group, delta_ids
+    ):
+        self._resolutions[frozenset(state_groups)] = _StateGroupResolution(
+            state_group=state_group, prev_group=prev_group, delta_ids=delta_ids
+        )
+        return defer.succeed(None)
+
     def register_events(self, events):
         for e in events:
             self._event_id_to_event[e.event_id] = e
@@ -172,6 +200,7 @@ class StateTestCase(unittest.TestCase):
         hs.get_auth.return_value = Auth(hs)
         hs.get_state_resolution_handler = lambda: StateResolutionHandler(hs)
 
+        self.hs = hs
         self.state = StateHandler(hs)
         self.event_id = 0
 
@@ -241,6 +270,51 @@ class StateTestCase(unittest.TestCase):
             {"START", "A", "C"}, {e_id for e_id in prev_state_ids.values()}
         )
 
+    @defer.inlineCallbacks
+    def test_branch_conflict_reuses_stored_resolution(self):
+        graph = Graph(
+            nodes={
+                "START": DictObj(
+                    type=EventTypes.Create,
+                    state_key="",
+                    content={"creator": "@user_id:example.com"},
+                    depth=1,
+                ),
+                "A": DictObj(
+                    type=EventTypes.Member,
+                    state_key="@user_id:example.com",
+                    content={"membership": Membership.JOIN},
+                    membership=Membership.JOIN,
+                    depth=2,
+                ),
+                "B": DictObj(type=EventTypes.Name, state_key="", depth=3),
+                "C": DictObj(type=EventTypes.Name, state_key="", depth=4),
+                "D": DictObj(type=EventTypes.Message, depth=5),
+            },
+            edges={"A": ["START"], "B": ["A"], "C": ["A"], "D": ["B", "C"]},
+        )
+
+        self.store.register_events(graph.walk())
+
+        for event in graph.walk():
+            context = yield self.state.compute_event_context(event)
+            self.store.register_event_context(event, context)
+
+        self.assertEqual(1, len(self.store._resolutions))
+
+        # a fresh StateResolutionHandler (eg, on another worker) has nothing in
+        # its in-memory cache, so should use the stored resolution rather than
+        # resolving the conflict again.
+        self.state._state_resolution_handler = StateResolutionHandler(self.hs)
+
+        with patch("synapse.state.resolve_events_with_store") as resolve:
+            resolve.side_effect = AssertionError("state was resolved again")
+            entry = yield self.state.resolve_state_groups_for_events(
+                "!room_id:example.com", ["B", "C"]
+            )
+
+        self.assertSetEqual({"START", "A", "C"}, set(entry.state.values()))
+
     @defer.inlineCallbacks
     def test_branch_have_banned_conflict(self):
         graph = Graph(
@@ -442,6 +516,88 @@ class StateTestCase(unittest.TestCase):
 
         self.assertEqual(group_name, context.state_group)
 
+    @defer.inlineCallbacks
+    def test_message_context_loads_state_lazily(self):
+        prev_event_id = "prev_event_id"
+        event = create_event(
+            type="test_message", name="event2", prev_events=[(prev_event_id, {})]
+        )
+
+        old_state = [
+            create_event(type=EventTypes.Create, state_key=""),
+            create_event(type=EventTypes.Member, state_key=event.sender),
+            create_event(type=EventTypes.Member, state_key="@other:example.com"),
+        ]
+
+        group_name = self.store.store_state_group(
+            prev_event_id,
+            event.room_id,
+            None,
+            None,
+            {(e.type, e.state_key): e.event_id for e in old_state},
+        )
+        self.store.register_event_id_state_group(prev_event_id, group_name)
+
+        context = yield self.state.compute_event_context(event)
+
+        self.assertEqual(group_name, context.state_group)
+        self.assertIsNone(context.get_cached_current_state_ids())
+
+        # asking for a subset of the state shouldn't load the full state
+        prev_state_ids = yield context.get_prev_state_ids(
+            self.store, StateFilter.from_types([(EventTypes.Member, event.sender)])
+        )
+        self.assertEqual(
+            {(EventTypes.Member, event.sender): old_state[1].event_id},
+            prev_state_ids,
+        )
+        self.assertIsNone(context.get_cached_current_state_ids())
+
+        current_state_ids = yield context.get_current_state_ids(self.store)
+        self.assertEqual(
+            set(e.event_id for e in old_state), set(current_state_ids.values())
+        )
+
+    @defer.inlineCallbacks
+    def test_get_current_state_ids_with_filter(self):
+        prev_event_id = "prev_event_id"
+        event = create_event(
+            type="test_message", name="event2", prev_events=[(prev_event_id, {})]
+        )
+
+        old_state = [
+            create_event(type=EventTypes.Create, state_key=""),
+            create_event(type=EventTypes.Member, state_key=event.sender),
+            create_event(type=EventTypes.Member, state_key="@other:example.com"),
+        ]
+
+        group_name = self.store.store_state_group(
+            prev_event_id,
+            event.room_id,
+            None,
+            None,
+            {(e.type, e.state_key): e.event_id for e in old_state},
+        )
+        self.store.register_event_id_state_group(prev_event_id, group_name)
+
+        # with a single state group, only the requested state is loaded
+        self.store.get_state_groups_ids = Mock(
+            side_effect=Exception("should not load the full state"),
+        )
+        state_ids = yield self.state.get_current_state_ids(
+            event.room_id, [prev_event_id],
+            state_filter=StateFilter.from_types([
+                (EventTypes.Create, ""), (EventTypes.Member, event.sender),
+            ]),
+        )
+        self.assertEqual(
+            {
+                (EventTypes.Create, ""): old_state[0].event_id,
+                (EventTypes.Member, event.sender): old_state[1].event_id,
+            },
+            state_ids,
+        )
+
     @defer.inlineCallbacks
     def test_trivial_annotate_state(self):
         prev_event_id = "prev_event_id"
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from synapse.util.hash_ring import ConsistentHashRing
+
+from .. import unittest
+
+
+class ConsistentHashRingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.keys = ["server%d.example.com" % (i,) for i in range(1000)]
+
+    def test_keys_are_spread_across_nodes(self):
+        ring = ConsistentHashRing(["a", "b", "c"])
+
+        counts = {}
+        for key in self.keys:
+            node = ring.get_node(key)
+            counts[node] = counts.get(node, 0) + 1
+
+        self.assertEqual(set(counts), {"a", "b", "c"})
+        for count in counts.values():
+            self.assertGreater(count, 200)
+
+    def test_adding_node_only_moves_keys_to_it(self):
+        ring = ConsistentHashRing(["a", "b", "c"])
+        new_ring = ConsistentHashRing(["a", "b", "c", "d"])
+
+        moved = 0
+        for key in self.keys:
+            node = ring.get_node(key)
+            new_node = new_ring.get_node(key)
+            if node != new_node:
+                self.assertEqual(new_node, "d")
+                moved += 1
+
+        self.assertGreater(moved, 0)
+        self.assertLess(moved, 400)
@@ -112,6 +112,9 @@ def default_config(name):
     config.password_providers = []
     config.worker_replication_url = ""
     config.worker_app = None
+    config.worker_name = None
+    config.federation_sender_instances = []
+    config.federation_sender_instance_name = "master"
     config.email_enable_notifs = False
     config.block_non_admin_invites = False
     config.federation_domain_whitelist = None
@@ -120,6 +123,13 @@ def default_config(name):
     config.federation_rc_sleep_delay = 100
     config.federation_rc_concurrent = 10
     config.filter_timeline_limit = 5000
+    config.initial_sync_cache_users = set()
+    config.initial_sync_cache_refresh_interval = 5 * 60 * 1000
+    config.sync_max_concurrent_computations = 0
+    config.sync_timeout_jitter = 0
+    config.federation_client_max_connections_per_host = 5
+    config.federation_client_idle_connection_timeout = 2 * 60 * 1000
+    config.federation_client_max_idle_connections = None
     config.user_directory_search_all_users = False
     config.user_consent_server_notice_content = None
     config.block_events_without_consent_error = None